@@ -0,0 +1,72 @@
+# admission.py
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class DBUnavailable(Exception):
+    """БД не успела выдать соединение или breaker разомкнут — отвечаем «занято», а не ждём."""
+
+
+class CircuitBreaker:
+    """closed -> (threshold ошибок БД подряд) -> open -> (cooldown) -> half_open.
+
+    В half_open проходит один пробный вызов: успех замыкает цепь, ошибка снова
+    размыкает на cooldown. Пока цепь разомкнута, before() сразу бросает
+    DBUnavailable — хендлеры не копятся в ожидании лежащей БД.
+    """
+
+    def __init__(self, name: str, threshold: int = 5, cooldown: float = 10.0):
+        self.name = name
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.failures = 0
+        self.trips = 0
+        self.opened_at = 0.0
+        self._probing = False
+
+    def before(self):
+        if self.state == "closed":
+            return
+        if self.state == "open":
+            if time.monotonic() - self.opened_at < self.cooldown:
+                raise DBUnavailable(f"{self.name}: circuit open")
+            self.state = "half_open"
+        if self._probing:
+            raise DBUnavailable(f"{self.name}: circuit half-open")
+        self._probing = True
+
+    def success(self):
+        if self.state != "closed":
+            logger.info("DB circuit %s closed", self.name)
+        self.state = "closed"
+        self.failures = 0
+        self._probing = False
+
+    def failure(self):
+        self.failures += 1
+        self._probing = False
+        if self.state == "half_open" or self.failures >= self.threshold:
+            if self.state != "open":
+                self.trips += 1
+                logger.warning("DB circuit %s opened after %d failures", self.name, self.failures)
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+    def abandon(self):
+        """Вызов не дошёл до БД или отменён — ни успех, ни ошибка."""
+        self._probing = False
+
+    @property
+    def is_open(self) -> bool:
+        return self.state == "open" and time.monotonic() - self.opened_at < self.cooldown
+
+    @property
+    def status(self) -> str:
+        """Состояние для наружу: после cooldown цепь уже ждёт пробу, даже если
+        before() с тех пор никто не вызывал."""
+        if self.state == "closed":
+            return "closed"
+        return "open" if self.is_open else "half_open"
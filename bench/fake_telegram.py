@@ -0,0 +1,58 @@
+# bench/fake_telegram.py
+"""Сессия aiogram, которая не ходит в Telegram, а записывает исходящие вызовы."""
+import asyncio
+import datetime as dt
+import itertools
+import time
+from typing import Any, AsyncGenerator, Dict, List, Optional
+
+from aiogram import Bot
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import TelegramMethod
+from aiogram.methods.base import TelegramType
+from aiogram.types import Message, User
+
+
+class FakeSession(BaseSession):
+    """Отвечает на любой метод правдоподобным результатом; latency — имитация сети."""
+
+    def __init__(self, latency: float = 0.0):
+        super().__init__()
+        self.latency = latency
+        self.calls: List[Dict[str, Any]] = []
+        self._message_ids = itertools.count(1_000_000)
+
+    async def close(self) -> None:
+        pass
+
+    async def stream_content(self, url: str, headers: Optional[Dict[str, Any]] = None,
+                             timeout: int = 30, chunk_size: int = 65536,
+                             raise_for_status: bool = True) -> AsyncGenerator[bytes, None]:
+        yield b""
+
+    def _result(self, method: TelegramMethod[TelegramType]) -> Any:
+        returning = method.__returning__
+        if returning is bool:
+            return True
+        if returning is User:
+            return User(id=1, is_bot=True, first_name="bench", username="bench_bot")
+        chat_id = getattr(method, "chat_id", None) or 1
+        payload: Dict[str, Any] = {
+            "message_id": getattr(method, "message_id", None) or next(self._message_ids),
+            "date": int(dt.datetime.now().timestamp()),
+            "chat": {"id": chat_id, "type": "private"},
+            "text": getattr(method, "text", None),
+        }
+        if hasattr(method, "document"):
+            payload["document"] = {"file_id": "bench-file", "file_unique_id": "bench-file"}
+        return Message.model_validate(payload)
+
+    async def make_request(self, bot: Bot, method: TelegramMethod[TelegramType],
+                           timeout: Optional[int] = None) -> TelegramType:
+        started = time.perf_counter()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        result = self._result(method)
+        self.calls.append({"method": type(method).__name__,
+                           "elapsed": time.perf_counter() - started})
+        return result
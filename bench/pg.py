@@ -0,0 +1,86 @@
+# bench/pg.py
+"""Одноразовый локальный Postgres для бенчмарка (initdb + pg_ctl во временном каталоге)."""
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+from contextlib import contextmanager
+from typing import Iterator
+
+import asyncpg
+
+import migrate
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _pg_bin(name: str) -> str:
+    path = shutil.which(name)
+    if path:
+        return path
+    # Debian/Ubuntu кладут серверные утилиты в /usr/lib/postgresql/<ver>/bin
+    root = "/usr/lib/postgresql"
+    if os.path.isdir(root):
+        for ver in sorted(os.listdir(root), reverse=True):
+            candidate = os.path.join(root, ver, "bin", name)
+            if os.path.exists(candidate):
+                return candidate
+    raise RuntimeError(f"{name} not found: install PostgreSQL or set BENCH_DATABASE_URL")
+
+
+@contextmanager
+def disposable_postgres() -> Iterator[str]:
+    """DSN временного кластера; BENCH_DATABASE_URL — использовать готовую (пустую) БД."""
+    dsn = os.getenv("BENCH_DATABASE_URL")
+    if dsn:
+        yield dsn
+        return
+
+    workdir = tempfile.mkdtemp(prefix="bench-pg-")
+    datadir = os.path.join(workdir, "data")
+    port = _free_port()
+    subprocess.run([_pg_bin("initdb"), "-D", datadir, "-U", "bench", "-A", "trust", "-E", "UTF8"],
+                   check=True, stdout=subprocess.DEVNULL)
+    subprocess.run([_pg_bin("pg_ctl"), "-D", datadir, "-l", os.path.join(workdir, "pg.log"), "-w",
+                    "-o", f"-p {port} -k {workdir} -c fsync=off -c listen_addresses=127.0.0.1",
+                    "start"], check=True, stdout=subprocess.DEVNULL)
+    try:
+        yield f"postgresql://bench@127.0.0.1:{port}/postgres"
+    finally:
+        subprocess.run([_pg_bin("pg_ctl"), "-D", datadir, "-m", "immediate", "stop"],
+                       stdout=subprocess.DEVNULL)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+async def seed(dsn: str, managers: int, restaurants_per_manager: int, open_incidents: int):
+    """Схема и справочники; возвращает {manager_id: [restaurant_id, ...]} и id открытых инцидентов."""
+    c = await asyncpg.connect(dsn)
+    try:
+        await migrate.apply(c)
+        links: dict[int, list[int]] = {}
+        for m in range(managers):
+            mgr_id = await c.fetchval("INSERT INTO managers (name) VALUES ($1) RETURNING id;",
+                                      f"Управляющий {m + 1:03d}")
+            links[mgr_id] = []
+            for r in range(restaurants_per_manager):
+                rest_id = await c.fetchval("INSERT INTO restaurants (name) VALUES ($1) RETURNING id;",
+                                           f"Ресторан {m + 1:03d}-{r + 1:02d}")
+                await c.execute("INSERT INTO manager_restaurants VALUES ($1, $2);", mgr_id, rest_id)
+                links[mgr_id].append(rest_id)
+        open_ids = []
+        pairs = [(m, r) for m, rs in links.items() for r in rs]
+        for n in range(open_incidents):
+            m, r = pairs[n % len(pairs)]
+            open_ids.append(await c.fetchval(
+                "INSERT INTO incidents (manager_id, restaurant_id, start_time, reason, comment, amount_kzt, status) "
+                "VALUES ($1, $2, now() - interval '2 hours', 'external', 'bench', 25000, 'open') RETURNING id;",
+                m, r,
+            ))
+        return links, open_ids
+    finally:
+        await c.close()
@@ -0,0 +1,133 @@
+# bench/run.py
+"""Нагрузочный прогон вебхука: python -m bench.run --users 200 --journeys 3 --max-p99-ms 250
+
+Поднимает одноразовый Postgres, подменяет сессию Bot на FakeSession и гоняет
+синтетические апдейты через server.app в том же процессе. Пользователи работают
+параллельно, апдейты одного пользователя — строго по очереди, как в Telegram.
+Код возврата 1, если p99 выше --max-p99-ms или хуже --baseline больше чем на
+--max-regression процентов.
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import statistics
+from typing import Dict, List
+
+from bench.pg import disposable_postgres, seed
+
+
+def _percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    idx = min(len(ordered) - 1, max(0, int(round(q / 100 * len(ordered))) - 1))
+    return ordered[idx]
+
+
+async def _run(args, dsn: str) -> Dict[str, float]:
+    os.environ["DATABASE_URL"] = dsn
+    os.environ.setdefault("BOT_TOKEN", "123456:bench")
+    # FakeSession не отвечает 429: с лимитером прогон меряет паузы token bucket'ов,
+    # а не обработку, поэтому по умолчанию он выключен (--rate-limit — включить)
+    os.environ["TG_RATE_LIMIT"] = "1" if args.rate_limit else "0"
+
+    import httpx
+    import server
+    from bench.fake_telegram import FakeSession
+    from bench.updates import user_script
+
+    links, open_ids = await seed(dsn, args.managers, args.restaurants, args.users)
+
+    fake = FakeSession(latency=args.api_latency_ms / 1000)
+    fake.middleware = server.bot.session.middleware
+    server.bot.session = fake
+
+    await server._startup()
+    path = f"/webhook/{server.BOT_TOKEN}"
+    latencies: List[float] = []
+    errors = 0
+
+    async def drive(client: httpx.AsyncClient, chat_id: int):
+        nonlocal errors
+        script = user_script(chat_id, args.journeys, links, open_ids, args.close_ratio, seed=chat_id)
+        for update in script:
+            started = time.perf_counter()
+            resp = await client.post(path, json=update)
+            latencies.append(time.perf_counter() - started)
+            if resp.status_code != 200:
+                errors += 1
+
+    transport = httpx.ASGITransport(app=server.app)
+    try:
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            started = time.perf_counter()
+            await asyncio.gather(*(drive(client, 10_000 + n) for n in range(args.users)))
+            if server.update_queue:
+                await server.update_queue.stop()
+                server.update_queue = None
+            elapsed = time.perf_counter() - started
+    finally:
+        await server._shutdown()
+
+    ms = [v * 1000 for v in latencies]
+    return {
+        "updates": len(ms),
+        "errors": errors,
+        "seconds": round(elapsed, 3),
+        "updates_per_sec": round(len(ms) / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(_percentile(ms, 50), 2),
+        "p95_ms": round(_percentile(ms, 95), 2),
+        "p99_ms": round(_percentile(ms, 99), 2),
+        "mean_ms": round(statistics.fmean(ms), 2) if ms else 0.0,
+        "api_calls": len(fake.calls),
+        "rate_limit": args.rate_limit,
+    }
+
+
+def main(argv=None) -> int:
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument("--users", type=int, default=100, help="параллельных пользователей (чатов)")
+    p.add_argument("--journeys", type=int, default=3, help="сценариев на пользователя")
+    p.add_argument("--managers", type=int, default=20)
+    p.add_argument("--restaurants", type=int, default=5, help="ресторанов на управляющего")
+    p.add_argument("--close-ratio", type=float, default=0.25, help="доля сценариев «Закрыть»")
+    p.add_argument("--api-latency-ms", type=float, default=0.0, help="имитация задержки Bot API")
+    p.add_argument("--rate-limit", action="store_true",
+                   help="с лимитером исходящих вызовов (TG_RATE_LIMIT=1)")
+    p.add_argument("--max-p99-ms", type=float, default=None, help="порог p99, мс")
+    p.add_argument("--baseline", help="JSON с прошлым результатом для сравнения")
+    p.add_argument("--max-regression", type=float, default=20.0, help="допустимый рост p99, %%")
+    p.add_argument("--output", help="куда сохранить результат (JSON)")
+    args = p.parse_args(argv)
+
+    with disposable_postgres() as dsn:
+        result = asyncio.run(_run(args, dsn))
+
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+
+    failed = False
+    if result["errors"]:
+        print(f"FAIL: {result['errors']} non-200 responses", file=sys.stderr)
+        failed = True
+    if args.max_p99_ms is not None and result["p99_ms"] > args.max_p99_ms:
+        print(f"FAIL: p99 {result['p99_ms']} ms > {args.max_p99_ms} ms", file=sys.stderr)
+        failed = True
+    if args.baseline:
+        with open(args.baseline) as f:
+            base = json.load(f)
+        limit = base["p99_ms"] * (1 + args.max_regression / 100)
+        if result["p99_ms"] > limit:
+            print(f"FAIL: p99 {result['p99_ms']} ms regressed over baseline "
+                  f"{base['p99_ms']} ms (+{args.max_regression}%)", file=sys.stderr)
+            failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,97 @@
+# bench/updates.py
+"""Генератор синтетических апдейтов: полные сценарии IncidentFSM и CloseLaterFSM."""
+import datetime as dt
+import itertools
+import random
+from typing import Any, Dict, Iterator, List
+
+from bot import AMOUNTS, BTN_CLOSE, BTN_INCIDENT, REASONS
+
+_update_ids = itertools.count(1)
+_message_ids = itertools.count(1)
+
+
+def _user(chat_id: int) -> Dict[str, Any]:
+    return {"id": chat_id, "is_bot": False, "first_name": f"bench{chat_id}"}
+
+
+def message(chat_id: int, text: str) -> Dict[str, Any]:
+    return {
+        "update_id": next(_update_ids),
+        "message": {
+            "message_id": next(_message_ids),
+            "date": int(dt.datetime.now().timestamp()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": _user(chat_id),
+            "text": text,
+        },
+    }
+
+
+def callback(chat_id: int, data: str, message_id: int) -> Dict[str, Any]:
+    return {
+        "update_id": next(_update_ids),
+        "callback_query": {
+            "id": str(next(_update_ids)),
+            "chat_instance": str(chat_id),
+            "from": _user(chat_id),
+            "data": data,
+            "message": {
+                "message_id": message_id,
+                "date": int(dt.datetime.now().timestamp()),
+                "chat": {"id": chat_id, "type": "private"},
+                "from": {"id": 1, "is_bot": True, "first_name": "bench"},
+                "text": "…",
+            },
+        },
+    }
+
+
+def incident_journey(chat_id: int, links: Dict[int, List[int]], rnd: random.Random) -> Iterator[Dict[str, Any]]:
+    mid = next(_message_ids)
+    mgr = rnd.choice(list(links))
+    rest = rnd.choice(links[mgr])
+    day = (dt.date.today() - dt.timedelta(days=rnd.randint(0, 6))).isoformat()
+    yield message(chat_id, BTN_INCIDENT)
+    yield callback(chat_id, f"mgr:{mgr}", mid)
+    if rnd.random() < 0.3:  # передумал с управляющим
+        yield callback(chat_id, "back:manager", mid)
+        yield callback(chat_id, f"mgr:{mgr}", mid)
+    yield callback(chat_id, f"rest:{rest}", mid)
+    if rnd.random() < 0.3:
+        yield callback(chat_id, "back:restaurant", mid)
+        yield callback(chat_id, f"rest:{rest}", mid)
+    yield callback(chat_id, f"day:{day}", mid)
+    yield callback(chat_id, f"sh:{rnd.randint(0, 23):02d}", mid)
+    yield callback(chat_id, f"sm:{rnd.choice(['00', '15', '30', '45'])}", mid)
+    if rnd.random() < 0.2:
+        yield callback(chat_id, "back:start_minute", mid)
+        yield callback(chat_id, f"sm:{rnd.choice(['00', '15', '30', '45'])}", mid)
+    yield callback(chat_id, rnd.choice(["end:now", "end:later"]), mid)
+    yield callback(chat_id, f"reason:{rnd.choice(REASONS)[1]}", mid)
+    yield message(chat_id, "bench комментарий")
+    yield callback(chat_id, f"amount:{rnd.choice(AMOUNTS[:-1])}", mid)
+    yield callback(chat_id, "confirm:yes", mid)
+
+
+def close_journey(chat_id: int, incident_id: int, rnd: random.Random) -> Iterator[Dict[str, Any]]:
+    mid = next(_message_ids)
+    yield message(chat_id, BTN_CLOSE)
+    yield callback(chat_id, f"pick:{incident_id}", mid)
+    yield callback(chat_id, f"day:{dt.date.today().isoformat()}", mid)
+    yield callback(chat_id, f"eh:{rnd.randint(0, 23):02d}", mid)
+    yield callback(chat_id, f"em:{rnd.choice(['00', '15', '30', '45'])}", mid)
+    yield callback(chat_id, f"close_yes:{incident_id}", mid)
+
+
+def user_script(chat_id: int, journeys: int, links: Dict[int, List[int]], open_ids: List[int],
+                close_ratio: float, seed: int) -> List[Dict[str, Any]]:
+    """Последовательность апдейтов одного пользователя (порядок внутри чата важен)."""
+    rnd = random.Random(seed)
+    out: List[Dict[str, Any]] = []
+    for _ in range(journeys):
+        if open_ids and rnd.random() < close_ratio:
+            out.extend(close_journey(chat_id, open_ids.pop(), rnd))
+        else:
+            out.extend(incident_journey(chat_id, links, rnd))
+    return out
@@ -1,13 +1,17 @@
 # bot.py
 from __future__ import annotations
 import os
+import logging
 import datetime as dt
+from functools import lru_cache
 from typing import Optional
 
 from aiogram import Router, F
+from aiogram.filters import ExceptionTypeFilter
 from aiogram.types import (
     Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton,
-    ReplyKeyboardMarkup, KeyboardButton
+    ReplyKeyboardMarkup, KeyboardButton, FSInputFile, BufferedInputFile,
+    InlineQuery, InlineQueryResultArticle, InputTextMessageContent, ErrorEvent,
 )
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.fsm.context import FSMContext
@@ -15,6 +19,14 @@ from aiogram.fsm.context import FSMContext
 import pytz
 
 import db
+import reports
+import report_render
+import incident_import
+import search_index
+import wizard_token
+from wizard_token import WizardData
+
+logger = logging.getLogger(__name__)
 
 router = Router()
 
@@ -35,6 +47,10 @@ AMOUNTS = ["10000", "25000", "50000", "100000", "250000", "500000", "1000000", "
 TZ = os.getenv("TZ", "Asia/Almaty")
 tz = pytz.timezone(TZ)
 
+# WIZARD_STATELESS=1 — выбранные в визарде инцидента поля едут в callback_data
+# (wizard_token), FSM-хранилище нужно только для комментария
+WIZARD_STATELESS = os.getenv("WIZARD_STATELESS", "0") == "1"
+
 # --- Главное меню (ReplyKeyboard) ---
 main_kb = ReplyKeyboardMarkup(
     keyboard=[
@@ -67,6 +83,12 @@ class CloseLaterFSM(StatesGroup):
     end_minute = State()
     confirm = State()
 
+# --- Реестр клавиатур ---
+# Статичные клавиатуры строятся один раз (lru_cache + прогрев при импорте), дни —
+# один раз за локальные сутки, списки управляющих/ресторанов — до смены справочника
+# (db.ref_cache_version). Разметки общие для всех апдейтов: их нельзя изменять.
+
+@lru_cache(maxsize=None)
 def kb_back_next(back_cb: str) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(
         inline_keyboard=[[InlineKeyboardButton(text="⬅️ Назад", callback_data=back_cb)]]
@@ -80,15 +102,22 @@ def kb_list(items: list[tuple[str, str]], back: Optional[str]=None) -> InlineKey
     return InlineKeyboardMarkup(inline_keyboard=rows)
 
 def kb_days() -> InlineKeyboardMarkup:
-    today = dt.datetime.now(tz).date()
-    buttons = []
-    buttons.append(("📅 Сегодня", f"day:{today.isoformat()}"))
-    buttons.append(("📅 Вчера", f"day:{(today - dt.timedelta(days=1)).isoformat()}"))
+    return _kb_days_for(dt.datetime.now(tz).date())
+
+@lru_cache(maxsize=2)
+def _day_choices(today: dt.date) -> tuple[tuple[str, dt.date], ...]:
+    days = [("📅 Сегодня", today), ("📅 Вчера", today - dt.timedelta(days=1))]
     for n in range(2, 8):
         d = today - dt.timedelta(days=n)
-        buttons.append((d.strftime("📅 %a %d.%m"), f"day:{d.isoformat()}"))
+        days.append((d.strftime("📅 %a %d.%m"), d))
+    return tuple(days)
+
+@lru_cache(maxsize=2)
+def _kb_days_for(today: dt.date) -> InlineKeyboardMarkup:
+    buttons = [(label, f"day:{d.isoformat()}") for label, d in _day_choices(today)]
     return kb_list(buttons, back="back:restaurant")
 
+@lru_cache(maxsize=None)
 def kb_hours(next_cb_prefix: str, back: str) -> InlineKeyboardMarkup:
     rows=[]
     for h in range(0,24,6):
@@ -99,11 +128,13 @@ def kb_hours(next_cb_prefix: str, back: str) -> InlineKeyboardMarkup:
     rows.append([InlineKeyboardButton(text="⬅️ Назад", callback_data=back)])
     return InlineKeyboardMarkup(inline_keyboard=rows)
 
+@lru_cache(maxsize=None)
 def kb_minutes(next_cb_prefix: str, back: str) -> InlineKeyboardMarkup:
     mins = ["00","15","30","45"]
     row = [InlineKeyboardButton(text=m, callback_data=f"{next_cb_prefix}:{m}") for m in mins]
     return InlineKeyboardMarkup(inline_keyboard=[row, [InlineKeyboardButton(text="⬅️ Назад", callback_data=back)]])
 
+@lru_cache(maxsize=None)
 def kb_end_choice() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(
         inline_keyboard=[
@@ -113,16 +144,19 @@ def kb_end_choice() -> InlineKeyboardMarkup:
         ]
     )
 
+@lru_cache(maxsize=None)
 def kb_reasons() -> InlineKeyboardMarkup:
     rows=[[InlineKeyboardButton(text=label, callback_data=f"reason:{val}")] for label,val in REASONS]
     rows.append([InlineKeyboardButton(text="⬅️ Назад", callback_data="back:end_choice")])
     return InlineKeyboardMarkup(inline_keyboard=rows)
 
+@lru_cache(maxsize=None)
 def kb_amounts() -> InlineKeyboardMarkup:
     row1 = [InlineKeyboardButton(text=a, callback_data=f"amount:{a}") for a in AMOUNTS[:4]]
     row2 = [InlineKeyboardButton(text=a, callback_data=f"amount:{a}") for a in AMOUNTS[4:8]]
     return InlineKeyboardMarkup(inline_keyboard=[row1,row2,[InlineKeyboardButton(text="⬅️ Назад", callback_data="back:reason")]])
 
+@lru_cache(maxsize=None)
 def kb_confirm() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="✅ Да, сохранить", callback_data="confirm:yes")],
@@ -130,14 +164,57 @@ def kb_confirm() -> InlineKeyboardMarkup:
         [InlineKeyboardButton(text="⬅️ Назад", callback_data="back:amount")],
     ])
 
-def kb_open_incidents(open_list) -> InlineKeyboardMarkup:
+OPEN_PAGE_SIZE = 8
+_EPOCH = dt.datetime(1970, 1, 1, tzinfo=dt.timezone.utc)
+
+def _ts_to_us(ts: dt.datetime) -> int:
+    return (ts - _EPOCH) // dt.timedelta(microseconds=1)
+
+def _us_to_ts(us: int) -> dt.datetime:
+    return _EPOCH + dt.timedelta(microseconds=us)
+
+def kb_open_incidents(open_list, manager_id: int = 0, restaurant_id: int = 0,
+                      has_prev: bool = False, has_next: bool = False) -> InlineKeyboardMarkup:
+    """Страница открытых инцидентов. Курсор и фильтры едут в callback_data:
+    op:<f|n|p>:<start_time в мкс>:<id>:<manager_id>:<restaurant_id> (0 — без фильтра)."""
     rows=[]
     for rec in open_list:
         title = f"#{rec['id']} • {rec['restaurant']} • {rec['reason']} • {rec['amount_kzt']}₸"
         rows.append([InlineKeyboardButton(text=title, callback_data=f"pick:{rec['id']}")])
+    nav = []
+    if has_prev and open_list:
+        first = open_list[0]
+        nav.append(InlineKeyboardButton(
+            text="◀️", callback_data=f"op:p:{_ts_to_us(first['start_time'])}:{first['id']}:{manager_id}:{restaurant_id}"))
+    if has_next and open_list:
+        last = open_list[-1]
+        nav.append(InlineKeyboardButton(
+            text="▶️", callback_data=f"op:n:{_ts_to_us(last['start_time'])}:{last['id']}:{manager_id}:{restaurant_id}"))
+    if nav:
+        rows.append(nav)
+    filters = [
+        InlineKeyboardButton(text="👤 Управляющий" + (" ✓" if manager_id else ""), callback_data=f"opfm:{restaurant_id}"),
+        InlineKeyboardButton(text="🍗 Ресторан" + (" ✓" if restaurant_id else ""), callback_data=f"opfr:{manager_id}"),
+    ]
+    rows.append(filters)
+    if manager_id or restaurant_id:
+        rows.append([InlineKeyboardButton(text="✖️ Сбросить фильтры", callback_data="op:f:0:0:0:0")])
     rows.append([InlineKeyboardButton(text="⬅️ Назад", callback_data="back:main")])
     return InlineKeyboardMarkup(inline_keyboard=rows)
 
+async def open_incidents_page(manager_id: int = 0, restaurant_id: int = 0,
+                              cursor: Optional[tuple] = None, newer: bool = False):
+    """(строки, есть_новее, есть_старше) для страницы выбора открытого инцидента."""
+    rows = await db.list_open_incidents(
+        limit=OPEN_PAGE_SIZE + 1, cursor=cursor, newer=newer,
+        manager_id=manager_id or None, restaurant_id=restaurant_id or None,
+    )
+    extra = len(rows) > OPEN_PAGE_SIZE
+    if newer:
+        rows = rows[-OPEN_PAGE_SIZE:]
+        return rows, extra, True
+    return rows[:OPEN_PAGE_SIZE], cursor is not None, extra
+
 def kb_confirm_close(incident_id: int) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="✅ Да, закрыть", callback_data=f"close_yes:{incident_id}")],
@@ -145,6 +222,53 @@ def kb_confirm_close(incident_id: int) -> InlineKeyboardMarkup:
         [InlineKeyboardButton(text="⬅️ Назад", callback_data=f"back:close_time:{incident_id}")],
     ])
 
+@lru_cache(maxsize=None)
+def kb_report_periods(period: Optional[str] = None) -> InlineKeyboardMarkup:
+    rows = [[InlineKeyboardButton(text=label, callback_data=f"rep:{val}") for label, val in reports.PERIODS]]
+    if period:
+        rows.append([InlineKeyboardButton(text=label, callback_data=f"repf:{period}:{fmt}")
+                     for fmt, (label, _) in report_render.FORMATS.items()])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+_list_kb_cache: dict[tuple, tuple[int, InlineKeyboardMarkup]] = {}
+
+def _cached_list_kb(key: tuple, version: int, build) -> InlineKeyboardMarkup:
+    hit = _list_kb_cache.get(key)
+    if hit and hit[0] == version:
+        return hit[1]
+    markup = build()
+    if version == db.ref_cache_version():  # справочник не сменился, пока строили
+        _list_kb_cache[key] = (version, markup)
+    return markup
+
+async def kb_managers() -> Optional[InlineKeyboardMarkup]:
+    version = db.ref_cache_version()
+    managers = await db.get_managers()
+    if not managers:
+        return None
+    return _cached_list_kb(
+        ("managers",), version,
+        lambda: kb_list([(f"👤 {m['name']}", f"mgr:{m['id']}") for m in managers], back="back:main"),
+    )
+
+async def kb_restaurants(manager_id: int) -> Optional[InlineKeyboardMarkup]:
+    version = db.ref_cache_version()
+    rests = await db.get_restaurants_for_manager(manager_id)
+    if not rests:
+        return None
+    return _cached_list_kb(
+        ("restaurants", manager_id), version,
+        lambda: kb_list([(f"🍗 {r['name']}", f"rest:{r['id']}") for r in rests], back="back:manager"),
+    )
+
+# прогрев статичных клавиатур
+kb_end_choice(); kb_reasons(); kb_amounts(); kb_confirm(); kb_report_periods()
+kb_hours("sh", "back:restaurant"); kb_minutes("sm", "back:start_hour")
+kb_hours("eh", "back:main"); kb_minutes("em", "back:main")
+
+def fmt_kzt(amount: int) -> str:
+    return f"{int(amount):,} ₸".replace(",", " ")
+
 # ====== /start ======
 @router.message(F.text == "/start")
 async def on_start(message: Message, state: FSMContext):
@@ -157,14 +281,17 @@ async def on_start(message: Message, state: FSMContext):
 # ====== Инцидент: шаги ======
 @router.message(F.text == BTN_INCIDENT)
 async def inc_start(message: Message, state: FSMContext):
+    if WIZARD_STATELESS:
+        text, markup = await _w_screen(WizardData())
+        await message.answer(text, reply_markup=markup)
+        return
     # шаг 1: выбрать управляющего
-    managers = await db.get_managers()
-    if not managers:
+    markup = await kb_managers()
+    if markup is None:
         await message.answer("В БД нет управляющих.")
         return
-    items = [(f"👤 {m['name']}", f"mgr:{m['id']}") for m in managers]
     await state.set_state(IncidentFSM.manager)
-    await message.answer("Выберите управляющего:", reply_markup=kb_list(items, back="back:main"))
+    await message.answer("Выберите управляющего:", reply_markup=markup)
 
 @router.callback_query(IncidentFSM.manager, F.data.startswith("mgr:"))
 async def inc_pick_manager(cb: CallbackQuery, state: FSMContext):
@@ -172,22 +299,19 @@ async def inc_pick_manager(cb: CallbackQuery, state: FSMContext):
     await state.update_data(manager_id=mgr_id)
 
     # шаг 2: ресторан
-    rests = await db.get_restaurants_for_manager(mgr_id)
-    if not rests:
+    markup = await kb_restaurants(mgr_id)
+    if markup is None:
         await cb.message.edit_text("У этого управляющего нет привязанных ресторанов.", reply_markup=kb_back_next("back:main"))
         await cb.answer()
         return
-    items = [(f"🍗 {r['name']}", f"rest:{r['id']}") for r in rests]
     await state.set_state(IncidentFSM.restaurant)
-    await cb.message.edit_text("Выберите ресторан:", reply_markup=kb_list(items, back="back:manager"))
+    await cb.message.edit_text("Выберите ресторан:", reply_markup=markup)
     await cb.answer()
 
 @router.callback_query(F.data=="back:manager")
 async def back_to_manager(cb: CallbackQuery, state:FSMContext):
-    managers = await db.get_managers()
-    items = [(f"👤 {m['name']}", f"mgr:{m['id']}") for m in managers]
     await state.set_state(IncidentFSM.manager)
-    await cb.message.edit_text("Выберите управляющего:", reply_markup=kb_list(items, back="back:main"))
+    await cb.message.edit_text("Выберите управляющего:", reply_markup=await kb_managers())
     await cb.answer()
 
 @router.callback_query(IncidentFSM.restaurant, F.data.startswith("rest:"))
@@ -202,10 +326,8 @@ async def inc_pick_rest(cb: CallbackQuery, state:FSMContext):
 async def back_to_rest(cb:CallbackQuery, state:FSMContext):
     data = await state.get_data()
     mgr_id = data.get("manager_id")
-    rests = await db.get_restaurants_for_manager(mgr_id)
-    items = [(f"🍗 {r['name']}", f"rest:{r['id']}") for r in rests]
     await state.set_state(IncidentFSM.restaurant)
-    await cb.message.edit_text("Выберите ресторан:", reply_markup=kb_list(items, back="back:manager"))
+    await cb.message.edit_text("Выберите ресторан:", reply_markup=await kb_restaurants(mgr_id))
     await cb.answer()
 
 @router.callback_query(IncidentFSM.day, F.data.startswith("day:"))
@@ -277,6 +399,14 @@ async def comment_entered(msg:Message, state:FSMContext):
     text = msg.text.strip()
     if not text:
         text = "—"
+    if WIZARD_STATELESS:
+        d = await _w_from_state(state)
+        if d is not None:
+            await state.update_data(comment=text)
+            await state.set_state(IncidentFSM.amount)
+            text, markup = await _w_screen(d._replace(step=wizard_token.S_COMMENT))
+            await msg.answer(text, reply_markup=markup)
+            return
     await state.update_data(comment=text)
     await state.set_state(IncidentFSM.amount)
     await msg.answer("💸 Сумма, KZT:", reply_markup=kb_amounts())
@@ -296,6 +426,17 @@ async def pick_amount(cb:CallbackQuery, state:FSMContext):
 
 @router.message(IncidentFSM.amount, F.text.regexp(r"^\d+$"))
 async def amount_other(msg:Message, state:FSMContext):
+    # db.AMOUNT_MAX (BIGINT) влезает и в поле Q wizard_token
+    if int(msg.text) > db.AMOUNT_MAX:
+        await msg.answer("Слишком большая сумма. Введите сумму числом (тенге):")
+        return
+    if WIZARD_STATELESS:
+        data = await state.get_data()
+        d = wizard_token.unpack(data.get("wizard", ""))
+        if d is not None:
+            d = d._replace(step=wizard_token.S_AMOUNT, amount=int(msg.text))
+            await msg.answer(_w_confirm_text(d, data.get("comment", "—")), reply_markup=_w_kb_confirm(d))
+            return
     await state.update_data(amount=int(msg.text))
     await show_confirm(msg, state)
     await state.set_state(IncidentFSM.confirm)
@@ -304,8 +445,12 @@ async def show_confirm(target, state:FSMContext):
     data = await state.get_data()
     day = dt.date.fromisoformat(data["day"])
     start = tz.localize(dt.datetime.combine(day, dt.time(int(data["start_hour"]), int(data["start_minute"]))))
-    end_now = data.get("end_now", False)
+    text = _confirm_text(data["manager_id"], data["restaurant_id"], start, data.get("end_now", False),
+                         data["reason"], data["comment"], data["amount"])
+    await target.answer(text, reply_markup=kb_confirm())
 
+def _confirm_text(manager_id: int, restaurant_id: int, start: dt.datetime, end_now: bool,
+                  reason: str, comment: str, amount: int) -> str:
     end_str = "—"
     dur_str = "—"
     if end_now:
@@ -315,20 +460,19 @@ async def show_confirm(target, state:FSMContext):
         dur_str = f"{minutes} мин"
 
     # читаемые названия
-    reason_label = next((lbl for lbl,val in REASONS if val==data["reason"]), data["reason"])
+    reason_label = next((lbl for lbl,val in REASONS if val==reason), reason)
 
-    text = (
+    return (
         "<b>Подтверждение</b>\n"
-        f"ТУ: выбрано ID {data['manager_id']}\n"
-        f"Ресторан: ID {data['restaurant_id']}\n"
+        f"ТУ: выбрано ID {manager_id}\n"
+        f"Ресторан: ID {restaurant_id}\n"
         f"Время начала: {start.strftime('%d.%m %H:%M')}\n"
         f"Время конца: {end_str}\n"
         f"Длительность: {dur_str}\n"
         f"Причина: {reason_label}\n"
-        f"Комментарий: {data['comment']}\n"
-        f"Сумма: {data['amount']:,} ₸".replace(",", " ")
+        f"Комментарий: {comment}\n"
+        f"Сумма: {amount:,} ₸".replace(",", " ")
     )
-    await target.answer(text, reply_markup=kb_confirm())
 
 @router.callback_query(IncidentFSM.confirm, F.data.startswith("confirm:"))
 async def confirm_create(cb:CallbackQuery, state:FSMContext):
@@ -342,22 +486,28 @@ async def confirm_create(cb:CallbackQuery, state:FSMContext):
     data = await state.get_data()
     day = dt.date.fromisoformat(data["day"])
     start_ts = tz.localize(dt.datetime.combine(day, dt.time(int(data["start_hour"]), int(data["start_minute"]))))
+    await _create_incident(cb, state, int(data["manager_id"]), int(data["restaurant_id"]), start_ts,
+                           bool(data.get("end_now")), data["reason"], data["comment"], int(data["amount"]))
 
+async def _create_incident(cb: CallbackQuery, state: FSMContext, manager_id: int, restaurant_id: int,
+                           start_ts: dt.datetime, end_now: bool, reason: str, comment: str, amount: int):
     end_ts = None
     status = "open"
-    if data.get("end_now"):
+    if end_now:
         end_ts = dt.datetime.now(tz)
         status = "closed"
 
     incident_id = await db.insert_incident(
-        manager_id=int(data["manager_id"]),
-        restaurant_id=int(data["restaurant_id"]),
+        manager_id=manager_id,
+        restaurant_id=restaurant_id,
         start_ts=start_ts,
         end_ts=end_ts,
-        reason=data["reason"],
-        comment=data["comment"],
-        amount_kzt=int(data["amount"]),
+        reason=reason,
+        comment=comment,
+        amount_kzt=amount,
         status=status,
+        # одно сообщение подтверждения — один инцидент, даже при повторном нажатии
+        idempotency_key=f"create:{cb.message.chat.id}:{cb.message.message_id}",
     )
     await state.clear()
     if status == "open":
@@ -366,15 +516,221 @@ async def confirm_create(cb:CallbackQuery, state:FSMContext):
         await cb.message.edit_text(f"Инцидент #{incident_id} сохранён и ЗАКРЫТ.", reply_markup=None)
     await cb.answer()
 
+# ====== Инцидент без FSM-хранилища (WIZARD_STATELESS=1) ======
+# Каждая кнопка несёт подписанный снимок уже выбранных полей (WizardData.step —
+# что выбрано последним), «Назад» — снимок на шаг раньше. Данные визарда в хранилище
+# пишут и читают только комментарий (текстом), сумма «Другая» и сохранение. Состояние
+# aiogram всё равно читает на каждом апдейте (FSMContextMiddleware -> get_state):
+# с FSM_STORAGE=postgres это один SELECT на нажатие, с FSM_CACHE_TTL — из кэша.
+
+def _wcb(d: WizardData, **changes) -> str:
+    return "w:" + wizard_token.pack(d._replace(**changes))
+
+def _w_reason(d: WizardData) -> str:
+    return REASONS[d.reason][1] if d.reason < len(REASONS) else REASONS[0][1]
+
+def _w_start(d: WizardData) -> dt.datetime:
+    return tz.localize(dt.datetime.combine(d.day, dt.time(d.start_hour, d.start_minute)))
+
+async def _w_screen(d: WizardData) -> tuple[str, Optional[InlineKeyboardMarkup]]:
+    """Текст и клавиатура экрана, который идёт после шага d.step."""
+    S = wizard_token
+    if d.step == S.S_START:
+        version = db.ref_cache_version()
+        managers = await db.get_managers()
+        if not managers:
+            return "В БД нет управляющих.", None
+        return "Выберите управляющего:", _cached_list_kb(
+            ("managers_w",), version,
+            lambda: kb_list([(f"👤 {m['name']}", _wcb(WizardData(), step=S.S_MANAGER, manager_id=m["id"]))
+                             for m in managers], back="back:main"),
+        )
+    if d.step == S.S_MANAGER:
+        version = db.ref_cache_version()
+        rests = await db.get_restaurants_for_manager(d.manager_id)
+        # клавиатура общая для всех чатов — строится от чистого снимка
+        base = WizardData(step=S.S_MANAGER, manager_id=d.manager_id)
+        back = _wcb(WizardData())
+        if not rests:
+            return "У этого управляющего нет привязанных ресторанов.", kb_list([], back=back)
+        return "Выберите ресторан:", _cached_list_kb(
+            ("restaurants_w", d.manager_id), version,
+            lambda: kb_list([(f"🍗 {r['name']}", _wcb(base, step=S.S_RESTAURANT, restaurant_id=r["id"]))
+                             for r in rests], back=back),
+        )
+    if d.step == S.S_RESTAURANT:
+        days = _day_choices(dt.datetime.now(tz).date())
+        return "День инцидента:", kb_list(
+            [(label, _wcb(d, step=S.S_DAY, day=day)) for label, day in days],
+            back=_wcb(d, step=S.S_MANAGER))
+    if d.step == S.S_DAY:
+        rows = [[InlineKeyboardButton(text=f"{j:02d}", callback_data=_wcb(d, step=S.S_HOUR, start_hour=j))
+                 for j in range(h, h + 6)] for h in range(0, 24, 6)]
+        rows.append([InlineKeyboardButton(text="⬅️ Назад", callback_data=_wcb(d, step=S.S_RESTAURANT))])
+        return "Час начала (0–23):", InlineKeyboardMarkup(inline_keyboard=rows)
+    if d.step == S.S_HOUR:
+        row = [InlineKeyboardButton(text=f"{m:02d}", callback_data=_wcb(d, step=S.S_MINUTE, start_minute=m))
+               for m in (0, 15, 30, 45)]
+        back = [InlineKeyboardButton(text="⬅️ Назад", callback_data=_wcb(d, step=S.S_DAY))]
+        return "Минуты начала:", InlineKeyboardMarkup(inline_keyboard=[row, back])
+    if d.step == S.S_MINUTE:
+        return "Завершение:", kb_list([
+            ("⚡ Закрыть сейчас", _wcb(d, step=S.S_END, end_now=True)),
+            ("⏳ Закрыть позже", _wcb(d, step=S.S_END, end_now=False)),
+        ], back=_wcb(d, step=S.S_HOUR))
+    if d.step == S.S_END:
+        return "Причина потерь:", kb_list(
+            [(label, _wcb(d, step=S.S_REASON, reason=i)) for i, (label, _) in enumerate(REASONS)],
+            back=_wcb(d, step=S.S_MINUTE))
+    if d.step == S.S_REASON:
+        return "💬 Комментарий (введите текст) или «—».", kb_list([], back=_wcb(d, step=S.S_END))
+    if d.step == S.S_COMMENT:
+        # «Другая» — обычный amount:, сумму ждёт amount_other в состоянии IncidentFSM.amount
+        buttons = [InlineKeyboardButton(
+            text=a, callback_data=f"amount:{a}" if a == "Другая" else _wcb(d, step=S.S_AMOUNT, amount=int(a)))
+            for a in AMOUNTS]
+        back = [InlineKeyboardButton(text="⬅️ Назад", callback_data=_wcb(d, step=S.S_END))]
+        return "💸 Сумма, KZT:", InlineKeyboardMarkup(inline_keyboard=[buttons[:4], buttons[4:8], back])
+    raise ValueError(f"no screen after step {d.step}")
+
+def _w_confirm_text(d: WizardData, comment: str) -> str:
+    return _confirm_text(d.manager_id, d.restaurant_id, _w_start(d), d.end_now,
+                         _w_reason(d), comment, d.amount)
+
+def _w_kb_confirm(d: WizardData) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="✅ Да, сохранить", callback_data=_wcb(d, step=wizard_token.S_CONFIRM))],
+        [InlineKeyboardButton(text="❌ Отменить", callback_data="wcancel")],
+        [InlineKeyboardButton(text="⬅️ Назад", callback_data=_wcb(d, step=wizard_token.S_COMMENT))],
+    ])
+
+async def _w_from_state(state: FSMContext) -> Optional[WizardData]:
+    return wizard_token.unpack((await state.get_data()).get("wizard", ""))
+
+@router.callback_query(F.data.startswith("w:"))
+async def wizard_step(cb: CallbackQuery, state: FSMContext):
+    d = wizard_token.unpack(cb.data[2:])
+    if d is None:
+        await cb.answer("Кнопка устарела, начните заново.", show_alert=True)
+        return
+    if d.step == wizard_token.S_REASON:
+        # единственная запись за весь путь до комментария
+        await state.set_state(IncidentFSM.comment)
+        await state.set_data({"wizard": wizard_token.pack(d)})
+    elif d.step in (wizard_token.S_AMOUNT, wizard_token.S_CONFIRM):
+        comment = (await state.get_data()).get("comment")
+        if comment is None:
+            await cb.answer("Комментарий потерялся, начните заново.", show_alert=True)
+            return
+        if d.step == wizard_token.S_CONFIRM:
+            await _create_incident(cb, state, d.manager_id, d.restaurant_id, _w_start(d), d.end_now,
+                                   _w_reason(d), comment, d.amount)
+            return
+        await cb.message.edit_text(_w_confirm_text(d, comment), reply_markup=_w_kb_confirm(d))
+        await cb.answer()
+        return
+    text, markup = await _w_screen(d)
+    await cb.message.edit_text(text, reply_markup=markup)
+    await cb.answer()
+
+@router.callback_query(F.data == "wcancel")
+async def wizard_cancel(cb: CallbackQuery, state: FSMContext):
+    await state.clear()
+    await cb.message.edit_text("Отменено.", reply_markup=None)
+    await cb.answer()
+
+# ====== Поиск в inline-режиме: @бот <название> ======
+# Выбранный результат отправляется в чат сообщением с меткой #m<id> / #r<mgr>_<rest>;
+# по ней визард инцидента открывается сразу с выбранным управляющим/рестораном.
+INLINE_RESULTS = 20
+# метка в конце текста; текст начинается с заголовка, поэтому search, а не match
+INLINE_TAG = F.text.regexp(r"#(m|r)(\d+)(?:_(\d+))?$", mode="search")
+
+def _inline_message_text(entry: search_index.Entry) -> tuple[str, str, str]:
+    """(title, description, message_text) результата inline-поиска."""
+    kind, mgr_id, rest_id = entry.key
+    if kind == "m":
+        title, description, tag = f"👤 {entry.name}", "Управляющий", f"#m{mgr_id}"
+    else:
+        title, description, tag = f"🍗 {entry.name}", f"ТУ: {entry.subtitle}", f"#r{mgr_id}_{rest_id}"
+    return title, description, f"🆕 {title}\n{tag}"
+
+@router.inline_query()
+async def inline_search(query: InlineQuery):
+    results = []
+    for e in await search_index.lookup(query.query, INLINE_RESULTS):
+        kind, mgr_id, rest_id = e.key
+        title, description, text = _inline_message_text(e)
+        results.append(InlineQueryResultArticle(
+            id=f"{kind}{mgr_id}_{rest_id}", title=title, description=description,
+            input_message_content=InputTextMessageContent(message_text=text),
+        ))
+    await query.answer(results, cache_time=30, is_personal=False)
+
+@router.message(F.via_bot, INLINE_TAG.as_("tag"))
+async def inline_picked(msg: Message, state: FSMContext, tag):
+    if msg.via_bot.id != msg.bot.id:
+        return  # результат чужого inline-бота с похожей меткой
+    kind, mgr_id, rest_id = tag.group(1), int(tag.group(2)), int(tag.group(3) or 0)
+    if WIZARD_STATELESS:
+        if kind == "m":
+            d = WizardData(step=wizard_token.S_MANAGER, manager_id=mgr_id)
+        else:
+            d = WizardData(step=wizard_token.S_RESTAURANT, manager_id=mgr_id, restaurant_id=rest_id)
+        text, markup = await _w_screen(d)
+        await msg.answer(text, reply_markup=markup)
+        return
+    await state.set_data({"manager_id": mgr_id})
+    if kind == "m":
+        markup = await kb_restaurants(mgr_id)
+        if markup is None:
+            await msg.answer("У этого управляющего нет привязанных ресторанов.", reply_markup=main_kb)
+            return
+        await state.set_state(IncidentFSM.restaurant)
+        await msg.answer("Выберите ресторан:", reply_markup=markup)
+        return
+    await state.update_data(restaurant_id=rest_id)
+    await state.set_state(IncidentFSM.day)
+    await msg.answer("День инцидента:", reply_markup=kb_days())
+
 # ====== Закрыть позже ======
 @router.message(F.text == BTN_CLOSE)
 async def on_close_entry(msg:Message, state:FSMContext):
-    opens = await db.list_open_incidents()
+    opens, has_prev, has_next = await open_incidents_page()
     if not opens:
         await msg.answer("Открытых инцидентов нет.", reply_markup=main_kb)
         return
     await state.set_state(CloseLaterFSM.pick_incident)
-    await msg.answer("Выберите открытый инцидент:", reply_markup=kb_open_incidents(opens))
+    await msg.answer("Выберите открытый инцидент:",
+                     reply_markup=kb_open_incidents(opens, has_prev=has_prev, has_next=has_next))
+
+@router.callback_query(CloseLaterFSM.pick_incident, F.data.startswith("op:"))
+async def open_page(cb:CallbackQuery, state:FSMContext):
+    _, direction, us, inc_id, mgr_id, rest_id = cb.data.split(":")
+    mgr_id, rest_id = int(mgr_id), int(rest_id)
+    cursor = None if direction == "f" else (_us_to_ts(int(us)), int(inc_id))
+    opens, has_prev, has_next = await open_incidents_page(mgr_id, rest_id, cursor, newer=direction == "p")
+    text = "Выберите открытый инцидент:" if opens else "Открытых инцидентов по этому фильтру нет."
+    await cb.message.edit_text(text, reply_markup=kb_open_incidents(opens, mgr_id, rest_id, has_prev, has_next))
+    await cb.answer()
+
+@router.callback_query(CloseLaterFSM.pick_incident, F.data.startswith("opfm:"))
+async def open_filter_manager(cb:CallbackQuery, state:FSMContext):
+    rest_id = int(cb.data.split(":")[1])
+    managers = await db.get_managers()
+    items = [("Все управляющие", f"op:f:0:0:0:{rest_id}")]
+    items += [(f"👤 {m['name']}", f"op:f:0:0:{m['id']}:{rest_id}") for m in managers]
+    await cb.message.edit_text("Фильтр по управляющему:", reply_markup=kb_list(items, back=f"op:f:0:0:0:{rest_id}"))
+    await cb.answer()
+
+@router.callback_query(CloseLaterFSM.pick_incident, F.data.startswith("opfr:"))
+async def open_filter_restaurant(cb:CallbackQuery, state:FSMContext):
+    mgr_id = int(cb.data.split(":")[1])
+    rests = await db.get_restaurants_for_manager(mgr_id) if mgr_id else await db.get_restaurants()
+    items = [("Все рестораны", f"op:f:0:0:{mgr_id}:0")]
+    items += [(f"🍗 {r['name']}", f"op:f:0:0:{mgr_id}:{r['id']}") for r in rests]
+    await cb.message.edit_text("Фильтр по ресторану:", reply_markup=kb_list(items, back=f"op:f:0:0:{mgr_id}:0"))
+    await cb.answer()
 
 @router.callback_query(CloseLaterFSM.pick_incident, F.data.startswith("pick:"))
 async def pick_open(cb:CallbackQuery, state:FSMContext):
@@ -418,16 +774,126 @@ async def do_close(cb:CallbackQuery, state:FSMContext):
     data = await state.get_data()
     day = dt.date.fromisoformat(data["day"])
     end_ts = tz.localize(dt.datetime.combine(day, dt.time(int(data["end_hour"]), int(data["end_minute"]))))
-    await db.close_incident(inc_id, end_ts)
+    await db.close_incident(inc_id, end_ts,
+                            idempotency_key=f"close:{cb.message.chat.id}:{cb.message.message_id}:{inc_id}")
     await state.clear()
     await cb.message.edit_text(f"Инцидент #{inc_id} закрыт.", reply_markup=None)
     await cb.answer()
 
-# ====== Отчёт (заглушка-меню) ======
+# ====== Отчёт ======
 @router.message(F.text == BTN_REPORT)
 async def on_report(msg:Message, state:FSMContext):
     await state.clear()
-    await msg.answer("Выбор периода отчёта появится в следующем шаге (PDF/Excel).", reply_markup=main_kb)
+    await msg.answer("Период отчёта:", reply_markup=kb_report_periods())
+
+@router.callback_query(F.data.startswith("rep:"))
+async def report_period(cb:CallbackQuery, state:FSMContext):
+    period = cb.data.split(":")[1]
+    d1, d2 = reports.period_bounds(period)
+    total = await reports.totals(d1, d2)
+    by_reason = await reports.breakdown("reason", d1, d2)
+    by_rest = await reports.breakdown("restaurant", d1, d2, limit=10)
+    by_mgr = await reports.breakdown("manager", d1, d2, limit=10)
+
+    reason_labels = dict((val, lbl) for lbl, val in REASONS)
+    lines = [
+        f"<b>Отчёт {d1.strftime('%d.%m.%Y')} – {d2.strftime('%d.%m.%Y')}</b>",
+        f"Инцидентов: {total['incidents']} (закрыто {total['closed']})",
+        f"Потери: {fmt_kzt(total['amount_kzt'])}",
+        f"Простой: {int(total['duration_sec']) // 3600} ч {int(total['duration_sec']) % 3600 // 60} мин",
+    ]
+    for title, rows, labels in (("По причинам", by_reason, reason_labels),
+                                ("Рестораны", by_rest, {}),
+                                ("Управляющие", by_mgr, {})):
+        if not rows:
+            continue
+        lines.append(f"\n<b>{title}</b>")
+        for r in rows:
+            lines.append(f"{labels.get(r['label'], r['label'])}: {fmt_kzt(r['amount_kzt'])} ({r['incidents']})")
+    await cb.message.edit_text("\n".join(lines), reply_markup=kb_report_periods(period))
+    await cb.answer()
+
+@router.callback_query(F.data.startswith("repf:"))
+async def report_file(cb:CallbackQuery, state:FSMContext):
+    _, period, fmt = cb.data.split(":")
+    key = await report_render.cache_key(period, fmt)
+    file_id = await report_render.get_cached_file_id(key)
+    if file_id:
+        await cb.message.answer_document(file_id)
+        await cb.answer()
+        return
+
+    await cb.answer("Готовлю файл…")
+    path, filename = await report_render.render(period, fmt)
+    try:
+        sent = await cb.message.answer_document(FSInputFile(path, filename=filename))
+    finally:
+        os.unlink(path)
+    await report_render.store_file_id(key, sent.document.file_id)
+
+# ====== Импорт инцидентов из файла ======
+IMPORT_ERRORS_INLINE = 20
+
+def import_reason_map() -> dict[str, str]:
+    out = {}
+    for label, val in REASONS:
+        out[val] = val
+        out[label.lower()] = val
+        out[label.split(" ", 1)[1].lower()] = val  # без эмодзи
+    return out
+
+@router.message(F.text == "/import")
+async def on_import_help(msg:Message, state:FSMContext):
+    await state.clear()
+    await msg.answer(
+        "Отправьте файл .csv или .xlsx. Первая строка — заголовок с колонками:\n"
+        f"<code>{', '.join(incident_import.COLUMNS)}</code>\n"
+        "manager/restaurant — имя или ID, start/end — «ДД.ММ.ГГГГ ЧЧ:ММ» (end пустой — инцидент открыт), "
+        f"reason — {', '.join(val for _, val in REASONS)}, amount — сумма в тенге.",
+        reply_markup=main_kb,
+    )
+
+@router.message(F.document)
+async def on_import_file(msg:Message, state:FSMContext):
+    doc = msg.document
+    name = doc.file_name or ""
+    if not name.lower().endswith((".csv", ".xlsx")):
+        await msg.answer("Для импорта нужен файл .csv или .xlsx (см. /import).", reply_markup=main_kb)
+        return
+    await state.clear()
+    raw = await msg.bot.download(doc)
+    try:
+        loaded, errors = await incident_import.import_file(raw.read(), name, import_reason_map())
+    except incident_import.IncidentImportError as e:
+        await msg.answer(f"Импорт не выполнен: {e}", reply_markup=main_kb)
+        return
+
+    if not errors:
+        text = f"Импортировано инцидентов: {loaded}." if loaded else "Новых инцидентов нет: все строки уже загружены."
+        await msg.answer(text, reply_markup=main_kb)
+        return
+    lines = [f"Импорт не выполнен, ошибок: {len(errors)}. Исправьте файл и отправьте снова."]
+    lines += [f"Строка {n}: {err}" for n, err in errors[:IMPORT_ERRORS_INLINE]]
+    await msg.answer("\n".join(lines), reply_markup=main_kb)
+    if len(errors) > IMPORT_ERRORS_INLINE:
+        report = "line,error\n" + "".join(f'{n},"{err.replace(chr(34), chr(39))}"\n' for n, err in errors)
+        await msg.answer_document(BufferedInputFile(report.encode("utf-8-sig"), filename="import_errors.csv"))
+
+# ====== БД недоступна ======
+# db.DBUnavailable: соединение не выдано за DB_ACQUIRE_TIMEOUT или цепь разомкнута.
+# Отвечаем сразу — пользователь повторит, а не ждёт ответа от лежащей БД.
+BUSY_TEXT = "Сервис занят, попробуйте ещё раз"
+
+@router.errors(ExceptionTypeFilter(db.DBUnavailable))
+async def on_db_unavailable(event: ErrorEvent):
+    logger.warning("DB unavailable: %s", event.exception)
+    upd = event.update
+    if upd.callback_query:
+        await upd.callback_query.answer(BUSY_TEXT, show_alert=True)
+    elif upd.message:
+        await upd.message.answer(BUSY_TEXT)
+    elif upd.inline_query:
+        await upd.inline_query.answer([], cache_time=0, is_personal=True)
 
 # ====== fallback ======
 @router.message()
@@ -1,53 +1,491 @@
 # db.py
 import os
+import json
+import time
+import asyncio
+import logging
 import asyncpg
-from typing import Optional, List, Tuple, Any
-from contextlib import asynccontextmanager
+from collections import deque
+from typing import Optional, List, Tuple, Any, Dict, Callable
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
 
+import metrics
+import migrate
+import partitions
+from admission import CircuitBreaker, DBUnavailable
+from write_behind import GroupCommitter
+
+logger = logging.getLogger(__name__)
+
+# Два пула: запись (_POOL, всегда primary) и чтение (_READ_POOL). Тяжёлые чтения
+# (отчёты, выгрузки, списки) не занимают соединения, нужные записям инцидентов.
+# DATABASE_REPLICA_URL — читать с реплики; чат, который только что писал, ещё
+# READ_YOUR_WRITES_SEC секунд читает с primary, чтобы увидеть свою запись.
 _POOL: Optional[asyncpg.Pool] = None
+_READ_POOL: Optional[asyncpg.Pool] = None
+
+MIGRATE_ON_STARTUP = os.getenv("MIGRATE_ON_STARTUP", "1") == "1"
+
+REPLICA_DSN = os.getenv("DATABASE_REPLICA_URL") or None
+READ_YOUR_WRITES_SEC = float(os.getenv("READ_YOUR_WRITES_SEC", "5"))
+DB_CONNECT_TIMEOUT = float(os.getenv("DB_CONNECT_TIMEOUT", "10"))
+DB_COMMAND_TIMEOUT = float(os.getenv("DB_COMMAND_TIMEOUT", "0")) or None
+# за pgbouncer в режиме transaction — 0 (prepared statements там не живут)
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "100"))
+DB_MAX_INACTIVE_LIFETIME = float(os.getenv("DB_MAX_INACTIVE_LIFETIME", "300"))
+
+# Допуск к БД: соединение ждём не дольше DB_ACQUIRE_TIMEOUT (иначе DBUnavailable —
+# пользователь получает «занято», а не висит), запрос — не дольше DB_STATEMENT_TIMEOUT_MS
+# (statement_timeout на сервере; обслуживание снимает его через unbounded()).
+# Запросы горячего пути (список, карточка, дедуп апдейтов) ограничены ещё и на клиенте —
+# DB_QUERY_TIMEOUT секунд (asyncpg отменяет запрос и бросает TimeoutError).
+# DB_BREAKER_THRESHOLD ошибок БД подряд размыкают цепь пула на DB_BREAKER_COOLDOWN секунд.
+DB_ACQUIRE_TIMEOUT = float(os.getenv("DB_ACQUIRE_TIMEOUT", "2"))
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "15000"))
+DB_QUERY_TIMEOUT = float(os.getenv("DB_QUERY_TIMEOUT", "3")) or None
+DB_BREAKER_THRESHOLD = int(os.getenv("DB_BREAKER_THRESHOLD", "5"))
+DB_BREAKER_COOLDOWN = float(os.getenv("DB_BREAKER_COOLDOWN", "10"))
+
+# ошибки, говорящие о состоянии БД, а не о данных запроса
+_DB_FAILURES = (
+    OSError,
+    asyncio.TimeoutError,
+    asyncpg.PostgresConnectionError,
+    asyncpg.QueryCanceledError,
+    asyncpg.TooManyConnectionsError,
+    asyncpg.CannotConnectNowError,
+)
+# то же для ошибок внутри `async with`: там OSError может быть и не от БД
+# (файл, сеть к Telegram), поэтому голый OSError считаем, только если соединение умерло
+_QUERY_FAILURES = (
+    asyncio.TimeoutError,
+    asyncpg.PostgresConnectionError,
+    asyncpg.InterfaceError,
+    asyncpg.QueryCanceledError,
+    asyncpg.TooManyConnectionsError,
+    asyncpg.CannotConnectNowError,
+)
+
+_breakers = {
+    name: CircuitBreaker(name, DB_BREAKER_THRESHOLD, DB_BREAKER_COOLDOWN)
+    for name in ("write", "read")
+}
+_acquire_waits: Dict[str, deque] = {name: deque(maxlen=1000) for name in _breakers}
+_acquire_waiting: Dict[str, int] = {name: 0 for name in _breakers}
+_acquire_timeouts: Dict[str, int] = {name: 0 for name in _breakers}
+
+# WRITE_BATCH=1 — insert_incident/close_incident идут через групповой коммит
+WRITE_BATCH = os.getenv("WRITE_BATCH", "1") == "1"
+WRITE_BATCH_DELAY_MS = float(os.getenv("WRITE_BATCH_DELAY_MS", "5"))
+WRITE_BATCH_MAX = int(os.getenv("WRITE_BATCH_MAX", "100"))
+
+_insert_batcher: Optional[GroupCommitter] = None
+_close_batcher: Optional[GroupCommitter] = None
+
+# чат текущего апдейта (ставит server.process_update) и до какого момента он читает с primary
+_current_chat: ContextVar[Optional[int]] = ContextVar("db_current_chat", default=None)
+_recent_writers: Dict[int, float] = {}
+
+def _create_pool(dsn: str, prefix: str, min_size: int, max_size: int):
+    server_settings = {}
+    if DB_STATEMENT_TIMEOUT_MS > 0:
+        server_settings["statement_timeout"] = str(DB_STATEMENT_TIMEOUT_MS)
+    return asyncpg.create_pool(
+        dsn,
+        min_size=int(os.getenv(f"{prefix}_MIN", str(min_size))),
+        max_size=int(os.getenv(f"{prefix}_MAX", str(max_size))),
+        timeout=DB_CONNECT_TIMEOUT,
+        command_timeout=DB_COMMAND_TIMEOUT,
+        statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+        max_inactive_connection_lifetime=DB_MAX_INACTIVE_LIFETIME,
+        server_settings=server_settings,
+    )
 
 async def init_pool():
-    global _POOL
+    global _POOL, _READ_POOL
     dsn = os.getenv("DATABASE_URL")
     if not dsn:
         raise RuntimeError("DATABASE_URL is not set")
-    _POOL = await asyncpg.create_pool(dsn, min_size=1, max_size=5)
+    _POOL, _READ_POOL = await asyncio.gather(
+        _create_pool(dsn, "DB_WRITE_POOL", 1, 5),
+        _create_pool(REPLICA_DSN or dsn, "DB_READ_POOL", 1, 5),
+    )
+    if MIGRATE_ON_STARTUP:
+        # DDL под advisory lock; при MIGRATE_ON_STARTUP=0 секции создаёт деплой
+        # (python partitions.py ensure) и ежедневно планировщик
+        async with conn(timeout=DB_CONNECT_TIMEOUT) as c:
+            await unbounded(c)
+            await migrate.apply(c)
+            await partitions.ensure(c, REPORT_TZ)
+    await _start_ref_listener(dsn)
+    _start_batchers()
 
 async def close_pool():
-    global _POOL
-    if _POOL:
-        await _POOL.close()
-        _POOL = None
+    global _POOL, _READ_POOL
+    await _stop_batchers()
+    await _stop_ref_listener()
+    for pool in (_READ_POOL, _POOL):
+        if pool:
+            await pool.close()
+    _POOL = _READ_POOL = None
+
+async def warmup():
+    """Прогрев после старта: кэш справочников и план/statement cache горячих чтений."""
+    await asyncio.gather(
+        _load_ref_data(),
+        list_open_incidents(limit=9),
+        return_exceptions=False,
+    )
 
 @asynccontextmanager
-async def conn():
-    if not _POOL:
+async def _acquire(pool: Optional[asyncpg.Pool], name: str, timeout: Optional[float] = None):
+    if not pool:
         raise RuntimeError("DB pool is not initialized")
-    async with _POOL.acquire() as c:
+    breaker = _breakers[name]
+    breaker.before()
+    started = time.perf_counter()
+    _acquire_waiting[name] += 1
+    try:
+        c = await pool.acquire(timeout=timeout or DB_ACQUIRE_TIMEOUT)
+    except asyncio.TimeoutError:
+        # пул занят, но БД может быть жива — цепь не размыкаем
+        breaker.abandon()
+        _acquire_timeouts[name] += 1
+        metrics.DB_ACQUIRE_TIMEOUTS.labels(name).inc()
+        raise DBUnavailable(f"{name}: no connection in {timeout or DB_ACQUIRE_TIMEOUT:g}s") from None
+    except _DB_FAILURES as e:
+        breaker.failure()
+        raise DBUnavailable(f"{name}: {e!r}") from e
+    except BaseException:
+        breaker.abandon()
+        raise
+    finally:
+        _acquire_waiting[name] -= 1
+    wait = time.perf_counter() - started
+    _acquire_waits[name].append(wait)
+    metrics.DB_ACQUIRE_WAIT.labels(name).observe(wait)
+    try:
         yield c
+    except BaseException as e:
+        if isinstance(e, _QUERY_FAILURES) or (isinstance(e, OSError) and c.is_closed()):
+            breaker.failure()
+        elif isinstance(e, asyncpg.PostgresError):
+            # ошибка данных (уникальность, check): БД ответила — она жива
+            breaker.success()
+        else:
+            breaker.abandon()
+        raise
+    else:
+        breaker.success()
+    finally:
+        await pool.release(c)
+
+def conn(timeout: Optional[float] = None):
+    """Соединение пула записи (primary); timeout — ожидание соединения вместо DB_ACQUIRE_TIMEOUT."""
+    return _acquire(_POOL, "write", timeout)
+
+def read_conn(fresh: bool = False, timeout: Optional[float] = None):
+    """Соединение для чтения: реплика или отдельный пул на primary.
+
+    fresh=True — нужны данные сразу после чужого коммита (перечитка по NOTIFY):
+    при наличии реплики такое чтение идёт на primary, как и чтения чата,
+    который недавно писал.
+    """
+    if REPLICA_DSN and (fresh or _reads_own_writes()):
+        return _acquire(_POOL, "write", timeout)
+    return _acquire(_READ_POOL, "read", timeout)
+
+async def unbounded(c: asyncpg.Connection):
+    """Снимает statement_timeout до возврата соединения в пул (миграции, пересчёты, архив)."""
+    if DB_STATEMENT_TIMEOUT_MS > 0:
+        await c.execute("SET statement_timeout = 0;")
+
+def circuit_open(pool: str = "write") -> bool:
+    """Цепь пула разомкнута (cooldown не истёк) — апдейты можно отбивать, не доходя до хендлеров."""
+    return _breakers[pool].is_open
+
+def _percentile_ms(waits: List[float], q: float) -> float:
+    return round(waits[min(len(waits) - 1, int(q * len(waits)))] * 1000, 1) if waits else 0.0
+
+def health() -> Dict[str, Any]:
+    """Насыщенность пулов, ожидание соединения (по последним 1000 выдачам) и состояние цепи."""
+    out: Dict[str, Any] = {}
+    for name, pool in (("write", _POOL), ("read", _READ_POOL)):
+        if pool is None:
+            continue
+        size, idle, max_size = pool.get_size(), pool.get_idle_size(), pool.get_max_size()
+        waits = sorted(_acquire_waits[name])
+        breaker = _breakers[name]
+        out[name] = {
+            "size": size,
+            "idle": idle,
+            "max_size": max_size,
+            "waiting": _acquire_waiting[name],
+            "saturation": round((size - idle + _acquire_waiting[name]) / max_size, 3),
+            "acquire_wait_ms": {q: _percentile_ms(waits, p) for q, p in (("p50", 0.5), ("p99", 0.99), ("max", 1.0))},
+            "acquire_timeouts": _acquire_timeouts[name],
+            "circuit": breaker.status,
+            "circuit_trips": breaker.trips,
+        }
+    return out
+
+@contextmanager
+def chat_scope(chat_id: Optional[int]):
+    """Привязывает чтения/записи текущей задачи к чату (для read-your-writes)."""
+    token = _current_chat.set(chat_id)
+    try:
+        yield
+    finally:
+        _current_chat.reset(token)
+
+def _mark_write():
+    chat_id = _current_chat.get()
+    if chat_id is None or not REPLICA_DSN:
+        return
+    now = time.monotonic()
+    if len(_recent_writers) > 10000:
+        for k in [k for k, until in _recent_writers.items() if until <= now]:
+            del _recent_writers[k]
+    _recent_writers[chat_id] = now + READ_YOUR_WRITES_SEC
+
+def _reads_own_writes() -> bool:
+    chat_id = _current_chat.get()
+    return chat_id is not None and _recent_writers.get(chat_id, 0.0) > time.monotonic()
+
+@metrics.on_scrape
+def _pool_gauges():
+    for name, pool in (("write", _POOL), ("read", _READ_POOL)):
+        if pool:
+            metrics.DB_POOL_SIZE.labels(name).set(pool.get_size())
+            metrics.DB_POOL_IDLE.labels(name).set(pool.get_idle_size())
+            metrics.DB_CIRCUIT_OPEN.labels(name).set(int(_breakers[name].is_open))
+
+# ---- справочники: кэш managers / restaurants ----
+# Список управляющих и привязка управляющий→рестораны держатся в памяти.
+# Сбрасываются по NOTIFY из триггеров на managers, restaurants, manager_restaurants
+# (канал REF_CHANNEL, см. migrations/0002_ref_data_notify.sql);
+# REF_CACHE_TTL — страховка, если уведомление потерялось (обрыв LISTEN-соединения).
+
+REF_CACHE_TTL = float(os.getenv("REF_CACHE_TTL", "300"))
+REF_CHANNEL = "ref_data_changed"
+
+_ref_managers: Optional[List[asyncpg.Record]] = None
+_ref_rests: Dict[int, List[asyncpg.Record]] = {}
+_ref_loaded_at: float = 0.0
+_ref_version: int = 0        # счётчик сбросов — ловит NOTIFY во время загрузки
+_ref_generation: int = 0     # меняется при любом изменении содержимого кэша
+_ref_lock = asyncio.Lock()
+_ref_listener: Optional[asyncpg.Connection] = None
+_listener_dsn: Optional[str] = None
+_reconnect_task: Optional[asyncio.Task] = None
+
+# События по инцидентам: insert_incident/close_incident шлют NOTIFY в той же
+# транзакции, поэтому их видят все инстансы и только после коммита.
+INCIDENT_CHANNEL = "incident_changed"
+_incident_listeners: List[Callable[[Dict[str, Any]], None]] = []
+
+CACHE_STATS: Dict[str, int] = {"hits": 0, "misses": 0, "invalidations": 0}
+
+def invalidate_ref_cache() -> None:
+    global _ref_managers, _ref_rests, _ref_loaded_at, _ref_version, _ref_generation
+    _ref_managers = None
+    _ref_rests = {}
+    _ref_loaded_at = 0.0
+    _ref_version += 1
+    _ref_generation += 1
+    CACHE_STATS["invalidations"] += 1
+
+def ref_cache_version() -> int:
+    """Растёт при каждом сбросе и перезагрузке кэша — ключ для производных данных."""
+    return _ref_generation
+
+def _on_ref_notify(connection, pid, channel, payload):
+    logger.info("ref cache invalidated by NOTIFY (%s)", payload)
+    invalidate_ref_cache()
+
+def add_incident_listener(fn: Callable[[Dict[str, Any]], None]) -> None:
+    """fn(event) на каждое событие INCIDENT_CHANNEL: {"op": "insert"|"close"|"reload", ...}."""
+    _incident_listeners.append(fn)
+
+def _emit_incident_event(event: Dict[str, Any]):
+    for fn in _incident_listeners:
+        try:
+            fn(event)
+        except Exception:
+            logger.exception("incident listener failed")
+
+def _on_incident_notify(connection, pid, channel, payload):
+    _emit_incident_event(json.loads(payload))
+
+async def _notify_incident(c: asyncpg.Connection, event: Dict[str, Any]):
+    await c.execute("SELECT pg_notify($1, $2);", INCIDENT_CHANNEL, json.dumps(event))
+
+def _on_ref_listener_lost(connection):
+    # пока LISTEN нет, кэш живёт на TTL; соединение переподнимаем в фоне
+    global _ref_listener, _reconnect_task
+    logger.warning("LISTEN connection lost, reconnecting (ref cache falls back to TTL)")
+    _ref_listener = None
+    invalidate_ref_cache()
+    if _listener_dsn and (_reconnect_task is None or _reconnect_task.done()):
+        _reconnect_task = asyncio.create_task(_reconnect_listener())
+
+async def _reconnect_listener():
+    while _listener_dsn and _ref_listener is None:
+        await asyncio.sleep(5)
+        if await _connect_listener(_listener_dsn):
+            # события, пришедшие пока LISTEN не было, потеряны — пусть подписчики перечитают
+            invalidate_ref_cache()
+            _emit_incident_event({"op": "reload"})
+
+async def _connect_listener(dsn: str) -> bool:
+    global _ref_listener
+    try:
+        listener = await asyncpg.connect(dsn)
+        await listener.add_listener(REF_CHANNEL, _on_ref_notify)
+        await listener.add_listener(INCIDENT_CHANNEL, _on_incident_notify)
+        listener.add_termination_listener(_on_ref_listener_lost)
+    except Exception:
+        logger.exception("cannot LISTEN %s/%s", REF_CHANNEL, INCIDENT_CHANNEL)
+        return False
+    _ref_listener = listener
+    return True
+
+async def _start_ref_listener(dsn: str):
+    # триггеры, которые шлют NOTIFY, ставит migrations/0002_ref_data_notify.sql
+    global _listener_dsn
+    _listener_dsn = dsn
+    if not await _connect_listener(dsn):
+        logger.warning("ref cache relies on TTL only")
+
+async def _stop_ref_listener():
+    global _ref_listener, _listener_dsn, _reconnect_task
+    _listener_dsn = None
+    if _reconnect_task:
+        _reconnect_task.cancel()
+        _reconnect_task = None
+    listener, _ref_listener = _ref_listener, None
+    if listener and not listener.is_closed():
+        listener.remove_termination_listener(_on_ref_listener_lost)
+        await listener.close()
+    invalidate_ref_cache()
+
+def _ref_fresh() -> bool:
+    return _ref_managers is not None and time.monotonic() - _ref_loaded_at < REF_CACHE_TTL
+
+@metrics.timed_query("load_ref_data")
+async def _load_ref_data():
+    global _ref_managers, _ref_rests, _ref_loaded_at, _ref_generation
+    async with _ref_lock:
+        if _ref_fresh():
+            return
+        CACHE_STATS["misses"] += 1
+        version = _ref_version
+        q = """
+        SELECT mr.manager_id, r.id, r.name
+        FROM manager_restaurants mr
+        JOIN restaurants r ON r.id = mr.restaurant_id
+        ORDER BY mr.manager_id, r.name;
+        """
+        async with read_conn(fresh=True) as c:
+            managers = await c.fetch("SELECT id, name, tg_chat_id FROM managers ORDER BY name;")
+            links = await c.fetch(q)
+        rests: Dict[int, List[asyncpg.Record]] = {}
+        for rec in links:
+            rests.setdefault(rec["manager_id"], []).append(rec)
+        _ref_managers, _ref_rests = managers, rests
+        _ref_generation += 1
+        # NOTIFY пришёл во время загрузки — данные могли устареть, свежими не считаем
+        _ref_loaded_at = time.monotonic() if version == _ref_version else 0.0
+
+# ---- роллапы для отчётов ----
+# incident_rollup_daily: агрегаты по (день в TZ, управляющий, ресторан, причина).
+# Обновляются в той же транзакции, что и запись инцидента; отчёты (reports.py)
+# читают только их.
+
+REPORT_TZ = os.getenv("TZ", "Asia/Almaty")
+
+_ROLLUP_UPSERT = """
+INSERT INTO incident_rollup_daily AS r
+    (day, manager_id, restaurant_id, reason, incidents, closed, amount_kzt, duration_sec)
+VALUES (($1::timestamptz AT TIME ZONE $2)::date, $3, $4, $5, $6, $7, $8, $9)
+ON CONFLICT (day, manager_id, restaurant_id, reason) DO UPDATE
+SET incidents    = r.incidents    + EXCLUDED.incidents,
+    closed       = r.closed       + EXCLUDED.closed,
+    amount_kzt   = r.amount_kzt   + EXCLUDED.amount_kzt,
+    duration_sec = r.duration_sec + EXCLUDED.duration_sec;
+"""
+
+def _duration_sec(start_ts, end_ts) -> int:
+    if start_ts is None or end_ts is None:
+        return 0
+    return max(0, int((end_ts - start_ts).total_seconds()))
+
+async def _rollup_add(c: asyncpg.Connection, start_ts, manager_id: int, restaurant_id: int,
+                      reason: str, incidents: int, closed: int, amount_kzt: int,
+                      duration_sec: int):
+    await c.execute(_ROLLUP_UPSERT, start_ts, REPORT_TZ, manager_id, restaurant_id, reason,
+                    incidents, closed, amount_kzt, duration_sec)
+
+# ---- идемпотентность записей ----
+# Ключ (например, чат + сообщение визарда) захватывается в той же транзакции, что и
+# запись; повтор с тем же ключом ждёт первую транзакцию и получает её результат.
+
+async def _claim_idempotency_key(c: asyncpg.Connection, key: Optional[str]) -> Tuple[bool, Optional[int]]:
+    """(новый ли ключ, сохранённый результат для повтора)."""
+    if key is None:
+        return True, None
+    claimed = await c.fetchval(
+        "INSERT INTO idempotency_keys (key) VALUES ($1) ON CONFLICT DO NOTHING RETURNING true;", key)
+    if claimed:
+        return True, None
+    return False, await c.fetchval("SELECT result FROM idempotency_keys WHERE key=$1;", key)
 
 # ---- helpers ----
 
 async def get_managers() -> List[asyncpg.Record]:
-    async with conn() as c:
-        rows = await c.fetch("SELECT id, name FROM managers ORDER BY name;")
-        return rows
+    if _ref_fresh():
+        CACHE_STATS["hits"] += 1
+    else:
+        await _load_ref_data()
+    return list(_ref_managers or [])
+
+async def get_restaurants() -> List[asyncpg.Record]:
+    """Все рестораны, привязанные хотя бы к одному управляющему (из кэша)."""
+    if _ref_fresh():
+        CACHE_STATS["hits"] += 1
+    else:
+        await _load_ref_data()
+    seen = {}
+    for rests in _ref_rests.values():
+        for r in rests:
+            seen.setdefault(r["id"], r)
+    return sorted(seen.values(), key=lambda r: r["name"])
 
 async def get_restaurants_for_manager(manager_id: int) -> List[asyncpg.Record]:
-    q = """
-    SELECT r.id, r.name
-    FROM manager_restaurants mr
-    JOIN restaurants r ON r.id = mr.restaurant_id
-    WHERE mr.manager_id = $1
-    ORDER BY r.name;
-    """
-    async with conn() as c:
-        return await c.fetch(q, manager_id)
+    if _ref_fresh():
+        CACHE_STATS["hits"] += 1
+    else:
+        await _load_ref_data()
+    return list(_ref_rests.get(manager_id, []))
+
+# incidents.amount_kzt — BIGINT
+AMOUNT_MAX = 2**63 - 1
 
+@metrics.timed_query("insert_incident")
 async def insert_incident(manager_id: int, restaurant_id: int,
                           start_ts, end_ts, reason: str,
                           comment: str, amount_kzt: int,
-                          status: str) -> int:
+                          status: str, idempotency_key: Optional[str] = None) -> int:
+    item = (manager_id, restaurant_id, start_ts, end_ts, reason, comment, amount_kzt,
+            status, idempotency_key)
+    _mark_write()
+    if _insert_batcher is not None:
+        return await _insert_batcher.submit(item)
+    return await _insert_incident_tx(item)
+
+async def _insert_incident_tx(item: tuple) -> int:
+    manager_id, restaurant_id, start_ts, end_ts, reason, comment, amount_kzt, status, key = item
     q = """
     INSERT INTO incidents (manager_id, restaurant_id, start_time, end_time,
                            reason, comment, amount_kzt, status)
@@ -55,27 +493,252 @@ async def insert_incident(manager_id: int, restaurant_id: int,
     RETURNING id;
     """
     async with conn() as c:
-        new_id = await c.fetchval(q, manager_id, restaurant_id, start_ts, end_ts,
-                                  reason, comment, amount_kzt, status)
+        async with c.transaction():
+            fresh, prev_id = await _claim_idempotency_key(c, key)
+            if not fresh:
+                return prev_id
+            new_id = await c.fetchval(q, manager_id, restaurant_id, start_ts, end_ts,
+                                      reason, comment, amount_kzt, status)
+            await _rollup_add(c, start_ts, manager_id, restaurant_id, reason,
+                              1, int(status == "closed"), amount_kzt or 0,
+                              _duration_sec(start_ts, end_ts))
+            if key is not None:
+                await c.execute("UPDATE idempotency_keys SET result=$2 WHERE key=$1;",
+                                key, new_id)
+            await _notify_incident(c, _insert_event(new_id, item))
         return new_id
 
-async def list_open_incidents() -> List[asyncpg.Record]:
-    q = """
+@metrics.timed_query("list_open_incidents")
+async def list_open_incidents(limit: Optional[int] = None,
+                              cursor: Optional[Tuple[Any, int]] = None,
+                              newer: bool = False,
+                              manager_id: Optional[int] = None,
+                              restaurant_id: Optional[int] = None,
+                              timeout: Optional[float] = DB_QUERY_TIMEOUT) -> List[asyncpg.Record]:
+    """Открытые инциденты, новые сверху; keyset-пагинация по (start_time, id).
+
+    cursor — (start_time, id) граничной строки: по умолчанию отдаются строки старше
+    неё, при newer=True — новее (для кнопки «назад»), но порядок всегда по убыванию.
+    timeout — предел на сам запрос (None — только statement_timeout сервера).
+    """
+    args: list = []
+    where = "i.status='open'"
+    if manager_id is not None:
+        args.append(manager_id)
+        where += f" AND i.manager_id=${len(args)}"
+    if restaurant_id is not None:
+        args.append(restaurant_id)
+        where += f" AND i.restaurant_id=${len(args)}"
+    if cursor is not None:
+        args.extend(cursor)
+        op = ">" if newer else "<"
+        where += f" AND (i.start_time, i.id) {op} (${len(args) - 1}, ${len(args)})"
+    order = "ASC" if newer else "DESC"
+    q = f"""
     SELECT i.id, i.start_time, i.reason, i.amount_kzt, r.name AS restaurant, m.name AS manager
     FROM incidents i
     JOIN restaurants r ON r.id=i.restaurant_id
     JOIN managers m    ON m.id=i.manager_id
-    WHERE i.status='open'
-    ORDER BY i.start_time DESC;
+    WHERE {where}
+    ORDER BY i.start_time {order}, i.id {order}
     """
-    async with conn() as c:
-        return await c.fetch(q)
+    if limit is not None:
+        args.append(limit)
+        q += f" LIMIT ${len(args)}"
+    async with read_conn() as c:
+        rows = await c.fetch(q, *args, timeout=timeout)
+    return rows[::-1] if newer else rows
 
-async def close_incident(incident_id: int, end_ts) -> None:
+@metrics.timed_query("get_incident")
+async def get_incident(incident_id: int,
+                       timeout: Optional[float] = DB_QUERY_TIMEOUT) -> Optional[asyncpg.Record]:
     q = """
-    UPDATE incidents
+    SELECT i.id, i.manager_id, i.restaurant_id, i.start_time, i.end_time, i.status,
+           i.reason, i.amount_kzt, r.name AS restaurant
+    FROM incidents i
+    JOIN restaurants r ON r.id=i.restaurant_id
+    WHERE i.id=$1;
+    """
+    async with read_conn() as c:
+        return await c.fetchrow(q, incident_id, timeout=timeout)
+
+@metrics.timed_query("close_incident")
+async def close_incident(incident_id: int, end_ts, idempotency_key: Optional[str] = None) -> None:
+    item = (incident_id, end_ts, idempotency_key)
+    _mark_write()
+    if _close_batcher is not None:
+        await _close_batcher.submit(item)
+    else:
+        await _close_incident_tx(item)
+
+async def _close_incident_tx(item: tuple) -> None:
+    incident_id, end_ts, key = item
+    q = """
+    UPDATE incidents i
     SET end_time=$2, status='closed'
-    WHERE id=$1;
+    FROM (SELECT id, end_time, status FROM incidents WHERE id=$1 FOR UPDATE) old
+    WHERE i.id=old.id
+    RETURNING i.manager_id, i.restaurant_id, i.reason, i.start_time,
+              old.end_time AS old_end, old.status AS old_status;
+    """
+    async with conn() as c:
+        async with c.transaction():
+            fresh, _ = await _claim_idempotency_key(c, key)
+            if not fresh:
+                return
+            row = await c.fetchrow(q, incident_id, end_ts)
+            if row is None:
+                return
+            await c.execute(_ROLLUP_UPSERT, *_close_rollup_args(row, end_ts))
+            await _notify_incident(c, {"op": "close", "id": incident_id})
+
+# ---- групповой коммит записей ----
+# Пачка вставок/закрытий — одна транзакция: ключи идемпотентности одним INSERT,
+# строки одним multi-row statement, роллапы и NOTIFY — executemany/unnest.
+# Порядок id внутри пачки задаётся заранее через nextval, поэтому каждый
+# вызывающий получает свой id без опоры на порядок RETURNING.
+
+def _start_batchers():
+    global _insert_batcher, _close_batcher
+    if not WRITE_BATCH:
+        return
+    delay = WRITE_BATCH_DELAY_MS / 1000
+    _insert_batcher = GroupCommitter("insert_incident", _insert_incidents_batch,
+                                     _insert_incident_tx, delay, WRITE_BATCH_MAX)
+    _close_batcher = GroupCommitter("close_incident", _close_incidents_batch,
+                                    _close_incident_tx, delay, WRITE_BATCH_MAX)
+
+async def _stop_batchers():
+    global _insert_batcher, _close_batcher
+    for batcher in (_insert_batcher, _close_batcher):
+        if batcher is not None:
+            await batcher.close()
+    _insert_batcher = _close_batcher = None
+
+def _insert_event(new_id: int, item: tuple) -> Dict[str, Any]:
+    manager_id, restaurant_id, start_ts, _, _, _, _, status, _ = item
+    return {"op": "insert", "id": new_id, "manager_id": manager_id,
+            "restaurant_id": restaurant_id, "status": status,
+            "start_time": start_ts.timestamp()}
+
+def _close_rollup_args(row, end_ts) -> tuple:
+    was_closed = row["old_status"] == "closed"
+    delta = _duration_sec(row["start_time"], end_ts)
+    if was_closed:
+        delta -= _duration_sec(row["start_time"], row["old_end"])
+    return (row["start_time"], REPORT_TZ, row["manager_id"], row["restaurant_id"],
+            row["reason"], 0, int(not was_closed), 0, delta)
+
+async def _claim_idempotency_keys(c: asyncpg.Connection, keys: List[Optional[str]]
+                                  ) -> Tuple[List[int], Dict[int, int], Dict[str, Any]]:
+    """Пакетный _claim_idempotency_key.
+
+    Возвращает (индексы, которые надо записать; повторы внутри пачки: индекс ->
+    индекс первого с тем же ключом; ранее записанные ключи -> сохранённый результат).
     """
+    todo: List[int] = []
+    dups: Dict[int, int] = {}
+    first: Dict[str, int] = {}
+    for i, key in enumerate(keys):
+        if key is None:
+            todo.append(i)
+        elif key in first:
+            dups[i] = first[key]
+        else:
+            first[key] = i
+    prev: Dict[str, Any] = {}
+    if first:
+        claimed = {r["key"] for r in await c.fetch(
+            "INSERT INTO idempotency_keys (key) SELECT unnest($1::text[]) "
+            "ON CONFLICT DO NOTHING RETURNING key;", sorted(first))}
+        stale = [k for k in first if k not in claimed]
+        if stale:
+            prev = {r["key"]: r["result"] for r in await c.fetch(
+                "SELECT key, result FROM idempotency_keys WHERE key = ANY($1::text[]);", stale)}
+            for k in stale:
+                prev.setdefault(k, None)
+        todo.extend(first[k] for k in claimed)
+    todo.sort()
+    return todo, dups, prev
+
+async def _notify_incidents(c: asyncpg.Connection, events: List[Dict[str, Any]]):
+    if events:
+        await c.execute("SELECT pg_notify($1, e) FROM unnest($2::text[]) AS e;",
+                        INCIDENT_CHANNEL, [json.dumps(e) for e in events])
+
+async def _insert_incidents_batch(items: List[tuple]) -> List[Optional[int]]:
+    results: List[Optional[int]] = [None] * len(items)
+    async with conn() as c:
+        async with c.transaction():
+            todo, dups, prev = await _claim_idempotency_keys(c, [it[8] for it in items])
+            for i, it in enumerate(items):
+                if it[8] in prev and i not in dups:
+                    results[i] = prev[it[8]]
+            if todo:
+                ids = [r[0] for r in await c.fetch(
+                    "SELECT nextval(pg_get_serial_sequence('incidents', 'id')) "
+                    "FROM generate_series(1, $1);", len(todo))]
+                rows = [items[i] for i in todo]
+                await c.execute("""
+                INSERT INTO incidents (id, manager_id, restaurant_id, start_time, end_time,
+                                       reason, comment, amount_kzt, status)
+                SELECT * FROM unnest($1::bigint[], $2::int[], $3::int[], $4::timestamptz[],
+                                     $5::timestamptz[], $6::text[], $7::text[], $8::bigint[],
+                                     $9::text[]);
+                """, ids, *(list(col) for col in zip(*(r[:8] for r in rows))))
+                # одинаковый порядок апсертов роллапа во всех транзакциях — без дедлоков
+                await c.executemany(_ROLLUP_UPSERT, sorted(
+                    ((r[2], REPORT_TZ, r[0], r[1], r[4], 1, int(r[7] == "closed"),
+                      r[6] or 0, _duration_sec(r[2], r[3])) for r in rows),
+                    key=lambda a: (a[2], a[3], a[4], a[0]),
+                ))
+                keyed = [(r[8], new_id) for r, new_id in zip(rows, ids) if r[8] is not None]
+                if keyed:
+                    await c.execute(
+                        "UPDATE idempotency_keys k SET result=v.result "
+                        "FROM unnest($1::text[], $2::bigint[]) AS v(key, result) WHERE k.key=v.key;",
+                        [k for k, _ in keyed], [v for _, v in keyed])
+                await _notify_incidents(c, [_insert_event(new_id, r) for r, new_id in zip(rows, ids)])
+                for i, new_id in zip(todo, ids):
+                    results[i] = new_id
+    for i, src in dups.items():
+        results[i] = results[src]
+    return results
+
+_CLOSE_BATCH = """
+UPDATE incidents i
+SET end_time=old.new_end, status='closed'
+FROM (SELECT o.id, o.end_time, o.status, v.end_ts AS new_end
+      FROM unnest($1::bigint[], $2::timestamptz[]) AS v(id, end_ts)
+      JOIN incidents o ON o.id=v.id
+      ORDER BY o.id
+      FOR UPDATE OF o) old
+WHERE i.id=old.id
+RETURNING i.id, i.manager_id, i.restaurant_id, i.reason, i.start_time, old.new_end,
+          old.end_time AS old_end, old.status AS old_status;
+"""
+
+async def _close_incidents_batch(items: List[tuple]) -> List[None]:
     async with conn() as c:
-        await c.execute(q, incident_id, end_ts)
+        async with c.transaction():
+            todo, _, _ = await _claim_idempotency_keys(c, [it[2] for it in items])
+            # один UPDATE меняет строку один раз: повторное закрытие того же
+            # инцидента в пачке уходит следующим заходом
+            rounds: List[List[tuple]] = []
+            for i in todo:
+                for rnd in rounds:
+                    if all(it[0] != items[i][0] for it in rnd):
+                        rnd.append(items[i])
+                        break
+                else:
+                    rounds.append([items[i]])
+            for rnd in rounds:
+                rows = await c.fetch(_CLOSE_BATCH, [it[0] for it in rnd], [it[1] for it in rnd])
+                if not rows:
+                    continue
+                await c.executemany(_ROLLUP_UPSERT, sorted(
+                    (_close_rollup_args(r, r["new_end"]) for r in rows),
+                    key=lambda a: (a[2], a[3], a[4], a[0]),
+                ))
+                await _notify_incidents(c, [{"op": "close", "id": r["id"]} for r in rows])
+    return [None] * len(items)
@@ -0,0 +1,99 @@
+# dedup.py
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Optional
+
+import db
+
+logger = logging.getLogger(__name__)
+
+# Telegram хранит недоставленные апдейты до суток — дольше помнить незачем
+RETENTION_SEC = 2 * 24 * 3600
+_CLEANUP_EVERY_SEC = 3600
+
+
+class UpdateDeduplicator:
+    """Отсекает повторную доставку апдейта по update_id.
+
+    Сначала LRU в памяти процесса (повтор в тот же инстанс — один dict lookup),
+    затем, если use_db, вставка в processed_updates: ON CONFLICT означает, что
+    апдейт уже взял другой воркер/инстанс.
+    """
+
+    def __init__(self, bot_id: int, lru_size: int = 10000, use_db: bool = True):
+        self.bot_id = bot_id
+        self.lru_size = lru_size
+        self.use_db = use_db
+        self._seen: "OrderedDict[int, None]" = OrderedDict()
+        self._last_cleanup = time.monotonic()
+        self._cleanup_task: Optional[asyncio.Task] = None
+        self.duplicates = 0
+
+    def _remember(self, update_id: int):
+        self._seen[update_id] = None
+        if len(self._seen) > self.lru_size:
+            self._seen.popitem(last=False)
+
+    async def claim(self, update_id: int) -> bool:
+        """True — апдейт новый и его надо обработать; False — дубль."""
+        if update_id in self._seen:
+            self._seen.move_to_end(update_id)
+            self.duplicates += 1
+            return False
+        if not self.use_db:
+            self._remember(update_id)
+            return True
+        async with db.conn() as c:
+            inserted = await c.fetchval(
+                "INSERT INTO processed_updates (bot_id, update_id) VALUES ($1, $2) "
+                "ON CONFLICT DO NOTHING RETURNING true;",
+                self.bot_id, update_id,
+                timeout=db.DB_QUERY_TIMEOUT,
+            )
+        # в LRU — только после успешной вставки: упавший claim не должен отсечь повтор
+        self._remember(update_id)
+        self._maybe_cleanup()
+        if not inserted:
+            self.duplicates += 1
+            return False
+        return True
+
+    async def release(self, update_id: int):
+        """Снимает claim, если апдейт так и не взяли в обработку (503/«занято»):
+        повторная доставка Telegram должна пройти, а не уйти в дубли."""
+        self._seen.pop(update_id, None)
+        if not self.use_db:
+            return
+        try:
+            async with db.conn() as c:
+                await c.execute(
+                    "DELETE FROM processed_updates WHERE bot_id = $1 AND update_id = $2;",
+                    self.bot_id, update_id,
+                )
+        except Exception:
+            logger.exception("failed to release update %s", update_id)
+
+    def _maybe_cleanup(self):
+        if time.monotonic() - self._last_cleanup < _CLEANUP_EVERY_SEC:
+            return
+        if self._cleanup_task and not self._cleanup_task.done():
+            return
+        self._last_cleanup = time.monotonic()
+        self._cleanup_task = asyncio.create_task(self._cleanup())
+
+    async def _cleanup(self):
+        # заодно чистим ключи идемпотентности db.insert_incident/close_incident
+        try:
+            async with db.conn() as c:
+                await c.execute(
+                    "DELETE FROM processed_updates WHERE seen_at < now() - make_interval(secs => $1);",
+                    float(RETENTION_SEC),
+                )
+                await c.execute(
+                    "DELETE FROM idempotency_keys WHERE created_at < now() - make_interval(secs => $1);",
+                    float(RETENTION_SEC),
+                )
+        except Exception:
+            logger.exception("processed_updates cleanup failed")
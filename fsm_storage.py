@@ -0,0 +1,171 @@
+# fsm_storage.py
+import json
+import time
+import logging
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+from aiogram.types import TelegramObject
+
+import db
+import metrics
+
+logger = logging.getLogger(__name__)
+
+_Key = Tuple[int, int, int, int, str, str]
+
+_SELECT_SQL = """
+SELECT state, data FROM fsm_state
+WHERE bot_id=$1 AND chat_id=$2 AND user_id=$3 AND thread_id=$4 AND business=$5 AND destiny=$6;
+"""
+
+# $7/$9 — флаги «поле менялось»: неизменённое поле в существующей строке не трогаем
+_UPSERT_SQL = """
+INSERT INTO fsm_state (bot_id, chat_id, user_id, thread_id, business, destiny, state, data)
+VALUES ($1,$2,$3,$4,$5,$6,$8,COALESCE($10::jsonb, '{}'::jsonb))
+ON CONFLICT (bot_id, chat_id, user_id, thread_id, business, destiny) DO UPDATE
+SET state      = CASE WHEN $7 THEN EXCLUDED.state ELSE fsm_state.state END,
+    data       = CASE WHEN $9 THEN EXCLUDED.data  ELSE fsm_state.data  END,
+    updated_at = now();
+"""
+
+_DELETE_SQL = """
+DELETE FROM fsm_state
+WHERE bot_id=$1 AND chat_id=$2 AND user_id=$3 AND thread_id=$4 AND business=$5 AND destiny=$6;
+"""
+
+
+def _state_str(state: StateType) -> Optional[str]:
+    return state.state if isinstance(state, State) else state
+
+
+class _Pending:
+    __slots__ = ("state", "data", "has_state", "has_data")
+
+    def __init__(self):
+        self.state: Optional[str] = None
+        self.data: Optional[Dict[str, Any]] = None
+        self.has_state = False
+        self.has_data = False
+
+
+class PostgresStorage(BaseStorage):
+    """FSM-хранилище в Postgres: одна строка fsm_state на (bot, chat, user).
+
+    Таблица создаётся миграцией migrations/0004_fsm_state.sql.
+
+    set_state/set_data только копят изменения в памяти; в БД они уходят одной
+    UPSERT-записью в flush(), который вызывает FSMFlushMiddleware после обработки
+    апдейта. Прочитанная строка тоже живёт до flush(): get_state и get_data
+    одного апдейта делят один SELECT. cache_ttl > 0 включает локальный read-through кэш — имеет смысл только
+    при одном процессе (иначе другие воркеры могут прочитать устаревшее состояние).
+    """
+
+    def __init__(self, cache_ttl: float = 0.0):
+        self._cache_ttl = cache_ttl
+        self._cache: Dict[_Key, Tuple[float, Optional[str], Dict[str, Any]]] = {}
+        self._pending: Dict[_Key, _Pending] = {}
+        self._loaded: Dict[_Key, Tuple[Optional[str], Dict[str, Any]]] = {}
+
+    @staticmethod
+    def _key(key: StorageKey) -> _Key:
+        return (key.bot_id, key.chat_id, key.user_id, key.thread_id or 0,
+                getattr(key, "business_connection_id", None) or "", key.destiny)
+
+    async def _load(self, k: _Key) -> Tuple[Optional[str], Dict[str, Any]]:
+        loaded = self._loaded.get(k)
+        if loaded is None:
+            loaded = self._loaded[k] = await self._fetch(k)
+        return loaded
+
+    @metrics.timed_query("fsm_load")
+    async def _fetch(self, k: _Key) -> Tuple[Optional[str], Dict[str, Any]]:
+        if self._cache_ttl > 0:
+            hit = self._cache.get(k)
+            if hit and time.monotonic() - hit[0] < self._cache_ttl:
+                return hit[1], hit[2]
+        async with db.conn() as c:
+            row = await c.fetchrow(_SELECT_SQL, *k)
+        state, data = (row["state"], json.loads(row["data"])) if row else (None, {})
+        if self._cache_ttl > 0:
+            self._cache[k] = (time.monotonic(), state, data)
+        return state, data
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        p = self._pending.setdefault(self._key(key), _Pending())
+        p.state, p.has_state = _state_str(state), True
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        k = self._key(key)
+        p = self._pending.get(k)
+        if p and p.has_state:
+            return p.state
+        state, _ = await self._load(k)
+        return state
+
+    def pending_state(self, key: StorageKey) -> Tuple[bool, Optional[str]]:
+        """(ставился ли state в этом апдейте, какой) — без обращения к БД."""
+        p = self._pending.get(self._key(key))
+        return (True, p.state) if p and p.has_state else (False, None)
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        p = self._pending.setdefault(self._key(key), _Pending())
+        p.data, p.has_data = dict(data), True
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        k = self._key(key)
+        p = self._pending.get(k)
+        if p and p.has_data:
+            return dict(p.data)
+        _, data = await self._load(k)
+        return dict(data)
+
+    @metrics.timed_query("fsm_flush")
+    async def flush(self, key: Optional[StorageKey] = None) -> None:
+        """Пишет накопленные изменения: по одному запросу на ключ."""
+        if key is not None:
+            k = self._key(key)
+            self._loaded.pop(k, None)
+            items = [(k, self._pending.pop(k))] if k in self._pending else []
+        else:
+            self._loaded.clear()
+            items, self._pending = list(self._pending.items()), {}
+        if not items:
+            return
+        async with db.conn() as c:
+            for k, p in items:
+                if p.has_state and p.has_data and p.state is None and not p.data:
+                    await c.execute(_DELETE_SQL, *k)
+                else:
+                    await c.execute(_UPSERT_SQL, *k, p.has_state, p.state, p.has_data,
+                                    json.dumps(p.data, ensure_ascii=False) if p.has_data else None)
+                if self._cache_ttl > 0:
+                    cached = self._cache.get(k)
+                    if cached or (p.has_state and p.has_data):
+                        state = p.state if p.has_state else cached[1]
+                        data = p.data if p.has_data else cached[2]
+                        self._cache[k] = (time.monotonic(), state, data)
+
+    async def close(self) -> None:
+        try:
+            await self.flush()
+        except Exception:
+            logger.exception("fsm storage flush on close failed")
+        self._cache.clear()
+
+
+class FSMFlushMiddleware(BaseMiddleware):
+    """Outer-middleware на update: после обработки апдейта сбрасывает состояние в БД."""
+
+    def __init__(self, storage: PostgresStorage):
+        self.storage = storage
+
+    async def __call__(self, handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject, data: Dict[str, Any]) -> Any:
+        try:
+            return await handler(event, data)
+        finally:
+            ctx = data.get("state")
+            await self.storage.flush(ctx.key if ctx is not None else None)
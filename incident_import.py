@@ -0,0 +1,250 @@
+# incident_import.py
+import io
+import csv
+import asyncio
+import logging
+import datetime as dt
+from typing import Dict, Iterator, List, Sequence, Tuple
+
+import pytz
+
+import db
+import metrics
+
+logger = logging.getLogger(__name__)
+
+MAX_ROWS = 50000
+
+# колонки файла (первая строка — заголовок, порядок произвольный)
+COLUMNS = ["manager", "restaurant", "start", "end", "reason", "comment", "amount"]
+_REQUIRED = ["manager", "restaurant", "start", "reason", "amount"]
+_DATE_FORMATS = ["%d.%m.%Y %H:%M", "%d.%m.%Y %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d %H:%M:%S",
+                 "%Y-%m-%dT%H:%M", "%Y-%m-%dT%H:%M:%S"]
+
+_STAGE_COLUMNS = ["line_no", "manager_id", "restaurant_id", "start_time", "end_time",
+                  "reason", "comment", "amount_kzt", "status"]
+
+_STAGE_SQL = """
+CREATE TEMP TABLE incident_import_stage (
+    line_no       INTEGER,
+    manager_id    INTEGER,
+    restaurant_id INTEGER,
+    start_time    TIMESTAMPTZ,
+    end_time      TIMESTAMPTZ,
+    reason        TEXT,
+    comment       TEXT,
+    amount_kzt    BIGINT,
+    status        TEXT
+) ON COMMIT DROP;
+"""
+
+# повторная загрузка того же файла: строки, уже лежащие в incidents (или выше
+# в этом же файле) с тем же управляющим, рестораном, началом и причиной, пропускаются
+_DEDUP_SQL = """
+DELETE FROM incident_import_stage s
+WHERE EXISTS (
+    SELECT 1 FROM incidents i
+    WHERE i.manager_id = s.manager_id AND i.restaurant_id = s.restaurant_id
+      AND i.start_time = s.start_time AND i.reason = s.reason
+) OR EXISTS (
+    SELECT 1 FROM incident_import_stage p
+    WHERE p.line_no < s.line_no AND p.manager_id = s.manager_id
+      AND p.restaurant_id = s.restaurant_id AND p.start_time = s.start_time AND p.reason = s.reason
+);
+"""
+
+_MERGE_SQL = """
+INSERT INTO incidents (manager_id, restaurant_id, start_time, end_time,
+                       reason, comment, amount_kzt, status)
+SELECT manager_id, restaurant_id, start_time, end_time, reason, comment, amount_kzt, status
+FROM incident_import_stage
+ORDER BY line_no;
+"""
+
+_MERGE_ROLLUP_SQL = """
+INSERT INTO incident_rollup_daily AS r
+    (day, manager_id, restaurant_id, reason, incidents, closed, amount_kzt, duration_sec)
+SELECT (start_time AT TIME ZONE $1)::date, manager_id, restaurant_id, reason,
+       count(*),
+       count(*) FILTER (WHERE status = 'closed'),
+       sum(amount_kzt),
+       COALESCE(sum(GREATEST(0, EXTRACT(EPOCH FROM end_time - start_time)))
+                FILTER (WHERE end_time IS NOT NULL), 0)::bigint
+FROM incident_import_stage
+GROUP BY 1, 2, 3, 4
+-- порядок блокировок строк роллапа как у пакетных апсертов db.py
+-- (manager, restaurant, reason, день) — иначе импорт и закрытия ловят дедлок
+ORDER BY 2, 3, 4, 1
+ON CONFLICT (day, manager_id, restaurant_id, reason) DO UPDATE
+SET incidents    = r.incidents    + EXCLUDED.incidents,
+    closed       = r.closed       + EXCLUDED.closed,
+    amount_kzt   = r.amount_kzt   + EXCLUDED.amount_kzt,
+    duration_sec = r.duration_sec + EXCLUDED.duration_sec;
+"""
+
+
+class IncidentImportError(Exception):
+    """Файл не удалось разобрать целиком (формат, заголовок, размер)."""
+
+
+def _iter_csv(raw: bytes) -> Iterator[Sequence]:
+    text = io.TextIOWrapper(io.BytesIO(raw), encoding="utf-8-sig", newline="")
+    sample = text.read(4096)
+    text.seek(0)
+    try:
+        dialect = csv.Sniffer().sniff(sample, delimiters=",;\t")
+    except csv.Error:
+        dialect = csv.excel
+    yield from csv.reader(text, dialect)
+
+
+def _iter_xlsx(raw: bytes) -> Iterator[Sequence]:
+    from openpyxl import load_workbook
+
+    wb = load_workbook(io.BytesIO(raw), read_only=True, data_only=True)
+    try:
+        yield from wb.active.iter_rows(values_only=True)
+    finally:
+        wb.close()
+
+
+def _cell(v) -> str:
+    return "" if v is None else str(v).strip()
+
+
+def _parse_ts(v, tz) -> dt.datetime:
+    if isinstance(v, dt.datetime):
+        ts = v
+    else:
+        s = _cell(v)
+        for fmt in _DATE_FORMATS:
+            try:
+                ts = dt.datetime.strptime(s, fmt)
+                break
+            except ValueError:
+                continue
+        else:
+            raise ValueError(f"неверная дата «{s}»")
+    return tz.localize(ts) if ts.tzinfo is None else ts
+
+
+def parse_rows(raw: bytes, filename: str, managers: Dict[str, int],
+               links: Dict[int, Dict[str, int]], reasons: Dict[str, str],
+               tz_name: str) -> Tuple[List[tuple], List[Tuple[int, str]]]:
+    """Разбирает и валидирует файл построчно. Синхронная — вызывается в потоке.
+
+    managers: имя (lower) -> id; links: manager_id -> {название ресторана (lower) -> id};
+    reasons: код или подпись (lower) -> код. Имена можно заменять числовыми id.
+    Возвращает (записи для staging-таблицы, [(номер строки, ошибка)]).
+    """
+    tz = pytz.timezone(tz_name)
+    name = filename.lower()
+    if name.endswith(".csv"):
+        rows = _iter_csv(raw)
+    elif name.endswith(".xlsx"):
+        rows = _iter_xlsx(raw)
+    else:
+        raise IncidentImportError("Поддерживаются только файлы .csv и .xlsx")
+
+    header = next(rows, None)
+    if not header:
+        raise IncidentImportError("Файл пустой")
+    index = {_cell(h).lower(): n for n, h in enumerate(header)}
+    missing = [c for c in _REQUIRED if c not in index]
+    if missing:
+        raise IncidentImportError(f"Нет колонок: {', '.join(missing)}. Ожидаются: {', '.join(COLUMNS)}")
+
+    manager_ids = set(managers.values())
+    records: List[tuple] = []
+    errors: List[Tuple[int, str]] = []
+    for line_no, row in enumerate(rows, start=2):
+        if line_no - 1 > MAX_ROWS:
+            raise IncidentImportError(f"Слишком много строк (максимум {MAX_ROWS})")
+        get = lambda col: row[index[col]] if col in index and index[col] < len(row) else None
+        if not any(_cell(v) for v in row):
+            continue
+        try:
+            m_raw = _cell(get("manager"))
+            mgr_id = int(m_raw) if m_raw.isdigit() else managers.get(m_raw.lower())
+            if mgr_id not in manager_ids:
+                raise ValueError(f"неизвестный управляющий «{m_raw}»")
+
+            r_raw = _cell(get("restaurant"))
+            rests = links.get(mgr_id, {})
+            rest_id = int(r_raw) if r_raw.isdigit() else rests.get(r_raw.lower())
+            if rest_id not in rests.values():
+                raise ValueError(f"ресторан «{r_raw}» не привязан к управляющему")
+
+            start_ts = _parse_ts(get("start"), tz)
+            end_ts = _parse_ts(get("end"), tz) if _cell(get("end")) else None
+            if end_ts is not None and end_ts < start_ts:
+                raise ValueError("конец раньше начала")
+
+            reason = reasons.get(_cell(get("reason")).lower())
+            if reason is None:
+                raise ValueError(f"неизвестная причина «{_cell(get('reason'))}»")
+
+            amount_raw = _cell(get("amount")).replace(" ", "").replace(" ", "")
+            if amount_raw.endswith(".0"):
+                amount_raw = amount_raw[:-2]
+            if not amount_raw.isdigit():
+                raise ValueError(f"неверная сумма «{_cell(get('amount'))}»")
+            if int(amount_raw) > db.AMOUNT_MAX:
+                raise ValueError(f"слишком большая сумма «{_cell(get('amount'))}»")
+
+            records.append((line_no, mgr_id, rest_id, start_ts, end_ts, reason,
+                            _cell(get("comment")) or "—", int(amount_raw),
+                            "closed" if end_ts else "open"))
+        except ValueError as e:
+            errors.append((line_no, str(e)))
+    return records, errors
+
+
+async def _reference_maps() -> Tuple[Dict[str, int], Dict[int, Dict[str, int]]]:
+    managers = await db.get_managers()
+    links: Dict[int, Dict[str, int]] = {}
+    for m in managers:
+        rests = await db.get_restaurants_for_manager(m["id"])
+        links[m["id"]] = {r["name"].lower(): r["id"] for r in rests}
+    return {m["name"].lower(): m["id"] for m in managers}, links
+
+
+@metrics.timed_query("import_load")
+async def load_records(records: List[tuple]) -> int:
+    """COPY в staging-таблицу и перенос в incidents одной транзакцией; возвращает число новых."""
+    if not records:
+        return 0
+    async with db.conn() as c:
+        await db.unbounded(c)
+        async with c.transaction():
+            await c.execute(_STAGE_SQL)
+            await c.copy_records_to_table("incident_import_stage", records=records,
+                                          columns=_STAGE_COLUMNS)
+            status = await c.execute(_DEDUP_SQL)
+            skipped = int(status.split()[-1])
+            if skipped == len(records):
+                return 0
+            await c.execute(_MERGE_SQL)
+            await c.execute(_MERGE_ROLLUP_SQL, db.REPORT_TZ)
+            await c.execute("SELECT pg_notify($1, $2);", db.INCIDENT_CHANNEL, '{"op": "reload"}')
+    if skipped:
+        logger.info("import: %d rows already loaded, skipped", skipped)
+    return len(records) - skipped
+
+
+async def import_file(raw: bytes, filename: str,
+                      reasons: Dict[str, str]) -> Tuple[int, List[Tuple[int, str]]]:
+    """Импорт файла: (сколько загружено, ошибки по строкам).
+
+    Если хоть одна строка с ошибкой — ничего не загружается, чтобы файл можно было
+    исправить и отправить повторно. Уже загруженные инциденты (тот же управляющий,
+    ресторан, начало и причина) повторно не вставляются.
+    """
+    managers, links = await _reference_maps()
+    records, errors = await asyncio.to_thread(parse_rows, raw, filename, managers, links,
+                                              reasons, db.REPORT_TZ)
+    if errors:
+        return 0, errors
+    loaded = await load_records(records)
+    logger.info("imported %d incidents from %s", loaded, filename)
+    return loaded, []
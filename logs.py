@@ -0,0 +1,148 @@
+# logs.py
+import os
+import sys
+import json
+import queue
+import atexit
+import random
+import logging
+import logging.handlers
+import datetime as dt
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Optional
+
+# Логи пишутся в stdout из отдельного потока (QueueListener): в event loop
+# остаётся только положить LogRecord в очередь. Сообщение и трейсбек
+# форматируются уже в потоке, поэтому аргументы логирования после вызова
+# не должны меняться (везде передаются строки/числа/готовые dict).
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")            # json | text
+# доля апдейтов, чей JSON попадает в лог (0 — никогда, 1 — каждый)
+LOG_PAYLOAD_SAMPLE = float(os.getenv("LOG_PAYLOAD_SAMPLE", "0"))
+LOG_PAYLOAD_MAX = int(os.getenv("LOG_PAYLOAD_MAX", "800"))
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+
+# поля текущего апдейта: update_id, chat, handler
+_context: ContextVar[Dict[str, Any]] = ContextVar("log_context", default={})
+
+payload_logger = logging.getLogger("payload")
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+@contextmanager
+def update_context(**fields: Any):
+    token = _context.set({**_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+def set_handler(name: str):
+    """Имя хендлера aiogram — выставляет HandlerMetricsMiddleware внутри update_context."""
+    ctx = _context.get()
+    if ctx:
+        ctx["handler"] = name
+
+
+class _ContextFilter(logging.Filter):
+    # выполняется в вызывающем коде: контекст апдейта доступен только там
+    def filter(self, record: logging.LogRecord) -> bool:
+        for key, value in _context.get().items():
+            setattr(record, key, value)
+        return True
+
+
+class _NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # в отличие от QueueHandler не форматирует запись в вызывающем потоке
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            # писатель не успевает — теряем запись, но не блокируем event loop
+            pass
+
+
+class JsonFormatter(logging.Formatter):
+    _FIELDS = ("update_id", "chat", "handler")
+
+    def format(self, record: logging.LogRecord) -> str:
+        out: Dict[str, Any] = {
+            "ts": dt.datetime.fromtimestamp(record.created, dt.timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key in self._FIELDS:
+            value = getattr(record, key, None)
+            if value is not None:
+                out[key] = value
+        if record.exc_info:
+            out["exc"] = self.formatException(record.exc_info)
+        return json.dumps(out, ensure_ascii=False, default=str)
+
+
+class _Payload:
+    """Ленивое представление апдейта: сериализуется только при форматировании."""
+    __slots__ = ("data",)
+
+    def __init__(self, data: Any):
+        self.data = data
+
+    def __str__(self) -> str:
+        return json.dumps(self.data, ensure_ascii=False, default=str)[:LOG_PAYLOAD_MAX]
+
+
+def log_payload(data: Any):
+    """Сэмплированный дамп JSON апдейта (LOG_PAYLOAD_SAMPLE)."""
+    if LOG_PAYLOAD_SAMPLE <= 0 or not payload_logger.isEnabledFor(logging.INFO):
+        return
+    if LOG_PAYLOAD_SAMPLE < 1 and random.random() >= LOG_PAYLOAD_SAMPLE:
+        return
+    payload_logger.info("update %s", _Payload(data))
+
+
+def setup():
+    """Корневой логгер -> очередь -> поток-писатель в stdout. Повторный вызов — no-op."""
+    global _listener
+    if _listener is not None:
+        return
+    stream = logging.StreamHandler(sys.stdout)
+    if LOG_FORMAT == "json":
+        stream.setFormatter(JsonFormatter())
+    else:
+        stream.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+
+    q: "queue.Queue[logging.LogRecord]" = queue.Queue(LOG_QUEUE_SIZE)
+    handler = _NonBlockingQueueHandler(q)
+    handler.addFilter(_ContextFilter())
+
+    root = logging.getLogger()
+    for h in root.handlers[:]:
+        root.removeHandler(h)
+    root.addHandler(handler)
+    root.setLevel(LOG_LEVEL)
+    # у uvicorn свои StreamHandler'ы — пусть тоже идут через очередь
+    for name in ("uvicorn", "uvicorn.error", "uvicorn.access"):
+        lg = logging.getLogger(name)
+        for h in lg.handlers[:]:
+            lg.removeHandler(h)
+        lg.propagate = True
+
+    _listener = logging.handlers.QueueListener(q, stream, respect_handler_level=True)
+    _listener.start()
+    atexit.register(shutdown)
+
+
+def shutdown():
+    """Дописывает очередь и останавливает поток-писатель."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,148 @@
+# metrics.py
+import time
+from contextlib import asynccontextmanager
+from functools import wraps
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.types import TelegramObject
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest,
+)
+
+import logs
+
+# границы бакетов в секундах: от быстрых ответов из кэша до таймаута Telegram
+_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+HANDLER_LATENCY = Histogram(
+    "bot_handler_seconds", "Время обработки апдейта хендлером aiogram",
+    ["handler", "state"], buckets=_BUCKETS,
+)
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Исключения в хендлерах", ["handler"])
+FSM_TRANSITIONS = Counter(
+    "bot_fsm_transitions_total", "Переходы FSM", ["from_state", "to_state"],
+)
+DB_QUERY_LATENCY = Histogram(
+    "bot_db_query_seconds", "Время запросов db.py (включая ожидание соединения)",
+    ["query"], buckets=_BUCKETS,
+)
+DB_ACQUIRE_WAIT = Histogram(
+    "bot_db_pool_acquire_seconds", "Ожидание соединения из пула", ["pool"], buckets=_BUCKETS,
+)
+TELEGRAM_API_LATENCY = Histogram(
+    "bot_telegram_api_seconds", "Время исходящих вызовов Telegram Bot API",
+    ["method"], buckets=_BUCKETS,
+)
+TELEGRAM_API_ERRORS = Counter("bot_telegram_api_errors_total", "Ошибки Bot API", ["method"])
+UPDATES_IN_FLIGHT = Gauge("bot_updates_in_flight", "Апдейты в обработке")
+UPDATE_LATENCY = Histogram(
+    "bot_update_seconds", "Полное время обработки апдейта", buckets=_BUCKETS,
+)
+DB_POOL_SIZE = Gauge("bot_db_pool_size", "Открытых соединений в пуле", ["pool"])
+DB_POOL_IDLE = Gauge("bot_db_pool_idle", "Свободных соединений в пуле", ["pool"])
+DB_WRITE_BATCH = Histogram(
+    "bot_db_write_batch_size", "Записей в одной пачке группового коммита",
+    ["writer"], buckets=(1, 2, 5, 10, 20, 50, 100, 200),
+)
+UPDATE_QUEUE_SIZE = Gauge("bot_update_queue_size", "Апдейтов в очереди воркеров")
+DB_ACQUIRE_TIMEOUTS = Counter(
+    "bot_db_pool_acquire_timeouts_total", "Соединение не выдано за DB_ACQUIRE_TIMEOUT", ["pool"],
+)
+DB_CIRCUIT_OPEN = Gauge("bot_db_circuit_open", "Цепь пула разомкнута (1) после ошибок БД", ["pool"])
+UPDATES_SHED = Counter(
+    "bot_updates_shed_total", "Апдейты, отбитые ответом «Сервис занят»", ["reason"],
+)
+
+_collectors: list[Callable[[], None]] = []
+
+
+def on_scrape(fn: Callable[[], None]) -> Callable[[], None]:
+    """Регистрирует функцию, обновляющую gauge-метрики перед каждым scrape."""
+    _collectors.append(fn)
+    return fn
+
+
+def render() -> tuple[bytes, str]:
+    for fn in _collectors:
+        fn()
+    return generate_latest(), CONTENT_TYPE_LATEST
+
+
+def timed_query(name: str):
+    """Декоратор для функций db.py: время запроса с ожиданием пула."""
+    def deco(fn):
+        @wraps(fn)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            finally:
+                DB_QUERY_LATENCY.labels(name).observe(time.perf_counter() - started)
+        return wrapper
+    return deco
+
+
+@asynccontextmanager
+async def track_update():
+    UPDATES_IN_FLIGHT.inc()
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        UPDATE_LATENCY.observe(time.perf_counter() - started)
+        UPDATES_IN_FLIGHT.dec()
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Inner-middleware роутера: латентность хендлера и переходы FSM."""
+
+    async def __call__(self, handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject, data: Dict[str, Any]) -> Any:
+        h = data.get("handler")
+        name = h.callback.__name__ if h is not None else "unknown"
+        logs.set_handler(name)
+        before = data.get("raw_state") or "-"
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.labels(name).inc()
+            raise
+        finally:
+            HANDLER_LATENCY.labels(name, before).observe(time.perf_counter() - started)
+            ctx = data.get("state")
+            if ctx is not None:
+                after = await _state_after(ctx, before)
+                if after != before:
+                    FSM_TRANSITIONS.labels(before, after).inc()
+
+
+async def _state_after(ctx: Any, before: str) -> str:
+    """Состояние после хендлера без лишнего запроса к хранилищу.
+
+    PostgresStorage копит set_state до flush — берём оттуда; если хендлер
+    состояние не ставил, оно не изменилось. Остальные хранилища (MemoryStorage)
+    читаются из памяти.
+    """
+    pending = getattr(ctx.storage, "pending_state", None)
+    if pending is None:
+        return await ctx.get_state() or "-"
+    changed, state = pending(ctx.key)
+    return (state or "-") if changed else before
+
+
+class TelegramApiMetricsMiddleware(BaseRequestMiddleware):
+    """Middleware сессии Bot: латентность каждого вызова Bot API."""
+
+    async def __call__(self, make_request, bot, method):
+        name = type(method).__name__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception:
+            TELEGRAM_API_ERRORS.labels(name).inc()
+            raise
+        finally:
+            TELEGRAM_API_LATENCY.labels(name).observe(time.perf_counter() - started)
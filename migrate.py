@@ -0,0 +1,193 @@
+# migrate.py
+"""Версионированные SQL-миграции из каталога migrations/.
+
+    python migrate.py up        # применить новые
+    python migrate.py status    # что применено, что ждёт
+    python migrate.py check     # EXPLAIN горячих запросов: без Seq Scan по большим таблицам
+
+Файлы называются NNNN_описание.sql и применяются по возрастанию номера, каждый
+в своей транзакции. Применённые версии пишутся в schema_migrations; параллельный
+запуск из нескольких воркеров сериализуется advisory-локом.
+"""
+import os
+import re
+import sys
+import json
+import asyncio
+import hashlib
+import logging
+from typing import List, Optional, Tuple
+
+import asyncpg
+
+logger = logging.getLogger(__name__)
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+_LOCK_ID = 0x534C5432  # "SLT2"
+_FILE_RE = re.compile(r"^(\d{4})_(.+)\.sql$")
+
+_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS schema_migrations (
+    version    INTEGER PRIMARY KEY,
+    name       TEXT NOT NULL,
+    checksum   TEXT NOT NULL,
+    applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+"""
+
+# Горячие запросы бота с типичными параметрами. Добавляя запрос в db.py/reports.py,
+# добавьте его сюда — `check` упадёт, если для него нет подходящего индекса.
+CHECK_QUERIES: List[Tuple[str, str, tuple]] = [
+    ("list_open_incidents", """
+        SELECT i.id, i.start_time, i.reason, i.amount_kzt, r.name AS restaurant, m.name AS manager
+        FROM incidents i
+        JOIN restaurants r ON r.id=i.restaurant_id
+        JOIN managers m    ON m.id=i.manager_id
+        WHERE i.status='open'
+        ORDER BY i.start_time DESC;""", ()),
+    ("list_open_incidents_page", """
+        SELECT i.id FROM incidents i
+        WHERE i.status='open' AND i.manager_id=$1 AND (i.start_time, i.id) < (now(), $2)
+        ORDER BY i.start_time DESC, i.id DESC LIMIT 8;""", (1, 1)),
+    ("list_open_incidents_by_restaurant", """
+        SELECT i.id FROM incidents i
+        WHERE i.status='open' AND i.restaurant_id=$1
+        ORDER BY i.start_time DESC, i.id DESC LIMIT 8;""", (1,)),
+    ("get_restaurants_for_manager", """
+        SELECT r.id, r.name
+        FROM manager_restaurants mr
+        JOIN restaurants r ON r.id = mr.restaurant_id
+        WHERE mr.manager_id = $1
+        ORDER BY r.name;""", (1,)),
+    ("close_incident", "SELECT id, end_time, status FROM incidents WHERE id=$1 FOR UPDATE;", (1,)),
+    ("report_totals", """
+        SELECT sum(incidents), sum(amount_kzt) FROM incident_rollup_daily
+        WHERE day BETWEEN current_date - 30 AND current_date;""", ()),
+    ("report_export", """
+        SELECT i.id FROM incidents i
+        WHERE i.start_time >= now() - interval '30 days' AND i.start_time < now()
+        ORDER BY i.start_time, i.id;""", ()),
+    ("fsm_load", """
+        SELECT state, data FROM fsm_state
+        WHERE bot_id=$1 AND chat_id=$2 AND user_id=$3 AND thread_id=0 AND business='' AND destiny='default';""",
+     (1, 1, 1)),
+]
+
+# Таблицы, которые растут с данными: по ним Seq Scan в горячем пути недопустим.
+LARGE_TABLES = {"incidents", "incident_rollup_daily", "fsm_state", "manager_restaurants"}
+# секции incidents (partitions.py) в плане видны под своими именами
+_PARTITION_RE = re.compile(r"^(incidents)_(?:\d{4}_\d{2}|default)$")
+
+
+def discover() -> List[Tuple[int, str, str]]:
+    """[(версия, имя, путь)] по возрастанию версии."""
+    out = []
+    for fn in sorted(os.listdir(MIGRATIONS_DIR)):
+        m = _FILE_RE.match(fn)
+        if m:
+            out.append((int(m.group(1)), m.group(2), os.path.join(MIGRATIONS_DIR, fn)))
+    versions = [v for v, _, _ in out]
+    if len(versions) != len(set(versions)):
+        raise RuntimeError("duplicate migration versions in migrations/")
+    return out
+
+
+def _checksum(sql: str) -> str:
+    return hashlib.sha256(sql.encode()).hexdigest()[:16]
+
+
+async def apply(c: asyncpg.Connection) -> List[int]:
+    """Применяет ещё не применённые миграции; возвращает их версии."""
+    applied_now: List[int] = []
+    await c.execute("SELECT pg_advisory_lock($1);", _LOCK_ID)
+    try:
+        await c.execute(_TABLE_SQL)
+        done = {r["version"]: r["checksum"] for r in
+                await c.fetch("SELECT version, checksum FROM schema_migrations;")}
+        for version, name, path in discover():
+            with open(path, encoding="utf-8") as f:
+                sql = f.read()
+            if version in done:
+                if done[version] != _checksum(sql):
+                    logger.warning("migration %04d_%s changed after it was applied", version, name)
+                continue
+            async with c.transaction():
+                await c.execute(sql)
+                await c.execute(
+                    "INSERT INTO schema_migrations (version, name, checksum) VALUES ($1, $2, $3);",
+                    version, name, _checksum(sql),
+                )
+            logger.info("applied migration %04d_%s", version, name)
+            applied_now.append(version)
+    finally:
+        await c.execute("SELECT pg_advisory_unlock($1);", _LOCK_ID)
+    return applied_now
+
+
+async def status(c: asyncpg.Connection) -> List[Tuple[int, str, Optional[str]]]:
+    await c.execute(_TABLE_SQL)
+    done = {r["version"]: r["applied_at"] for r in
+            await c.fetch("SELECT version, applied_at FROM schema_migrations;")}
+    return [(v, n, str(done[v]) if v in done else None) for v, n, _ in discover()]
+
+
+def _seq_scans(plan: dict) -> List[str]:
+    found = []
+    relation = plan.get("Relation Name") or ""
+    if plan.get("Node Type") == "Seq Scan" and _PARTITION_RE.sub(r"\1", relation) in LARGE_TABLES:
+        found.append(relation)
+    for child in plan.get("Plans", []):
+        found.extend(_seq_scans(child))
+    return found
+
+
+async def check(c: asyncpg.Connection) -> List[Tuple[str, List[str]]]:
+    """EXPLAIN каждого запроса из CHECK_QUERIES с enable_seqscan=off.
+
+    Если планировщик всё равно выбирает Seq Scan по большой таблице — подходящего
+    индекса нет. Возвращает [(запрос, [таблицы с Seq Scan])] для проблемных запросов.
+    """
+    problems = []
+    async with c.transaction():
+        await c.execute("SET LOCAL enable_seqscan = off;")
+        for name, sql, args in CHECK_QUERIES:
+            raw = await c.fetchval(f"EXPLAIN (FORMAT JSON) {sql.strip().rstrip(';')}", *args)
+            plan = (json.loads(raw) if isinstance(raw, str) else raw)[0]["Plan"]
+            scans = _seq_scans(plan)
+            if scans:
+                problems.append((name, scans))
+    return problems
+
+
+async def _main(cmd: str) -> int:
+    dsn = os.getenv("DATABASE_URL")
+    if not dsn:
+        raise RuntimeError("DATABASE_URL is not set")
+    c = await asyncpg.connect(dsn)
+    try:
+        if cmd == "up":
+            applied = await apply(c)
+            print(f"applied: {', '.join(f'{v:04d}' for v in applied) or 'nothing'}")
+        elif cmd == "status":
+            for version, name, applied_at in await status(c):
+                print(f"{version:04d}_{name}: {applied_at or 'pending'}")
+        elif cmd == "check":
+            problems = await check(c)
+            for name, scans in problems:
+                print(f"FAIL {name}: Seq Scan on {', '.join(scans)}")
+            if problems:
+                return 1
+            print(f"ok: {len(CHECK_QUERIES)} queries use indexes")
+        else:
+            print(__doc__)
+            return 2
+    finally:
+        await c.close()
+    return 0
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(asyncio.run(_main(sys.argv[1] if len(sys.argv) > 1 else "")))
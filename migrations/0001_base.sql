@@ -0,0 +1,28 @@
+-- Базовые таблицы бота. IF NOT EXISTS — для баз, созданных до появления миграций.
+CREATE TABLE IF NOT EXISTS managers (
+    id   SERIAL PRIMARY KEY,
+    name TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS restaurants (
+    id   SERIAL PRIMARY KEY,
+    name TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS manager_restaurants (
+    manager_id    INTEGER NOT NULL REFERENCES managers(id),
+    restaurant_id INTEGER NOT NULL REFERENCES restaurants(id),
+    PRIMARY KEY (manager_id, restaurant_id)
+);
+
+CREATE TABLE IF NOT EXISTS incidents (
+    id            BIGSERIAL PRIMARY KEY,
+    manager_id    INTEGER NOT NULL REFERENCES managers(id),
+    restaurant_id INTEGER NOT NULL REFERENCES restaurants(id),
+    start_time    TIMESTAMPTZ NOT NULL,
+    end_time      TIMESTAMPTZ,
+    reason        TEXT NOT NULL,
+    comment       TEXT,
+    amount_kzt    BIGINT NOT NULL DEFAULT 0,
+    status        TEXT NOT NULL DEFAULT 'open'
+);
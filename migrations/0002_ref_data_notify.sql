@@ -0,0 +1,22 @@
+-- NOTIFY для сброса кэша справочников в db.py (канал db.REF_CHANNEL).
+CREATE OR REPLACE FUNCTION notify_ref_data_changed() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('ref_data_changed', TG_TABLE_NAME);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_managers_ref_notify ON managers;
+CREATE TRIGGER trg_managers_ref_notify
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON managers
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_ref_data_changed();
+
+DROP TRIGGER IF EXISTS trg_restaurants_ref_notify ON restaurants;
+CREATE TRIGGER trg_restaurants_ref_notify
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON restaurants
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_ref_data_changed();
+
+DROP TRIGGER IF EXISTS trg_manager_restaurants_ref_notify ON manager_restaurants;
+CREATE TRIGGER trg_manager_restaurants_ref_notify
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON manager_restaurants
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_ref_data_changed();
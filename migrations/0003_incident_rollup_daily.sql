@@ -0,0 +1,12 @@
+-- Дневные агрегаты для отчётов (reports.py); ведутся в insert_incident/close_incident.
+CREATE TABLE IF NOT EXISTS incident_rollup_daily (
+    day           DATE    NOT NULL,
+    manager_id    INTEGER NOT NULL,
+    restaurant_id INTEGER NOT NULL,
+    reason        TEXT    NOT NULL,
+    incidents     INTEGER NOT NULL DEFAULT 0,
+    closed        INTEGER NOT NULL DEFAULT 0,
+    amount_kzt    BIGINT  NOT NULL DEFAULT 0,
+    duration_sec  BIGINT  NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, manager_id, restaurant_id, reason)
+);
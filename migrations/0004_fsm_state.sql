@@ -0,0 +1,13 @@
+-- Состояние визардов для fsm_storage.PostgresStorage.
+CREATE TABLE IF NOT EXISTS fsm_state (
+    bot_id     BIGINT NOT NULL,
+    chat_id    BIGINT NOT NULL,
+    user_id    BIGINT NOT NULL,
+    thread_id  BIGINT NOT NULL DEFAULT 0,
+    business   TEXT   NOT NULL DEFAULT '',
+    destiny    TEXT   NOT NULL DEFAULT 'default',
+    state      TEXT,
+    data       JSONB  NOT NULL DEFAULT '{}'::jsonb,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    PRIMARY KEY (bot_id, chat_id, user_id, thread_id, business, destiny)
+);
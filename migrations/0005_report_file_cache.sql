@@ -0,0 +1,6 @@
+-- Telegram file_id готовых файлов отчётов (report_render.py).
+CREATE TABLE IF NOT EXISTS report_file_cache (
+    cache_key  TEXT PRIMARY KEY,
+    file_id    TEXT NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
@@ -0,0 +1,16 @@
+-- Индексы под запросы db.py / reports.py / report_render.py.
+
+-- list_open_incidents: WHERE status='open' ORDER BY start_time DESC.
+-- Частичный индекс содержит только открытые инциденты и не растёт с архивом.
+CREATE INDEX IF NOT EXISTS incidents_open_start_idx
+    ON incidents (start_time DESC, id DESC)
+    INCLUDE (manager_id, restaurant_id, reason, amount_kzt)
+    WHERE status = 'open';
+
+-- выгрузка отчёта за период и пересчёт роллапов: WHERE start_time >= ... AND < ...
+CREATE INDEX IF NOT EXISTS incidents_start_time_idx
+    ON incidents (start_time, id);
+
+-- join restaurants/managers по id с выборкой name — index-only scan.
+CREATE INDEX IF NOT EXISTS restaurants_id_name_idx ON restaurants (id) INCLUDE (name);
+CREATE INDEX IF NOT EXISTS managers_id_name_idx ON managers (id) INCLUDE (name);
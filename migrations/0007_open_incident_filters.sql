@@ -0,0 +1,9 @@
+-- Постраничный выбор открытых инцидентов с фильтром по управляющему / ресторану:
+-- WHERE status='open' AND manager_id=$1 AND (start_time, id) < (...) ORDER BY start_time DESC, id DESC
+CREATE INDEX IF NOT EXISTS incidents_open_manager_start_idx
+    ON incidents (manager_id, start_time DESC, id DESC)
+    WHERE status = 'open';
+
+CREATE INDEX IF NOT EXISTS incidents_open_restaurant_start_idx
+    ON incidents (restaurant_id, start_time DESC, id DESC)
+    WHERE status = 'open';
@@ -0,0 +1,15 @@
+-- Дедупликация апдейтов по update_id (dedup.py); строки старше двух суток удаляются.
+CREATE TABLE IF NOT EXISTS processed_updates (
+    bot_id    BIGINT NOT NULL,
+    update_id BIGINT NOT NULL,
+    seen_at   TIMESTAMPTZ NOT NULL DEFAULT now(),
+    PRIMARY KEY (bot_id, update_id)
+);
+CREATE INDEX IF NOT EXISTS processed_updates_seen_at_idx ON processed_updates (seen_at);
+
+-- Ключи идемпотентности insert_incident / close_incident: повтор возвращает прежний результат.
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    key        TEXT PRIMARY KEY,
+    result     BIGINT,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
@@ -0,0 +1,2 @@
+-- Чат управляющего в Telegram — куда слать напоминания и вечернюю сводку (scheduler.py).
+ALTER TABLE managers ADD COLUMN IF NOT EXISTS tg_chat_id BIGINT;
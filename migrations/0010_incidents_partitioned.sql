@@ -0,0 +1,63 @@
+-- incidents -> секционированная по start_time (помесячно, см. partitions.py).
+-- Здесь создаётся только секция DEFAULT: старые строки попадают в неё и
+-- разъезжаются по месячным секциям при первом partitions.ensure() (он же
+-- заранее создаёт секции на PARTITION_MONTHS_AHEAD месяцев вперёд).
+-- Первичный ключ секционированной таблицы обязан включать ключ секционирования.
+ALTER TABLE incidents RENAME TO incidents_unpartitioned;
+ALTER INDEX IF EXISTS incidents_pkey RENAME TO incidents_unpartitioned_pkey;
+DROP INDEX IF EXISTS incidents_open_start_idx;
+DROP INDEX IF EXISTS incidents_start_time_idx;
+DROP INDEX IF EXISTS incidents_open_manager_start_idx;
+DROP INDEX IF EXISTS incidents_open_restaurant_start_idx;
+
+CREATE TABLE incidents (
+    id            BIGINT NOT NULL DEFAULT nextval('incidents_id_seq'),
+    manager_id    INTEGER NOT NULL REFERENCES managers(id),
+    restaurant_id INTEGER NOT NULL REFERENCES restaurants(id),
+    start_time    TIMESTAMPTZ NOT NULL,
+    end_time      TIMESTAMPTZ,
+    reason        TEXT NOT NULL,
+    comment       TEXT,
+    amount_kzt    BIGINT NOT NULL DEFAULT 0,
+    status        TEXT NOT NULL DEFAULT 'open',
+    PRIMARY KEY (id, start_time)
+) PARTITION BY RANGE (start_time);
+
+ALTER SEQUENCE incidents_id_seq OWNED BY incidents.id;
+
+CREATE TABLE incidents_default PARTITION OF incidents DEFAULT;
+
+INSERT INTO incidents (id, manager_id, restaurant_id, start_time, end_time,
+                       reason, comment, amount_kzt, status)
+SELECT id, manager_id, restaurant_id, start_time, end_time,
+       reason, comment, amount_kzt, status
+FROM incidents_unpartitioned;
+
+DROP TABLE incidents_unpartitioned;
+
+-- индексы из 0006/0007 — теперь на каждой секции
+CREATE INDEX incidents_open_start_idx
+    ON incidents (start_time DESC, id DESC)
+    INCLUDE (manager_id, restaurant_id, reason, amount_kzt)
+    WHERE status = 'open';
+
+CREATE INDEX incidents_start_time_idx
+    ON incidents (start_time, id);
+
+CREATE INDEX incidents_open_manager_start_idx
+    ON incidents (manager_id, start_time DESC, id DESC)
+    WHERE status = 'open';
+
+CREATE INDEX incidents_open_restaurant_start_idx
+    ON incidents (restaurant_id, start_time DESC, id DESC)
+    WHERE status = 'open';
+
+-- выгруженные в файлы и удалённые секции (partitions.archive)
+CREATE TABLE IF NOT EXISTS incident_archives (
+    path        TEXT PRIMARY KEY,
+    partition   TEXT NOT NULL,
+    range_from  TIMESTAMPTZ NOT NULL,
+    range_to    TIMESTAMPTZ NOT NULL,
+    row_count   BIGINT NOT NULL,
+    archived_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
@@ -0,0 +1,3 @@
+-- manager_restaurants_manager_idx (ранняя редакция 0006) повторял первичный ключ
+-- (manager_id, restaurant_id) из 0001 — лишняя запись на каждую привязку.
+DROP INDEX IF EXISTS manager_restaurants_manager_idx;
@@ -0,0 +1,306 @@
+# partitions.py
+"""Помесячные секции incidents и архив старых закрытых секций.
+
+    python partitions.py ensure     # секции на PARTITION_MONTHS_AHEAD месяцев вперёд
+    python partitions.py archive    # выгрузить и удалить секции старше PARTITION_RETENTION_MONTHS
+    python partitions.py status     # секции и архивы
+
+incidents секционирована по start_time (migrations/0010). Границы секций — начала
+месяцев в TZ отчётов: месяц секции совпадает с днями роллапа. Архив — Parquet (zstd)
+в PARTITION_ARCHIVE_DIR, список архивов — incident_archives; выгрузки report_render
+дочитывают из него архивные периоды. Роллапы (incident_rollup_daily) при архивации
+не трогаются, поэтому суммы в отчётах не меняются.
+"""
+import os
+import re
+import sys
+import asyncio
+import logging
+import datetime as dt
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional
+
+import asyncpg
+import pytz
+
+logger = logging.getLogger(__name__)
+
+PARTITION_MONTHS_AHEAD = int(os.getenv("PARTITION_MONTHS_AHEAD", "3"))
+# 0 — не архивировать
+PARTITION_RETENTION_MONTHS = int(os.getenv("PARTITION_RETENTION_MONTHS", "0"))
+# постоянный том (диск Render, NFS, смонтированный бакет): после выгрузки секция
+# удаляется из БД, поэтому без заданного каталога архивация не выполняется
+PARTITION_ARCHIVE_DIR = os.getenv("PARTITION_ARCHIVE_DIR", "")
+# строк в row group архива: по статистикам row group'ов чтение пропускает чужие даты
+ARCHIVE_ROW_GROUP = 64 * 1024
+
+_LOCK_ID = 0x534C5450  # "SLTP"
+_NAME_RE = re.compile(r"^incidents_(\d{4})_(\d{2})$")
+
+ARCHIVE_COLUMNS = ["id", "manager_id", "manager", "restaurant_id", "restaurant", "start_time",
+                   "end_time", "reason", "comment", "amount_kzt", "status"]
+
+_EXPORT_SQL = """
+SELECT i.id, i.manager_id, m.name AS manager, i.restaurant_id, r.name AS restaurant,
+       i.start_time, i.end_time, i.reason, i.comment, i.amount_kzt, i.status
+FROM {table} i
+LEFT JOIN managers m    ON m.id = i.manager_id
+LEFT JOIN restaurants r ON r.id = i.restaurant_id
+ORDER BY i.start_time, i.id;
+"""
+
+
+def _add_months(month: dt.date, n: int) -> dt.date:
+    years, m = divmod(month.month - 1 + n, 12)
+    return dt.date(month.year + years, m + 1, 1)
+
+
+def _bound(month: dt.date, tz: str) -> dt.datetime:
+    return pytz.timezone(tz).localize(dt.datetime.combine(month, dt.time()))
+
+
+def partition_name(month: dt.date) -> str:
+    return f"incidents_{month:%Y_%m}"
+
+
+async def _monthly(c: asyncpg.Connection) -> Dict[dt.date, str]:
+    rows = await c.fetch("""
+        SELECT ch.relname FROM pg_inherits inh
+        JOIN pg_class ch ON ch.oid = inh.inhrelid
+        WHERE inh.inhparent = 'incidents'::regclass;
+    """)
+    out = {}
+    for r in rows:
+        m = _NAME_RE.match(r["relname"])
+        if m:
+            out[dt.date(int(m.group(1)), int(m.group(2)), 1)] = r["relname"]
+    return out
+
+
+async def ensure(c: asyncpg.Connection, tz: str, ahead: int = PARTITION_MONTHS_AHEAD) -> List[str]:
+    """Создаёт недостающие секции: прошлый месяц … +ahead и месяцы строк из DEFAULT."""
+    this_month = dt.datetime.now(pytz.timezone(tz)).date().replace(day=1)
+    created = []
+    await c.execute("SELECT pg_advisory_lock($1);", _LOCK_ID)
+    try:
+        existing = await _monthly(c)
+        months = {_add_months(this_month, n) for n in range(-1, ahead + 1)}
+        # DEFAULT: данные до миграции 0010 и даты вне созданных секций
+        months.update(r["m"] for r in await c.fetch(
+            "SELECT DISTINCT date_trunc('month', start_time AT TIME ZONE $1)::date AS m "
+            "FROM incidents_default;", tz))
+        for month in sorted(months - set(existing)):
+            await _create(c, month, tz)
+            created.append(partition_name(month))
+    finally:
+        await c.execute("SELECT pg_advisory_unlock($1);", _LOCK_ID)
+    if created:
+        logger.info("created partitions: %s", ", ".join(created))
+    return created
+
+
+async def _create(c: asyncpg.Connection, month: dt.date, tz: str):
+    name = partition_name(month)
+    lo, hi = _bound(month, tz), _bound(_add_months(month, 1), tz)
+    bounds = f"FROM ('{lo.isoformat()}') TO ('{hi.isoformat()}')"
+    async with c.transaction():
+        in_default = await c.fetchval(
+            "SELECT EXISTS (SELECT 1 FROM incidents_default WHERE start_time >= $1 AND start_time < $2);",
+            lo, hi)
+        if not in_default:
+            await c.execute(f"CREATE TABLE {name} PARTITION OF incidents FOR VALUES {bounds};")
+            return
+        # строки месяца уже лежат в DEFAULT: переносим в отдельную таблицу и подключаем её
+        await c.execute(f"CREATE TABLE {name} (LIKE incidents INCLUDING DEFAULTS INCLUDING CONSTRAINTS);")
+        await c.execute(
+            f"WITH moved AS (DELETE FROM incidents_default WHERE start_time >= $1 AND start_time < $2 "
+            f"RETURNING *) INSERT INTO {name} SELECT * FROM moved;", lo, hi)
+        await c.execute(f"ALTER TABLE incidents ATTACH PARTITION {name} FOR VALUES {bounds};")
+
+
+# ---- архив ----
+
+def _archive_schema():
+    import pyarrow as pa
+
+    ts = pa.timestamp("us", tz="UTC")
+    return pa.schema([
+        ("id", pa.int64()), ("manager_id", pa.int32()), ("manager", pa.string()),
+        ("restaurant_id", pa.int32()), ("restaurant", pa.string()),
+        ("start_time", ts), ("end_time", ts), ("reason", pa.string()),
+        ("comment", pa.string()), ("amount_kzt", pa.int64()), ("status", pa.string()),
+    ])
+
+
+class _ParquetSink:
+    """Архив секции: row group'ы пишутся во временный файл по мере чтения курсора,
+    commit() — fsync, сверка с БД, rename и fsync каталога."""
+
+    def __init__(self, path: str):
+        import pyarrow.parquet as pq
+
+        self.path = path
+        self.tmp = path + ".tmp"
+        self.schema = _archive_schema()
+        self.writer = pq.ParquetWriter(self.tmp, self.schema, compression="zstd")
+
+    def write(self, columns: Dict[str, list]):
+        import pyarrow as pa
+
+        batch = pa.record_batch([columns[col] for col in ARCHIVE_COLUMNS], schema=self.schema)
+        self.writer.write_batch(batch, row_group_size=ARCHIVE_ROW_GROUP)
+
+    def commit(self, rows: int, id_sum: int):
+        import pyarrow.compute as pc
+        import pyarrow.parquet as pq
+
+        self.writer.close()
+        with open(self.tmp, "rb") as f:
+            os.fsync(f.fileno())
+        # перечитываем записанное с диска: секция удаляется только после сверки
+        ids = pq.read_table(self.tmp, columns=["id"])["id"]
+        written_sum = pc.sum(ids).as_py() or 0
+        if len(ids) != rows or written_sum != id_sum:
+            raise RuntimeError(f"archive {self.tmp} verification failed: {len(ids)} rows, "
+                               f"sum(id)={written_sum}; expected {rows}, {id_sum}")
+        os.replace(self.tmp, self.path)
+        fd = os.open(os.path.dirname(self.path), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def abort(self):
+        try:
+            self.writer.close()
+        except Exception:
+            pass
+        if os.path.exists(self.tmp):
+            os.unlink(self.tmp)
+
+
+def _open_batches(path: str, ts_from: dt.datetime, ts_to: dt.datetime, batch_size: int) -> Iterator:
+    import pyarrow.dataset as ds
+
+    # фильтр уходит в сканер: лишние row group'ы не читаются, батчи идут в порядке файла
+    start = ds.field("start_time")
+    return ds.dataset(path, format="parquet").to_batches(
+        filter=(start >= ts_from) & (start < ts_to), batch_size=batch_size)
+
+
+async def archive(c: asyncpg.Connection, tz: str, retention: int = PARTITION_RETENTION_MONTHS,
+                  directory: str = PARTITION_ARCHIVE_DIR) -> List[str]:
+    """Секции целиком старше retention месяцев и без открытых инцидентов -> Parquet, затем DROP."""
+    if retention <= 0:
+        return []
+    if not directory:
+        logger.error("PARTITION_ARCHIVE_DIR is not set, partitions are not archived")
+        return []
+    horizon = _add_months(dt.datetime.now(pytz.timezone(tz)).date().replace(day=1), -retention)
+    os.makedirs(directory, exist_ok=True)
+    done = []
+    await c.execute("SELECT pg_advisory_lock($1);", _LOCK_ID)
+    try:
+        for month, name in sorted((await _monthly(c)).items()):
+            if month >= horizon:
+                break
+            if await c.fetchval(f"SELECT EXISTS (SELECT 1 FROM {name} WHERE status = 'open');"):
+                logger.warning("partition %s has open incidents, not archived", name)
+                continue
+            # метка времени в имени: месяц, снова набежавший в DEFAULT, архивируется отдельным файлом
+            stamp = dt.datetime.now(dt.timezone.utc).strftime("%Y%m%dT%H%M%S")
+            path = os.path.abspath(os.path.join(directory, f"{name}_{stamp}.parquet"))
+            sink = await asyncio.to_thread(_ParquetSink, path)
+            try:
+                async with c.transaction():
+                    # SHARE: правки секции ждут, пока она не выгружена и не отключена
+                    await c.execute(f"LOCK TABLE {name} IN SHARE MODE;")
+                    rows, id_sum = await c.fetchrow(
+                        f"SELECT count(*), COALESCE(sum(id), 0) FROM {name};")
+                    columns: Dict[str, list] = {col: [] for col in ARCHIVE_COLUMNS}
+                    async for rec in c.cursor(_EXPORT_SQL.format(table=name), prefetch=1000):
+                        for col in ARCHIVE_COLUMNS:
+                            columns[col].append(rec[col])
+                        if len(columns["id"]) >= ARCHIVE_ROW_GROUP:
+                            await asyncio.to_thread(sink.write, columns)
+                            columns = {col: [] for col in ARCHIVE_COLUMNS}
+                    if columns["id"]:
+                        await asyncio.to_thread(sink.write, columns)
+                    await asyncio.to_thread(sink.commit, rows, int(id_sum))
+                    await c.execute(f"ALTER TABLE incidents DETACH PARTITION {name};")
+                    await c.execute(
+                        "INSERT INTO incident_archives (path, partition, range_from, range_to, row_count) "
+                        "VALUES ($1, $2, $3, $4, $5);",
+                        path, name, _bound(month, tz), _bound(_add_months(month, 1), tz), rows)
+                    await c.execute(f"DROP TABLE {name};")
+            except BaseException:
+                sink.abort()
+                raise
+            logger.info("archived %s: %d rows -> %s", name, rows, path)
+            done.append(name)
+    finally:
+        await c.execute("SELECT pg_advisory_unlock($1);", _LOCK_ID)
+    return done
+
+
+async def archived_before(c: asyncpg.Connection) -> Optional[dt.datetime]:
+    """Всё, что раньше этого момента, лежит только в архиве (None — архива нет)."""
+    return await c.fetchval("SELECT max(range_to) FROM incident_archives;")
+
+
+async def read_archived(c: asyncpg.Connection, ts_from: dt.datetime, ts_to: dt.datetime,
+                        batch_size: int = 1000) -> AsyncIterator[List[Dict[str, Any]]]:
+    """Пачки строк архива с start_time в [ts_from, ts_to), по возрастанию (start_time, id)."""
+    archives = await c.fetch(
+        "SELECT partition, path FROM incident_archives "
+        "WHERE range_to > $1 AND range_from < $2 ORDER BY range_from;", ts_from, ts_to)
+    for a in archives:
+        if not os.path.exists(a["path"]):
+            logger.warning("archive %s is missing at %s", a["partition"], a["path"])
+            continue
+        batches = await asyncio.to_thread(_open_batches, a["path"], ts_from, ts_to, batch_size)
+        while True:
+            batch = await asyncio.to_thread(next, batches, None)
+            if batch is None:
+                break
+            if batch.num_rows:
+                yield batch.to_pylist()
+
+
+async def _main(cmd: str) -> int:
+    dsn = os.getenv("DATABASE_URL")
+    if not dsn:
+        raise RuntimeError("DATABASE_URL is not set")
+    tz = os.getenv("TZ", "Asia/Almaty")
+    c = await asyncpg.connect(dsn)
+    try:
+        if cmd == "ensure":
+            created = await ensure(c, tz)
+            print(f"created: {', '.join(created) or 'nothing'}")
+        elif cmd == "archive":
+            if PARTITION_RETENTION_MONTHS <= 0:
+                print("PARTITION_RETENTION_MONTHS is not set")
+                return 2
+            if not PARTITION_ARCHIVE_DIR:
+                print("PARTITION_ARCHIVE_DIR is not set")
+                return 2
+            archived = await archive(c, tz)
+            print(f"archived: {', '.join(archived) or 'nothing'}")
+        elif cmd == "status":
+            for month, name in sorted((await _monthly(c)).items()):
+                rows = await c.fetchval(f"SELECT count(*) FROM {name};")
+                print(f"{name}: {rows} rows")
+            for a in await c.fetch("SELECT partition, row_count, path FROM incident_archives ORDER BY range_from;"):
+                print(f"{a['partition']}: archived, {a['row_count']} rows -> {a['path']}")
+        else:
+            print(__doc__)
+            return 2
+    finally:
+        await c.close()
+    return 0
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(asyncio.run(_main(sys.argv[1] if len(sys.argv) > 1 else "")))
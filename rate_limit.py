@@ -0,0 +1,164 @@
+# rate_limit.py
+import time
+import asyncio
+import logging
+from typing import Any, Dict, Optional, Tuple
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import AnswerCallbackQuery, EditMessageReplyMarkup, EditMessageText
+
+logger = logging.getLogger(__name__)
+
+# Ответ на callback и правка сообщения под нажатой кнопкой — реакция на действие
+# самого пользователя: общий лимит (рассылки, новые сообщения) они не ждут, только
+# паузу после 429. Правки ограничены по-чатовым ведром, ответы на callback — ничем.
+_EDITS = (EditMessageText, EditMessageReplyMarkup)
+
+
+class TokenBucket:
+    """Ведро с резервированием: reserve() сразу списывает токен и говорит, сколько ждать."""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self) -> float:
+        now = time.monotonic()
+        self._refill(now)
+        self.tokens -= 1
+        wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        return max(wait, self.paused_until - now)
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def pause_left(self) -> float:
+        return max(0.0, self.paused_until - time.monotonic())
+
+    def idle(self) -> bool:
+        self._refill(time.monotonic())
+        return self.tokens >= self.burst and self.paused_until <= self.updated
+
+
+class _Edit:
+    __slots__ = ("method", "future", "sent", "waiters")
+
+    def __init__(self, method):
+        self.method = method
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.sent = False
+        self.waiters = 0   # вызывающие, чью правку заменила эта
+
+
+class RateLimitMiddleware(BaseRequestMiddleware):
+    """Middleware сессии Bot: общий и по-чатовый token bucket, retry_after, слияние правок.
+
+    Если правка сообщения ещё ждёт своей очереди, а для того же сообщения пришла
+    новая, уходит только новая — все вызывающие получают её результат. Правку
+    отправляет отдельная задача: отмена первого вызывающего не отменяет её, пока
+    результата ждут другие.
+    """
+
+    def __init__(self, global_rate: float = 30.0, global_burst: float = 30.0,
+                 chat_rate: float = 1.0, chat_burst: float = 3.0, max_retries: int = 3):
+        self.global_limit = TokenBucket(global_rate, global_burst)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._chats: Dict[Any, TokenBucket] = {}
+        self._edits: Dict[Tuple[Any, int], _Edit] = {}
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > 10000:
+                self._chats = {k: b for k, b in self._chats.items() if not b.idle()}
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    async def _wait_turn(self, chat_id, method):
+        callback = isinstance(method, AnswerCallbackQuery)
+        delay = 0.0
+        if chat_id is not None and not callback:
+            delay = self._chat_bucket(chat_id).reserve()
+        if callback or isinstance(method, _EDITS):
+            delay = max(delay, self.global_limit.pause_left())
+        else:
+            delay = max(delay, self.global_limit.reserve())
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def _send(self, make_request, bot, method, chat_id, edit: Optional[_Edit] = None):
+        attempt = 0
+        while True:
+            await self._wait_turn(chat_id, method)
+            if edit is not None:
+                edit.sent = True
+                method = edit.method
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                attempt += 1
+                if attempt > self.max_retries:
+                    raise
+                logger.warning("429 on %s (chat %s), retry after %ss",
+                               type(method).__name__, chat_id, e.retry_after)
+                if chat_id is not None:
+                    self._chat_bucket(chat_id).pause(e.retry_after)
+                else:
+                    self.global_limit.pause(e.retry_after)
+                if edit is not None:
+                    edit.sent = False  # пока ждём, новая правка может заменить эту
+
+    async def _send_edit(self, make_request, bot, chat_id, key, entry: _Edit):
+        try:
+            result = await self._send(make_request, bot, entry.method, chat_id, entry)
+            if not entry.future.done():
+                entry.future.set_result(result)
+        except asyncio.CancelledError:
+            entry.future.cancel()
+            raise
+        except Exception as e:
+            if not entry.future.done():
+                entry.future.set_exception(e)
+                entry.future.exception()  # не ругаться, если больше никто не ждал
+        finally:
+            if self._edits.get(key) is entry:
+                del self._edits[key]
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        message_id = getattr(method, "message_id", None)
+        if not isinstance(method, EditMessageText) or chat_id is None or message_id is None:
+            return await self._send(make_request, bot, method, chat_id)
+
+        key = (chat_id, message_id)
+        entry = self._edits.get(key)
+        if entry is not None and not entry.sent:
+            entry.method = method
+            entry.waiters += 1
+            try:
+                return await asyncio.shield(entry.future)
+            finally:
+                entry.waiters -= 1
+
+        entry = self._edits[key] = _Edit(method)
+        task = asyncio.create_task(self._send_edit(make_request, bot, chat_id, key, entry))
+        try:
+            return await asyncio.shield(entry.future)
+        except asyncio.CancelledError:
+            if not entry.waiters:
+                # правку больше никто не ждёт — снимаем её вместе с задачей
+                task.cancel()
+                entry.future.cancel()
+                if self._edits.get(key) is entry:
+                    del self._edits[key]
+            raise
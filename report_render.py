@@ -0,0 +1,202 @@
+# report_render.py
+import os
+import csv
+import asyncio
+import hashlib
+import logging
+import tempfile
+import datetime as dt
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Optional, Tuple
+
+import pytz
+
+import db
+import partitions
+import reports
+
+logger = logging.getLogger(__name__)
+
+FORMATS = {
+    "pdf":  ("📄 PDF", "application/pdf"),
+    "xlsx": ("📊 Excel", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    "csv":  ("🧾 CSV", "text/csv"),
+}
+
+RENDER_WORKERS = int(os.getenv("REPORT_RENDER_WORKERS", "1"))
+PDF_FONT = os.getenv("REPORT_PDF_FONT", "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf")
+CURSOR_PREFETCH = 500
+
+HEADER = ["ID", "Начало", "Конец", "Управляющий", "Ресторан", "Причина",
+          "Комментарий", "Сумма, ₸", "Статус"]
+
+_ROWS_SQL = """
+SELECT i.id, i.start_time, i.end_time, m.name AS manager, r.name AS restaurant,
+       i.reason, i.comment, i.amount_kzt, i.status
+FROM incidents i
+JOIN restaurants r ON r.id = i.restaurant_id
+JOIN managers m    ON m.id = i.manager_id
+WHERE i.start_time >= $1 AND i.start_time < $2
+ORDER BY i.start_time, i.id;
+"""
+
+_executor: Optional[ProcessPoolExecutor] = None
+_file_ids: Dict[str, str] = {}
+
+
+def shutdown():
+    global _executor
+    if _executor:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+def _pool() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=RENDER_WORKERS)
+    return _executor
+
+
+# ---- кэш готовых файлов: (период, фильтры, версия данных, формат) -> Telegram file_id ----
+
+async def cache_key(period: str, fmt: str, manager_id: Optional[int] = None,
+                    restaurant_id: Optional[int] = None) -> str:
+    d1, d2 = reports.period_bounds(period)
+    # версия данных — агрегаты роллапа за период: меняются при любой вставке/закрытии
+    t = await reports.totals(d1, d2, manager_id, restaurant_id)
+    raw = (f"{d1}|{d2}|{manager_id}|{restaurant_id}|{fmt}|"
+           f"{t['incidents']}|{t['closed']}|{t['amount_kzt']}|{t['duration_sec']}")
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+async def get_cached_file_id(key: str) -> Optional[str]:
+    file_id = _file_ids.get(key)
+    if file_id:
+        return file_id
+    async with db.read_conn() as c:
+        file_id = await c.fetchval("SELECT file_id FROM report_file_cache WHERE cache_key=$1;", key)
+    if file_id:
+        _file_ids[key] = file_id
+    return file_id
+
+
+async def store_file_id(key: str, file_id: str):
+    _file_ids[key] = file_id
+    async with db.conn() as c:
+        await c.execute(
+            "INSERT INTO report_file_cache (cache_key, file_id) VALUES ($1, $2) "
+            "ON CONFLICT (cache_key) DO UPDATE SET file_id=EXCLUDED.file_id, created_at=now();",
+            key, file_id,
+        )
+
+
+# ---- выгрузка и рендер ----
+
+async def _spool_rows(period: str, path: str):
+    """Стримит строки курсором asyncpg во временный CSV, не держа выборку в памяти."""
+    tz = pytz.timezone(db.REPORT_TZ)
+    d1, d2 = reports.period_bounds(period)
+    ts_from = tz.localize(dt.datetime.combine(d1, dt.time()))
+    ts_to = tz.localize(dt.datetime.combine(d2 + dt.timedelta(days=1), dt.time()))
+    loop = asyncio.get_running_loop()
+
+    def row(rec) -> list:
+        return [
+            rec["id"],
+            rec["start_time"].astimezone(tz).strftime("%d.%m.%Y %H:%M"),
+            rec["end_time"].astimezone(tz).strftime("%d.%m.%Y %H:%M") if rec["end_time"] else "",
+            rec["manager"], rec["restaurant"], rec["reason"],
+            rec["comment"] or "", rec["amount_kzt"], rec["status"],
+        ]
+
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(HEADER)
+        async with db.read_conn() as c:
+            # архивные месяцы старше живых секций — идут первыми, порядок сохраняется
+            async for archived in partitions.read_archived(c, ts_from, ts_to, CURSOR_PREFETCH):
+                await loop.run_in_executor(None, writer.writerows, [row(r) for r in archived])
+            batch = []
+            async with c.transaction():
+                async for rec in c.cursor(_ROWS_SQL, ts_from, ts_to, prefetch=CURSOR_PREFETCH):
+                    batch.append(row(rec))
+                    if len(batch) >= CURSOR_PREFETCH:
+                        await loop.run_in_executor(None, writer.writerows, batch)
+                        batch = []
+        if batch:
+            await loop.run_in_executor(None, writer.writerows, batch)
+
+
+def _render_xlsx(src: str, dst: str, title: str):
+    from openpyxl import Workbook
+
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(title[:31])
+    with open(src, newline="", encoding="utf-8") as f:
+        for n, row in enumerate(csv.reader(f)):
+            if n and row[0].isdigit():
+                row[0] = int(row[0])
+                row[7] = int(row[7]) if row[7] else None
+            ws.append(row)
+    wb.save(dst)
+
+
+def _render_pdf(src: str, dst: str, title: str, font_path: str):
+    from reportlab.lib import colors
+    from reportlab.lib.pagesizes import A4, landscape
+    from reportlab.lib.styles import getSampleStyleSheet
+    from reportlab.pdfbase import pdfmetrics
+    from reportlab.pdfbase.ttfonts import TTFont
+    from reportlab.platypus import LongTable, Paragraph, SimpleDocTemplate, TableStyle
+
+    font = "Helvetica"
+    if os.path.exists(font_path):
+        pdfmetrics.registerFont(TTFont("ReportFont", font_path))
+        font = "ReportFont"
+
+    with open(src, newline="", encoding="utf-8") as f:
+        rows = [row[:6] + [row[7], row[8]] for row in csv.reader(f)]  # без комментария
+
+    style = getSampleStyleSheet()["Title"]
+    style.fontName = font
+    table = LongTable(rows, repeatRows=1)
+    table.setStyle(TableStyle([
+        ("FONTNAME", (0, 0), (-1, -1), font),
+        ("FONTSIZE", (0, 0), (-1, -1), 8),
+        ("BACKGROUND", (0, 0), (-1, 0), colors.lightgrey),
+        ("GRID", (0, 0), (-1, -1), 0.25, colors.grey),
+    ]))
+    doc = SimpleDocTemplate(dst, pagesize=landscape(A4), title=title)
+    doc.build([Paragraph(title, style), table])
+
+
+async def render(period: str, fmt: str) -> Tuple[str, str]:
+    """Готовит файл отчёта; возвращает (путь, имя файла). Путь удаляет вызывающий."""
+    d1, d2 = reports.period_bounds(period)
+    title = f"Потери {d1.strftime('%d.%m.%Y')}-{d2.strftime('%d.%m.%Y')}"
+    filename = f"losses_{d1.isoformat()}_{d2.isoformat()}.{fmt}"
+
+    if fmt not in ("csv", "xlsx", "pdf"):
+        raise ValueError(f"unknown format: {fmt}")
+    fd, spool = tempfile.mkstemp(suffix=".csv")
+    os.close(fd)
+    out = None
+    try:
+        await _spool_rows(period, spool)
+        if fmt == "csv":
+            return spool, filename
+        fd, out = tempfile.mkstemp(suffix=f".{fmt}")
+        os.close(fd)
+        loop = asyncio.get_running_loop()
+        if fmt == "xlsx":
+            await loop.run_in_executor(_pool(), _render_xlsx, spool, out, title)
+        else:
+            await loop.run_in_executor(_pool(), _render_pdf, spool, out, title, PDF_FONT)
+        os.unlink(spool)
+        return out, filename
+    except BaseException:
+        for path in (spool, out):
+            if path and os.path.exists(path):
+                os.unlink(path)
+        raise
@@ -0,0 +1,135 @@
+# reports.py
+import datetime as dt
+import logging
+from typing import List, Optional, Tuple
+
+import asyncpg
+import pytz
+
+import db
+import metrics
+import partitions
+
+logger = logging.getLogger(__name__)
+
+PERIODS = [
+    ("Сегодня", "today"),
+    ("7 дней", "week"),
+    ("Месяц", "month"),
+    ("Год", "year"),
+]
+
+# измерение разбивки -> (колонка роллапа, join для названия)
+_DIMENSIONS = {
+    "reason":     ("r.reason",        "r.reason",  ""),
+    "restaurant": ("r.restaurant_id", "rs.name",   "JOIN restaurants rs ON rs.id = r.restaurant_id"),
+    "manager":    ("r.manager_id",    "m.name",    "JOIN managers m ON m.id = r.manager_id"),
+}
+
+_REBUILD_SQL = """
+INSERT INTO incident_rollup_daily
+    (day, manager_id, restaurant_id, reason, incidents, closed, amount_kzt, duration_sec)
+SELECT (start_time AT TIME ZONE $1)::date, manager_id, restaurant_id, reason,
+       count(*),
+       count(*) FILTER (WHERE status = 'closed'),
+       COALESCE(sum(amount_kzt), 0),
+       COALESCE(sum(GREATEST(0, EXTRACT(EPOCH FROM end_time - start_time)))
+                FILTER (WHERE status = 'closed' AND end_time IS NOT NULL), 0)::bigint
+FROM incidents
+WHERE $2::timestamptz IS NULL OR start_time >= $2
+GROUP BY 1, 2, 3, 4;
+"""
+
+
+async def setup():
+    """Заполняет роллапы, если они пустые, а инциденты уже есть (таблица — миграция 0003)."""
+    async with db.conn() as c:
+        empty = await c.fetchval("SELECT NOT EXISTS (SELECT 1 FROM incident_rollup_daily);")
+        if empty and await c.fetchval("SELECT EXISTS (SELECT 1 FROM incidents);"):
+            logger.info("incident_rollup_daily is empty, backfilling from incidents")
+            await _rebuild(c)
+
+
+async def rebuild_rollups():
+    """Пересчёт роллапов из incidents (после ручных правок в БД); архивные месяцы не трогаются."""
+    async with db.conn() as c:
+        await _rebuild(c)
+
+
+async def _rebuild(c: asyncpg.Connection):
+    await db.unbounded(c)
+    async with c.transaction():
+        await c.execute("LOCK TABLE incidents IN SHARE MODE;")
+        # строк архивных секций в incidents нет — их роллапы остаются как были
+        horizon = await partitions.archived_before(c)
+        if horizon is None:
+            await c.execute("TRUNCATE incident_rollup_daily;")
+        else:
+            await c.execute("DELETE FROM incident_rollup_daily WHERE day >= ($1::timestamptz AT TIME ZONE $2)::date;",
+                            horizon, db.REPORT_TZ)
+        await c.execute(_REBUILD_SQL, db.REPORT_TZ, horizon)
+
+
+def period_bounds(period: str, today: Optional[dt.date] = None) -> Tuple[dt.date, dt.date]:
+    """Границы периода [from, to] включительно, в днях часового пояса TZ."""
+    today = today or dt.datetime.now(dt.timezone.utc).astimezone(pytz.timezone(db.REPORT_TZ)).date()
+    if period == "today":
+        return today, today
+    if period == "week":
+        return today - dt.timedelta(days=6), today
+    if period == "month":
+        return today.replace(day=1), today
+    if period == "year":
+        return today.replace(month=1, day=1), today
+    raise ValueError(f"unknown period: {period}")
+
+
+def _filters(manager_id: Optional[int], restaurant_id: Optional[int], args: list) -> str:
+    sql = ""
+    if manager_id is not None:
+        args.append(manager_id)
+        sql += f" AND r.manager_id = ${len(args)}"
+    if restaurant_id is not None:
+        args.append(restaurant_id)
+        sql += f" AND r.restaurant_id = ${len(args)}"
+    return sql
+
+
+@metrics.timed_query("report_totals")
+async def totals(date_from: dt.date, date_to: dt.date, manager_id: Optional[int] = None,
+                 restaurant_id: Optional[int] = None) -> asyncpg.Record:
+    args: list = [date_from, date_to]
+    q = f"""
+    SELECT COALESCE(sum(r.incidents), 0)    AS incidents,
+           COALESCE(sum(r.closed), 0)       AS closed,
+           COALESCE(sum(r.amount_kzt), 0)   AS amount_kzt,
+           COALESCE(sum(r.duration_sec), 0) AS duration_sec
+    FROM incident_rollup_daily r
+    WHERE r.day BETWEEN $1 AND $2{_filters(manager_id, restaurant_id, args)};
+    """
+    async with db.read_conn() as c:
+        return await c.fetchrow(q, *args)
+
+
+@metrics.timed_query("report_breakdown")
+async def breakdown(dimension: str, date_from: dt.date, date_to: dt.date,
+                    manager_id: Optional[int] = None, restaurant_id: Optional[int] = None,
+                    limit: int = 20) -> List[asyncpg.Record]:
+    """Разбивка по reason / restaurant / manager, по убыванию суммы потерь."""
+    key, label, join = _DIMENSIONS[dimension]
+    args: list = [date_from, date_to]
+    where = _filters(manager_id, restaurant_id, args)
+    args.append(limit)
+    q = f"""
+    SELECT {key} AS key, {label} AS label,
+           sum(r.incidents) AS incidents, sum(r.closed) AS closed,
+           sum(r.amount_kzt) AS amount_kzt, sum(r.duration_sec) AS duration_sec
+    FROM incident_rollup_daily r
+    {join}
+    WHERE r.day BETWEEN $1 AND $2{where}
+    GROUP BY 1, 2
+    ORDER BY amount_kzt DESC, label
+    LIMIT ${len(args)};
+    """
+    async with db.read_conn() as c:
+        return await c.fetch(q, *args)
@@ -0,0 +1,216 @@
+# scheduler.py
+import os
+import time
+import asyncio
+import logging
+import datetime as dt
+from typing import Any, Callable, Dict, List, Optional
+
+import pytz
+from aiogram import Bot
+
+import db
+import partitions
+import reports
+
+logger = logging.getLogger(__name__)
+
+# через сколько часов после начала напоминать об открытом инциденте
+AGING_ALERT_HOURS = [float(h) for h in os.getenv("AGING_ALERT_HOURS", "2,8,24").split(",") if h.strip()]
+# вечерняя сводка управляющим, время в TZ; пусто — не отправлять
+DIGEST_TIME = os.getenv("DIGEST_TIME", "21:00")
+# куда слать, если у управляющего не задан managers.tg_chat_id
+ALERT_CHAT_ID = int(os.getenv("ALERT_CHAT_ID", "0")) or None
+# секции incidents на месяцы вперёд и архив старых (partitions.py), время в TZ
+PARTITION_MAINTENANCE_TIME = os.getenv("PARTITION_MAINTENANCE_TIME", "03:30")
+
+
+class Timer:
+    __slots__ = ("deadline", "rounds", "callback", "cancelled")
+
+    def __init__(self, deadline: float, rounds: int, callback: Callable[[], Any]):
+        self.deadline = deadline
+        self.rounds = rounds
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TimerWheel:
+    """Хешированное колесо таймеров: O(1) на добавление/отмену, на тик — один слот.
+
+    slots * tick — один оборот; более дальние дедлайны ждут нужное число оборотов.
+    """
+
+    def __init__(self, tick: float = 60.0, slots: int = 1440):
+        self.tick = tick
+        self.slots: List[List[Timer]] = [[] for _ in range(slots)]
+        self.current = int(time.time() // tick)
+
+    def add(self, deadline: float, callback: Callable[[], Any]) -> Timer:
+        tick_no = max(int(deadline // self.tick), self.current + 1)
+        rounds = (tick_no - self.current - 1) // len(self.slots)
+        timer = Timer(deadline, rounds, callback)
+        self.slots[tick_no % len(self.slots)].append(timer)
+        return timer
+
+    def advance(self, now: float) -> List[Timer]:
+        """Прокручивает колесо до now; возвращает сработавшие таймеры."""
+        due: List[Timer] = []
+        target = int(now // self.tick)
+        while self.current < target:
+            self.current += 1
+            slot = self.slots[self.current % len(self.slots)]
+            keep = []
+            for timer in slot:
+                if timer.cancelled:
+                    continue
+                if timer.rounds > 0:
+                    timer.rounds -= 1
+                    keep.append(timer)
+                else:
+                    due.append(timer)
+            self.slots[self.current % len(self.slots)] = keep
+        return due
+
+
+class IncidentScheduler:
+    """Напоминания об «зависших» открытых инцидентах и вечерняя сводка потерь.
+
+    Открытые инциденты читаются один раз при старте; дальше колесо обновляется по
+    событиям db.INCIDENT_CHANNEL (insert/close из любого инстанса). Запускать его
+    стоит в одном инстансе (SCHEDULER_ENABLED=1), иначе напоминания задвоятся.
+    """
+
+    def __init__(self, bot: Bot, tick: float = 60.0):
+        self.bot = bot
+        self.wheel = TimerWheel(tick=tick)
+        self.tz = pytz.timezone(db.REPORT_TZ)
+        self._timers: Dict[int, List[Timer]] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._reload_task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        db.add_incident_listener(self._on_event)
+        await self._load()
+        self._schedule_digest()
+        self._schedule_maintenance()
+        self._task = asyncio.create_task(self._run(), name="incident-scheduler")
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    # ---- наполнение колеса ----
+
+    async def _load(self):
+        for timers in self._timers.values():
+            for t in timers:
+                t.cancel()
+        self._timers.clear()
+        rows = await db.list_open_incidents()
+        for r in rows:
+            self._schedule_incident(r["id"], r["start_time"].timestamp())
+        logger.info("scheduler: %d open incidents loaded", len(rows))
+
+    def _schedule_incident(self, incident_id: int, start_ts: float):
+        now = time.time()
+        timers = []
+        for hours in AGING_ALERT_HOURS:
+            deadline = start_ts + hours * 3600
+            if deadline > now:
+                timers.append(self.wheel.add(deadline, lambda i=incident_id, h=hours: self._aging_alert(i, h)))
+        if timers:
+            self._timers[incident_id] = timers
+
+    def _on_event(self, event: Dict[str, Any]):
+        op = event.get("op")
+        if op == "insert" and event.get("status") == "open":
+            self._schedule_incident(event["id"], event["start_time"])
+        elif op == "close":
+            for t in self._timers.pop(event["id"], []):
+                t.cancel()
+        elif op == "reload" and (self._reload_task is None or self._reload_task.done()):
+            self._reload_task = asyncio.create_task(self._load())
+
+    def _schedule_daily(self, hhmm: str, callback: Callable[[], Any]):
+        if not hhmm:
+            return
+        hh, mm = (int(x) for x in hhmm.split(":"))
+        now = dt.datetime.now(self.tz)
+        at = self.tz.localize(dt.datetime.combine(now.date(), dt.time(hh, mm)))
+        if at <= now:
+            at = self.tz.localize(dt.datetime.combine(now.date() + dt.timedelta(days=1), dt.time(hh, mm)))
+        self.wheel.add(at.timestamp(), callback)
+
+    def _schedule_digest(self):
+        self._schedule_daily(DIGEST_TIME, self._daily_digest)
+
+    def _schedule_maintenance(self):
+        self._schedule_daily(PARTITION_MAINTENANCE_TIME, self._partition_maintenance)
+
+    # ---- цикл ----
+
+    async def _run(self):
+        while True:
+            now = time.time()
+            await asyncio.sleep(self.wheel.tick - now % self.wheel.tick + 0.01)
+            for timer in self.wheel.advance(time.time()):
+                try:
+                    await timer.callback()
+                except Exception:
+                    logger.exception("scheduler job failed")
+
+    # ---- задания ----
+
+    async def _chat_for(self, manager_id: int) -> Optional[int]:
+        for m in await db.get_managers():
+            if m["id"] == manager_id:
+                return m["tg_chat_id"] or ALERT_CHAT_ID
+        return ALERT_CHAT_ID
+
+    async def _aging_alert(self, incident_id: int, hours: float):
+        timers = self._timers.get(incident_id)
+        if timers and all(t.cancelled or t.deadline <= time.time() for t in timers):
+            self._timers.pop(incident_id, None)
+        inc = await db.get_incident(incident_id)
+        if inc is None or inc["status"] != "open":
+            return
+        chat_id = await self._chat_for(inc["manager_id"])
+        if chat_id is None:
+            return
+        await self.bot.send_message(
+            chat_id,
+            f"⏰ Инцидент #{incident_id} ({inc['restaurant']}) открыт уже {hours:g} ч. "
+            "Закройте его кнопкой «✅ Закрыть», когда проблема устранена.",
+        )
+
+    async def _partition_maintenance(self):
+        self._schedule_maintenance()
+        async with db.conn() as c:
+            await db.unbounded(c)
+            await partitions.ensure(c, db.REPORT_TZ)
+            await partitions.archive(c, db.REPORT_TZ)
+
+    async def _daily_digest(self):
+        self._schedule_digest()
+        today = dt.datetime.now(self.tz).date()
+        rows = await reports.breakdown("manager", today, today, limit=1000)
+        for r in rows:
+            chat_id = await self._chat_for(r["key"])
+            if chat_id is None:
+                continue
+            amount = f"{int(r['amount_kzt']):,}".replace(",", " ")
+            try:
+                await self.bot.send_message(
+                    chat_id,
+                    f"<b>Итоги дня {today.strftime('%d.%m')}</b> — {r['label']}\n"
+                    f"Инцидентов: {r['incidents']} (закрыто {r['closed']})\n"
+                    f"Потери: {amount} ₸",
+                )
+            except Exception:
+                logger.exception("digest to chat %s failed", chat_id)
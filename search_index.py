@@ -0,0 +1,146 @@
+# search_index.py
+import re
+import asyncio
+import logging
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple
+
+import db
+
+logger = logging.getLogger(__name__)
+
+# Поиск управляющих и ресторанов для inline-режима целиком в памяти:
+# префиксы слов (для коротких запросов) + триграммы (опечатки, середина слова).
+# Источник — кэш справочников db.py; при смене db.ref_cache_version() индекс
+# сверяется с ним и меняет только добавленные/удалённые/переименованные записи.
+
+PREFIX_MAX = 12
+
+_WORD = re.compile(r"\w+")
+
+
+class Entry(NamedTuple):
+    key: Tuple[str, int, int]     # ("m", manager_id, 0) | ("r", manager_id, restaurant_id)
+    name: str                     # что ищем
+    subtitle: str                 # ТУ для ресторана
+
+
+def _norm(text: str) -> str:
+    return text.lower().replace("ё", "е")
+
+
+def _trigrams(text: str) -> Set[str]:
+    grams: Set[str] = set()
+    for word in _WORD.findall(text):
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+class NameIndex:
+    def __init__(self):
+        self.entries: Dict[tuple, Entry] = {}
+        self._prefix: Dict[str, Set[tuple]] = {}
+        self._grams: Dict[str, Set[tuple]] = {}
+        self._version: Optional[int] = None
+        self._lock = asyncio.Lock()
+
+    # ---- наполнение ----
+
+    def _add(self, entry: Entry):
+        self.entries[entry.key] = entry
+        text = _norm(entry.name)
+        for word in _WORD.findall(text):
+            for i in range(1, min(len(word), PREFIX_MAX) + 1):
+                self._prefix.setdefault(word[:i], set()).add(entry.key)
+        for g in _trigrams(text):
+            self._grams.setdefault(g, set()).add(entry.key)
+
+    def _remove(self, key: tuple):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        text = _norm(entry.name)
+        for word in _WORD.findall(text):
+            for i in range(1, min(len(word), PREFIX_MAX) + 1):
+                keys = self._prefix.get(word[:i])
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del self._prefix[word[:i]]
+        for g in _trigrams(text):
+            keys = self._grams.get(g)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._grams[g]
+
+    def sync(self, entries: List[Entry]) -> Tuple[int, int]:
+        """Приводит индекс к entries, трогая только изменившиеся записи. (добавлено, удалено)."""
+        fresh = {e.key: e for e in entries}
+        removed = [k for k, e in self.entries.items() if fresh.get(k) != e]
+        for k in removed:
+            self._remove(k)
+        added = [e for k, e in fresh.items() if k not in self.entries]
+        for e in added:
+            self._add(e)
+        return len(added), len(removed)
+
+    async def refresh(self):
+        """Сверка с кэшем справочников, если тот сменился с прошлой сверки."""
+        if self._version == db.ref_cache_version():
+            return
+        async with self._lock:
+            version = db.ref_cache_version()
+            if self._version == version:
+                return
+            managers = await db.get_managers()
+            names = {m["id"]: m["name"] for m in managers}
+            entries = [Entry(("m", m["id"], 0), m["name"], "") for m in managers]
+            for m in managers:
+                for r in await db.get_restaurants_for_manager(m["id"]):
+                    entries.append(Entry(("r", m["id"], r["id"]), r["name"], names[m["id"]]))
+            added, removed = self.sync(entries)
+            # загрузка сама меняет версию — запоминаем ту, что стала после неё
+            self._version = db.ref_cache_version()
+            if added or removed:
+                logger.info("search index: +%d -%d, %d entries", added, removed, len(self.entries))
+
+    # ---- поиск ----
+
+    def search(self, query: str, limit: int = 20) -> List[Entry]:
+        words = _WORD.findall(_norm(query))
+        if not words:
+            return sorted(self.entries.values(), key=lambda e: (e.key[0] != "m", e.name))[:limit]
+
+        # все слова запроса — префиксы слов имени
+        hits: Optional[Set[tuple]] = None
+        for w in words:
+            keys = self._prefix.get(w[:PREFIX_MAX], set())
+            hits = set(keys) if hits is None else hits & keys
+            if not hits:
+                break
+        scored: Dict[tuple, float] = {k: 2.0 for k in hits or ()}
+
+        # доращиваем триграммами: опечатки и совпадения в середине слова
+        if len(scored) < limit and sum(len(w) for w in words) >= 3:
+            grams = _trigrams(" ".join(words))
+            counts: Dict[tuple, int] = {}
+            for g in grams:
+                for k in self._grams.get(g, ()):
+                    counts[k] = counts.get(k, 0) + 1
+            for k, n in counts.items():
+                score = n / len(grams)
+                if score >= 0.3 and k not in scored:
+                    scored[k] = score
+
+        best = sorted(scored, key=lambda k: (-scored[k], self.entries[k].key[0] != "m",
+                                             self.entries[k].name))
+        return [self.entries[k] for k in best[:limit]]
+
+
+INDEX = NameIndex()
+
+
+async def lookup(query: str, limit: int = 20) -> List[Entry]:
+    await INDEX.refresh()
+    return INDEX.search(query, limit)
@@ -1,36 +1,192 @@
+import startup
 import os
+import asyncio
 import logging
-from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import JSONResponse
 
-from aiogram import Bot, Dispatcher
-from aiogram.enums import ParseMode
-from aiogram.types import Update
-from aiogram.client.default import DefaultBotProperties
+import logs
+logs.setup()
 
-from bot import router
-import db
+with startup.phase("import:fastapi"):
+    from fastapi import FastAPI, Request, HTTPException
+    from fastapi.responses import JSONResponse, Response
+
+with startup.phase("import:aiogram"):
+    from aiogram import Bot, Dispatcher
+    from aiogram.enums import ParseMode
+    from aiogram.types import Update
+    from aiogram.client.default import DefaultBotProperties
+
+with startup.phase("import:bot"):
+    from bot import router, BUSY_TEXT
+    import reports
+    import report_render
+    import db
+    import metrics
+    import search_index
+    from rate_limit import RateLimitMiddleware
+    from dedup import UpdateDeduplicator
+    from update_queue import update_chat_id
+
+# модули опциональных режимов (queue, postgres FSM, webhook reply, планировщик)
+# импортируются ниже, только если режим включён
 
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 if not BOT_TOKEN:
     raise RuntimeError("BOT_TOKEN is not set")
 
-bot = Bot(BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-dp = Dispatcher()
+# Bot() не ходит в сеть: aiohttp-сессия создаётся при первом запросе
+with startup.phase("bot_init"):
+    bot = Bot(BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+bot.session.middleware(metrics.TelegramApiMetricsMiddleware())
+
+# WEBHOOK_REPLY=1 — последний вызов Bot API за апдейт уходит телом ответа вебхука
+# (только в режиме inline: в режиме queue ответ уже отправлен до обработки)
+WEBHOOK_REPLY = os.getenv("WEBHOOK_REPLY", "0") == "1"
+if WEBHOOK_REPLY:
+    import webhook_reply
+    bot.session.middleware(webhook_reply.DeferredCallsMiddleware())
+
+# лимиты исходящих вызовов: общий ~30 rps, в один чат ~1 сообщение в секунду
+if os.getenv("TG_RATE_LIMIT", "1") == "1":
+    bot.session.middleware(RateLimitMiddleware(
+        global_rate=float(os.getenv("TG_GLOBAL_RPS", "30")),
+        global_burst=float(os.getenv("TG_GLOBAL_BURST", "30")),
+        chat_rate=float(os.getenv("TG_CHAT_RPS", "1")),
+        chat_burst=float(os.getenv("TG_CHAT_BURST", "3")),
+        max_retries=int(os.getenv("TG_MAX_RETRIES", "3")),
+    ))
+
+# FSM_STORAGE=postgres — состояние визардов в БД, можно запускать несколько воркеров
+FSM_STORAGE = os.getenv("FSM_STORAGE", "memory")
+FSM_CACHE_TTL = float(os.getenv("FSM_CACHE_TTL", "0"))
+
+fsm_storage = None
+if FSM_STORAGE == "postgres":
+    from fsm_storage import PostgresStorage, FSMFlushMiddleware
+    fsm_storage = PostgresStorage(cache_ttl=FSM_CACHE_TTL)
+    dp = Dispatcher(storage=fsm_storage)
+    dp.update.outer_middleware(FSMFlushMiddleware(fsm_storage))
+else:
+    dp = Dispatcher()
+router.message.middleware(metrics.HandlerMetricsMiddleware())
+router.callback_query.middleware(metrics.HandlerMetricsMiddleware())
 dp.include_router(router)
 
+# WEBHOOK_MODE=queue — вебхук сразу отвечает 200, апдейт обрабатывают воркеры
+WEBHOOK_MODE = os.getenv("WEBHOOK_MODE", "inline")
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "8"))
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", "1000"))
+UPDATE_QUEUE_PUT_TIMEOUT = float(os.getenv("UPDATE_QUEUE_PUT_TIMEOUT", "5"))
+
+# Перегрузка: в режиме inline в обработке не больше MAX_INFLIGHT_UPDATES апдейтов —
+# сверх этого (и при разомкнутой цепи БД) вебхук сразу отвечает «Сервис занят» телом
+# ответа, без вызова Bot API. В режиме queue предел — сама очередь: UPDATE_QUEUE_SIZE
+# и UPDATE_QUEUE_PUT_TIMEOUT, после которого 503 и повторная доставка от Telegram.
+MAX_INFLIGHT_UPDATES = int(os.getenv("MAX_INFLIGHT_UPDATES", "64"))
+_inflight = 0
+
+async def process_update(update: Update):
+    global _inflight
+    chat_id = update_chat_id(update)
+    _inflight += 1
+    try:
+        with db.chat_scope(chat_id), logs.update_context(update_id=update.update_id, chat=chat_id):
+            async with metrics.track_update():
+                await dp.feed_update(bot, update)
+    finally:
+        _inflight -= 1
+
+update_queue = None
+
+# напоминания и сводки — ровно в одном инстансе
+SCHEDULER_ENABLED = os.getenv("SCHEDULER_ENABLED", "0") == "1"
+scheduler = None
+
+# STARTUP_BACKGROUND=1 — порт открывается сразу, пул/прогрев идут в фоне;
+# вебхук ждёт готовности не дольше READY_WAIT_TIMEOUT секунд
+STARTUP_BACKGROUND = os.getenv("STARTUP_BACKGROUND", "0") == "1"
+READY_WAIT_TIMEOUT = float(os.getenv("READY_WAIT_TIMEOUT", "20"))
+_ready = asyncio.Event()
+_startup_task: asyncio.Task | None = None
+
+# повторные доставки апдейта (Telegram ретраит медленные ответы вебхука)
+dedup = UpdateDeduplicator(
+    bot_id=bot.id,
+    lru_size=int(os.getenv("DEDUP_LRU_SIZE", "10000")),
+    use_db=os.getenv("DEDUP_DB", "1") == "1",
+)
+
 app = FastAPI(title="SalesLossTracker 2.0 Bot")
+startup.mark("import_total")
+
+async def _check_bot():
+    me = await bot.get_me()
+    logger.info("bot @%s is reachable", me.username)
+
+async def _warm_up():
+    """Пул + прогрев и getMe параллельно, затем фоновые сервисы."""
+    global update_queue, scheduler
+
+    async def pool_and_warmup():
+        with startup.phase("db_pool"):
+            await db.init_pool()
+        with startup.phase("db_warmup"):
+            await db.warmup()
+            await search_index.INDEX.refresh()
+        logger.info("DB pool initialized")
+
+    async def telegram():
+        with startup.phase("telegram_getme"):
+            try:
+                await _check_bot()
+            except Exception:
+                logger.exception("getMe failed")
+
+    with startup.phase("startup_total"):
+        await asyncio.gather(pool_and_warmup(), telegram())
+        with startup.phase("rollup_backfill"):
+            await reports.setup()
+        if WEBHOOK_MODE == "queue":
+            from update_queue import UpdateQueue
+            update_queue = UpdateQueue(process_update, workers=UPDATE_WORKERS,
+                                       maxsize=UPDATE_QUEUE_SIZE,
+                                       put_timeout=UPDATE_QUEUE_PUT_TIMEOUT)
+            update_queue.start()
+        if SCHEDULER_ENABLED:
+            from scheduler import IncidentScheduler
+            scheduler = IncidentScheduler(bot)
+            await scheduler.start()
+    startup.mark("ready_since_import")
+    _ready.set()
+    logger.info("ready, startup timings (ms): %s", startup.TIMINGS)
 
 @app.on_event("startup")
 async def _startup():
-    await db.init_pool()
-    logger.info("DB pool initialized")
+    global _startup_task
+    if STARTUP_BACKGROUND:
+        _startup_task = asyncio.create_task(_warm_up())
+        _startup_task.add_done_callback(
+            lambda t: t.cancelled() or t.exception() is None
+            or logger.error("background startup failed", exc_info=t.exception())
+        )
+    else:
+        await _warm_up()
 
 @app.on_event("shutdown")
 async def _shutdown():
+    global update_queue, scheduler
+    if _startup_task and not _startup_task.done():
+        _startup_task.cancel()
+    if scheduler:
+        await scheduler.stop()
+        scheduler = None
+    if update_queue:
+        await update_queue.stop()
+        update_queue = None
+    report_render.shutdown()
+    await dp.storage.close()
     await db.close_pool()
     logger.info("DB pool closed")
 
@@ -38,6 +194,50 @@ async def _shutdown():
 async def root():
     return {"status": "ok", "service": "SalesLossTracker_2.0"}
 
+@app.get("/ready")
+async def ready():
+    """Готовность: пул поднят, прогрев и getMe прошли. "/" — только liveness."""
+    body = {"ready": _ready.is_set(), "timings_ms": startup.TIMINGS}
+    return JSONResponse(body, status_code=200 if _ready.is_set() else 503)
+
+@app.get("/health/db")
+async def health_db():
+    """Насыщенность пулов, ожидание соединения, цепь БД и загрузка апдейтами; 503 — цепь разомкнута."""
+    pools = db.health()
+    body = {
+        "pools": pools,
+        "updates_in_flight": _inflight,
+        "updates_queued": update_queue.size if update_queue else 0,
+        "max_inflight_updates": None if update_queue else MAX_INFLIGHT_UPDATES,
+        "queue_capacity": UPDATE_QUEUE_SIZE if update_queue else None,
+    }
+    healthy = _ready.is_set() and not any(db.circuit_open(name) for name in pools)
+    return JSONResponse(body, status_code=200 if healthy else 503)
+
+def _overloaded() -> bool:
+    # в режиме queue воркеров UPDATE_WORKERS, а ожидание решает put_timeout очереди
+    return update_queue is None and _inflight >= MAX_INFLIGHT_UPDATES
+
+def _shed(update: Update, reason: str) -> JSONResponse:
+    """Ответ «Сервис занят» методом в теле ответа вебхука; апдейт не обрабатывается."""
+    metrics.UPDATES_SHED.labels(reason).inc()
+    logger.warning("update %s shed: %s", update.update_id, reason)
+    if update.callback_query:
+        return JSONResponse({"method": "answerCallbackQuery", "callback_query_id": update.callback_query.id,
+                             "text": BUSY_TEXT, "show_alert": True})
+    if update.message:
+        return JSONResponse({"method": "sendMessage", "chat_id": update.message.chat.id, "text": BUSY_TEXT})
+    return JSONResponse({"ok": True})
+
+@metrics.on_scrape
+def _queue_gauge():
+    metrics.UPDATE_QUEUE_SIZE.set(update_queue.size if update_queue else 0)
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    body, content_type = metrics.render()
+    return Response(content=body, media_type=content_type)
+
 @app.post(f"/webhook/{BOT_TOKEN}")
 async def telegram_webhook(request: Request):
     try:
@@ -46,15 +246,45 @@ async def telegram_webhook(request: Request):
         logger.exception("bad json")
         raise HTTPException(status_code=400, detail=str(e))
 
-    logger.info("server:Update JSON: %s", str(data)[:800])
+    logs.log_payload(data)
     try:
         update = Update.model_validate(data)
     except Exception as e:
         logger.exception("update validate error")
         raise HTTPException(status_code=422, detail=str(e))
 
+    if not _ready.is_set():
+        try:
+            await asyncio.wait_for(_ready.wait(), READY_WAIT_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=503, detail="starting up")
+
+    if _overloaded():
+        return _shed(update, "inflight")
+    if db.circuit_open():
+        return _shed(update, "db_circuit")
+
+    try:
+        fresh = await dedup.claim(update.update_id)
+    except db.DBUnavailable:
+        return _shed(update, "db_unavailable")
+    if not fresh:
+        logger.info("duplicate update %s skipped", update.update_id)
+        return JSONResponse({"ok": True})
+
+    if update_queue:
+        if not await update_queue.put(update):
+            await dedup.release(update.update_id)
+            raise HTTPException(status_code=503, detail="update queue is full")
+        return JSONResponse({"ok": True})
+
     try:
-        await dp.feed_update(bot, update)
+        if WEBHOOK_REPLY:
+            reply = await webhook_reply.run(bot, lambda: process_update(update))
+            if reply is not None:
+                return JSONResponse(reply)
+        else:
+            await process_update(update)
     except Exception:
         logger.exception("handler failed")
 
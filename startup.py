@@ -0,0 +1,24 @@
+# startup.py
+import time
+from contextlib import contextmanager
+from typing import Dict
+
+# момент импорта этого модуля — первым делом в server.py
+PROCESS_T0 = time.perf_counter()
+
+# фаза -> длительность, мс (порядок вставки = порядок фаз)
+TIMINGS: Dict[str, float] = {}
+
+
+@contextmanager
+def phase(name: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        TIMINGS[name] = round((time.perf_counter() - started) * 1000, 1)
+
+
+def mark(name: str):
+    """Время от импорта startup.py до текущего момента."""
+    TIMINGS[name] = round((time.perf_counter() - PROCESS_T0) * 1000, 1)
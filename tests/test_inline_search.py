@@ -0,0 +1,25 @@
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("aiogram")
+pytest.importorskip("asyncpg")
+
+import bot
+from search_index import Entry
+
+
+@pytest.mark.parametrize("entry, expected", [
+    (Entry(("m", 5, 0), "Айгерим Садыкова", ""), ("m", "5", None)),
+    (Entry(("r", 3, 7), "KFC Достык", "Айгерим Садыкова"), ("r", "3", "7")),
+])
+def test_picked_inline_result_matches_tag_filter(entry, expected):
+    # текст, который Telegram присылает после выбора результата, — ровно message_text
+    _, _, text = bot._inline_message_text(entry)
+    tag = bot.INLINE_TAG.resolve(SimpleNamespace(text=text))
+    assert tag is not None
+    assert tag.groups() == expected
+
+
+def test_tag_filter_ignores_plain_text():
+    assert bot.INLINE_TAG.resolve(SimpleNamespace(text="🆕 Инцидент")) is None
@@ -0,0 +1,88 @@
+# update_queue.py
+import asyncio
+import logging
+from typing import Awaitable, Callable, List, Optional
+
+from aiogram.types import Update
+
+logger = logging.getLogger(__name__)
+
+Handler = Callable[[Update], Awaitable[None]]
+
+
+def update_chat_id(update: Update) -> Optional[int]:
+    """chat_id (или id пользователя), к которому относится апдейт — ключ порядка."""
+    try:
+        event = update.event
+    except Exception:  # неизвестный тип апдейта
+        return None
+    chat = getattr(event, "chat", None)
+    if chat is not None:
+        return chat.id
+    message = getattr(event, "message", None)  # CallbackQuery
+    if message is not None and getattr(message, "chat", None) is not None:
+        return message.chat.id
+    user = getattr(event, "from_user", None)
+    if user is not None:
+        return user.id
+    return None
+
+
+class UpdateQueue:
+    """Пул воркеров, разбирающих апдейты из ограниченных очередей.
+
+    Каждый чат закреплён за одним воркером (chat_id % workers), поэтому шаги FSM
+    одного пользователя обрабатываются строго по порядку, а разные чаты — параллельно.
+    Когда очередь шарда заполнена, put() ждёт до put_timeout и возвращает False —
+    вебхук отвечает ошибкой, и Telegram повторит доставку позже.
+    """
+
+    def __init__(self, handler: Handler, workers: int = 8, maxsize: int = 1000,
+                 put_timeout: float = 5.0):
+        self._handler = handler
+        self._workers = max(1, workers)
+        self._put_timeout = put_timeout
+        per_shard = max(1, maxsize // self._workers)
+        self._queues: List[asyncio.Queue] = [asyncio.Queue(per_shard) for _ in range(self._workers)]
+        self._tasks: List[asyncio.Task] = []
+
+    @property
+    def size(self) -> int:
+        return sum(q.qsize() for q in self._queues)
+
+    def start(self):
+        for n, q in enumerate(self._queues):
+            self._tasks.append(asyncio.create_task(self._worker(q), name=f"update-worker-{n}"))
+        logger.info("update queue started: %d workers", self._workers)
+
+    async def stop(self, drain_timeout: float = 10.0):
+        try:
+            await asyncio.wait_for(asyncio.gather(*(q.join() for q in self._queues)), drain_timeout)
+        except asyncio.TimeoutError:
+            logger.warning("update queue: %d updates dropped on shutdown", self.size)
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+
+    async def put(self, update: Update) -> bool:
+        key = update_chat_id(update)
+        if key is None:
+            key = update.update_id
+        q = self._queues[key % self._workers]
+        try:
+            await asyncio.wait_for(q.put(update), self._put_timeout)
+        except asyncio.TimeoutError:
+            logger.warning("update queue full, rejecting update %s", update.update_id)
+            return False
+        return True
+
+    async def _worker(self, q: asyncio.Queue):
+        while True:
+            update = await q.get()
+            try:
+                await self._handler(update)
+            except Exception:
+                logger.exception("handler failed")
+            finally:
+                q.task_done()
@@ -0,0 +1,105 @@
+# webhook_reply.py
+import asyncio
+import logging
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.methods import (
+    AnswerCallbackQuery, EditMessageReplyMarkup, EditMessageText, SendMessage, TelegramMethod,
+)
+from aiogram.types import Message
+
+logger = logging.getLogger(__name__)
+
+# Методы, результат которых хендлеры bot.py не используют: их можно отложить,
+# вернув хендлеру заглушку, и отправить последний из них ответом на вебхук.
+DEFERRABLE = (AnswerCallbackQuery, EditMessageText, EditMessageReplyMarkup, SendMessage)
+
+_Pending = Tuple[Callable, Bot, TelegramMethod]
+_pending: ContextVar[Optional[List[_Pending]]] = ContextVar("webhook_reply_pending", default=None)
+
+
+def _placeholder(method: TelegramMethod) -> Any:
+    if isinstance(method, SendMessage):
+        return Message.model_validate({
+            "message_id": 0, "date": 0,
+            "chat": {"id": method.chat_id if isinstance(method.chat_id, int) else 0, "type": "private"},
+            "text": method.text,
+        })
+    return True
+
+
+async def _issue(calls: List[_Pending]):
+    """Отправляет отложенные вызовы: внутри чата по порядку, разные чаты — параллельно."""
+    groups: Dict[Any, List[_Pending]] = {}
+    for call in calls:
+        key = getattr(call[2], "chat_id", None) or id(call)
+        groups.setdefault(key, []).append(call)
+
+    async def run_group(group: List[_Pending]):
+        for make_request, bot, method in group:
+            try:
+                await make_request(bot, method)
+            except Exception:
+                logger.exception("deferred %s failed", type(method).__name__)
+
+    await asyncio.gather(*(run_group(g) for g in groups.values()))
+
+
+class DeferredCallsMiddleware(BaseRequestMiddleware):
+    """Middleware сессии Bot: внутри run() откладывает DEFERRABLE-вызовы.
+
+    Любой другой вызов (нужен результат или есть файлы) сначала отправляет всё
+    отложенное по порядку, чтобы сообщения в чате не перепутались.
+    """
+
+    async def __call__(self, make_request, bot, method):
+        pending = _pending.get()
+        if pending is None:
+            return await make_request(bot, method)
+        if isinstance(method, DEFERRABLE):
+            pending.append((make_request, bot, method))
+            return _placeholder(method)
+        if pending:
+            calls = pending[:]
+            pending.clear()
+            for call in calls:
+                await call[0](call[1], call[2])
+        return await make_request(bot, method)
+
+
+def _as_webhook_body(bot: Bot, method: TelegramMethod) -> Optional[Dict[str, Any]]:
+    files: Dict[str, Any] = {}
+    body: Dict[str, Any] = {"method": method.__api_method__}
+    for key, value in method.model_dump(warnings=False).items():
+        prepared = bot.session.prepare_value(value, bot=bot, files=files)
+        if prepared is not None:
+            body[key] = prepared
+    return None if files else body
+
+
+async def run(bot: Bot, handler: Callable[[], Awaitable[None]]) -> Optional[Dict[str, Any]]:
+    """Выполняет handler; последний отложенный вызов возвращает телом ответа вебхука.
+
+    Остальные отложенные вызовы отправляются параллельно (с порядком внутри чата).
+    Ошибку метода, ушедшего в ответе вебхука, Telegram не сообщает — поэтому сюда
+    попадают только вызовы, результат которых хендлеры не проверяют.
+    """
+    pending: List[_Pending] = []
+    token = _pending.set(pending)
+    try:
+        await handler()
+    except BaseException:
+        # хендлер упал — ответа вебхуком не будет, отправляем всё обычным путём
+        await _issue(pending)
+        raise
+    finally:
+        _pending.reset(token)
+    if not pending:
+        return None
+    last = pending[-1]
+    reply = _as_webhook_body(last[1], last[2])
+    await _issue(pending[:-1] if reply is not None else pending)
+    return reply
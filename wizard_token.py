@@ -0,0 +1,62 @@
+# wizard_token.py
+import os
+import hmac
+import base64
+import struct
+import hashlib
+import datetime as dt
+from typing import NamedTuple, Optional
+
+# Поля визарда инцидента в callback_data (лимит Telegram — 64 байта):
+# 23 байта полей + 8 байт HMAC-SHA256 -> 42 символа base64url, с префиксом "w:" — 44.
+# Подпись не даёт подставить чужие manager/restaurant/сумму руками.
+
+# шаг = что уже выбрано (и какой экран показать следующим)
+(S_START, S_MANAGER, S_RESTAURANT, S_DAY, S_HOUR, S_MINUTE, S_END, S_REASON, S_COMMENT,
+ S_AMOUNT, S_CONFIRM) = range(11)
+
+_FMT = struct.Struct(">BIIHBBBBQ")
+_SIG_LEN = 8
+_EPOCH = dt.date(1970, 1, 1)
+
+_SECRET = (os.getenv("WIZARD_SECRET") or os.getenv("BOT_TOKEN") or "").encode()
+_KEY = hashlib.sha256(b"wizard-token:" + _SECRET).digest()
+
+
+class WizardData(NamedTuple):
+    step: int = S_START
+    manager_id: int = 0
+    restaurant_id: int = 0
+    day: Optional[dt.date] = None
+    start_hour: int = 0
+    start_minute: int = 0
+    end_now: bool = False
+    reason: int = 0          # индекс в bot.REASONS
+    amount: int = 0
+
+
+def _sign(raw: bytes) -> bytes:
+    return hmac.new(_KEY, raw, hashlib.sha256).digest()[:_SIG_LEN]
+
+
+def pack(d: WizardData) -> str:
+    raw = _FMT.pack(
+        d.step, d.manager_id, d.restaurant_id,
+        (d.day - _EPOCH).days if d.day else 0,
+        d.start_hour, d.start_minute, int(d.end_now), d.reason, d.amount,
+    )
+    return base64.urlsafe_b64encode(raw + _sign(raw)).rstrip(b"=").decode()
+
+
+def unpack(token: str) -> Optional[WizardData]:
+    """WizardData или None, если токен битый или подпись не сошлась."""
+    try:
+        blob = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+    except ValueError:
+        return None
+    raw, sig = blob[:-_SIG_LEN], blob[-_SIG_LEN:]
+    if len(raw) != _FMT.size or not hmac.compare_digest(sig, _sign(raw)):
+        return None
+    step, m, r, days, h, mi, end_now, reason, amount = _FMT.unpack(raw)
+    return WizardData(step, m, r, _EPOCH + dt.timedelta(days=days) if days else None,
+                      h, mi, bool(end_now), reason, amount)
@@ -0,0 +1,102 @@
+# write_behind.py
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, List, Optional, Sequence, Tuple
+
+import asyncpg
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# сбой самой БД (соединение, нехватка ресурсов, отмена по statement_timeout/остановка):
+# по одной записи это не исправить — ошибка пачки сразу уходит всем её записям
+_DB_DOWN = (
+    asyncpg.PostgresConnectionError,
+    asyncpg.InsufficientResourcesError,
+    asyncpg.OperatorInterventionError,
+)
+
+
+def _data_error(e: BaseException) -> bool:
+    return isinstance(e, asyncpg.PostgresError) and not isinstance(e, _DB_DOWN)
+
+
+class GroupCommitter:
+    """Групповой коммит: записи копятся max_delay секунд (или до max_batch) и уходят
+    одним вызовом flush(items) -> results — одна транзакция и один fsync на пачку.
+
+    Пока пачка пишется, следующие записи копятся и уходят сразу после неё. Если
+    пачка упала на ошибке данных, записи повторяются по одной через single(item),
+    чтобы одна плохая строка (FK, constraint) не роняла соседей; при недоступной
+    БД (DBUnavailable, обрыв, таймаут) ошибка сразу отдаётся всей пачке. Отмена ожидающего
+    запись не отменяет — она уже в пачке.
+    """
+
+    def __init__(self, name: str,
+                 flush: Callable[[List[Any]], Awaitable[Sequence[Any]]],
+                 single: Callable[[Any], Awaitable[Any]],
+                 max_delay: float = 0.005, max_batch: int = 100):
+        self.name = name
+        self.flush = flush
+        self.single = single
+        self.max_delay = max_delay
+        self.max_batch = max_batch
+        self._pending: List[Tuple[Any, asyncio.Future]] = []
+        self._full = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    async def submit(self, item: Any) -> Any:
+        fut = asyncio.get_running_loop().create_future()
+        # ошибку заберём сами, если ожидающего успели отменить
+        fut.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._pending.append((item, fut))
+        if len(self._pending) >= self.max_batch:
+            self._full.set()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(), name=f"group-commit-{self.name}")
+        return await asyncio.shield(fut)
+
+    async def _run(self):
+        self._full.clear()
+        try:
+            await asyncio.wait_for(self._full.wait(), self.max_delay)
+        except asyncio.TimeoutError:
+            pass
+        while self._pending:
+            batch = self._pending[:self.max_batch]
+            del self._pending[:self.max_batch]
+            self._full.clear()
+            await self._write(batch)
+
+    async def _write(self, batch: List[Tuple[Any, asyncio.Future]]):
+        items = [item for item, _ in batch]
+        metrics.DB_WRITE_BATCH.labels(self.name).observe(len(items))
+        try:
+            results: Sequence[Any] = await self.flush(items)
+        except Exception as e:
+            if len(items) == 1 or not _data_error(e):
+                results = [e] * len(items)
+            else:
+                logger.warning("%s: batch of %d failed, retrying one by one",
+                               self.name, len(items), exc_info=True)
+                results = [await self._single_safe(item) for item in items]
+        for (_, fut), res in zip(batch, results):
+            if fut.done():
+                continue
+            if isinstance(res, BaseException):
+                fut.set_exception(res)
+            else:
+                fut.set_result(res)
+
+    async def _single_safe(self, item: Any) -> Any:
+        try:
+            return await self.single(item)
+        except Exception as e:
+            return e
+
+    async def close(self):
+        """Дописывает накопленное (перед закрытием пула)."""
+        while self._task and not self._task.done():
+            self._full.set()
+            await asyncio.gather(self._task, return_exceptions=True)